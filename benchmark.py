@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# benchmark.py
+'''Benchmark downloader.py and link_collector.py against a local site.
+
+A stand-in for the real site is served by http.server, in a process of its
+own, on 127.0.0.1. Its pages, /view/<n>.html, are either
+
+    synthetic (the default): random sentences drawn from the characters of
+    the pages in CRAWLED_PAGES/, padded to --page-size bytes, with
+    --fan-out links to other pages of the site; or
+    recorded (--recorded): the pages in CRAWLED_PAGES/ as they are, in
+    turn, with the links we follow pointed at pages of the site.
+
+Every response waits --latency seconds, and a share --error-rate of them
+are 500 errors.
+
+downloader.main and link_collector.main are run alternately, as in a real
+crawl, against a fresh database made from create_table.sqlscript in a
+temporary directory, until no pages are due to be downloaded. Each run is a
+process of its own, so that its CPU time and peak RSS are its alone. For
+each tool the benchmark reports pages/sec, CPU time, peak RSS and the rate
+of database rows written; the results are appended, with the settings and
+the git commit, to benchmark_results.jsonl for comparison between versions:
+
+    python benchmark.py run [--label NAME] [settings]
+    python benchmark.py compare [LABEL ...]
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+import http.server
+import multiprocessing
+
+import utils
+import metrics
+import db_writer
+import downloader
+import compression
+import link_collector
+import sentence_extractor
+
+site_name = 'benchmark'
+default_pages = 500
+default_fan_out = 10
+default_page_size = 40 * 1024
+default_latency = 0.0
+default_error_rate = 0.0
+default_max_rounds = 50
+default_seed = 0
+default_results = 'benchmark_results.jsonl'
+repo_directory = os.path.dirname(os.path.abspath(__file__))
+# Used when there are no pages in CRAWLED_PAGES/ to take characters from.
+fallback_text = ('今天天氣很好，我們一起去公園散步。'
+                 '這個城市的交通非常方便，到處都有地鐵站。')
+recorded_link = re.compile(r'''href=(["'])/view[^"']*\1''')
+tools = ('downloader', 'link_collector')
+
+class Site(object):
+    '''The pages of the stand-in site, by path.'''
+    def __init__(self, corpus, pages=default_pages, fan_out=default_fan_out,
+                 page_size=default_page_size, recorded=False,
+                 seed=default_seed):
+        self.page_count = pages
+        self.fan_out = fan_out
+        self.random = random.Random(seed)
+        self.pages = {}
+        if recorded:
+            if not corpus:
+                raise ValueError('no pages in CRAWLED_PAGES to serve')
+            for number in range(pages):
+                self.pages[self.path(number)] = self.recorded_page(
+                        corpus[number % len(corpus)], number)
+        else:
+            characters = self.characters(corpus)
+            for number in range(pages):
+                self.pages[self.path(number)] = self.synthetic_page(
+                        characters, number, page_size)
+        self.pages['/'] = self.index_page()
+
+    @staticmethod
+    def path(number):
+        return '/view/{:d}.html'.format(number)
+
+    @staticmethod
+    def characters(corpus):
+        '''Return the Chinese characters of the main text of the corpus, as
+        a string to draw from.'''
+        text = ''.join(sentence_extractor.chinese_character.findall(
+                ''.join(''.join(sentence_extractor.extract_sentences(page, 1))
+                        for page in corpus)))
+        return text or ''.join(sentence_extractor.chinese_character.findall(
+                fallback_text))
+
+    def targets(self, number, count):
+        '''Return count page numbers for page number to link to. The next
+        page is always among them, so that every page can be reached.'''
+        if not count:
+            return []
+        return [(number + 1) % self.page_count] + [
+                self.random.randrange(self.page_count)
+                for i in range(count - 1)]
+
+    def links(self, targets):
+        return ''.join('<li><a href="{}">{:d}</a></li>'.format(
+                self.path(target), target) for target in targets)
+
+    def synthetic_page(self, characters, number, page_size):
+        head = ('<html><head><meta charset="utf-8"><title>{:d}</title>'
+                '</head><body><div class="article">'.format(number))
+        tail = '</div><ul>{}</ul></body></html>'.format(
+                self.links(self.targets(number, self.fan_out)))
+        size = len(head.encode('utf-8')) + len(tail.encode('utf-8'))
+        paragraphs = []
+        while size < page_size:
+            sentences = []
+            for i in range(self.random.randint(3, 8)):
+                sentences.append(''.join(self.random.choices(
+                        characters, k=self.random.randint(8, 30))))
+            paragraph = '<p>{}。</p>'.format('。'.join(sentences))
+            paragraphs.append(paragraph)
+            size += len(paragraph.encode('utf-8'))
+        return (head + ''.join(paragraphs) + tail).encode('utf-8')
+
+    def recorded_page(self, page_contents, number):
+        if isinstance(page_contents, bytes):
+            page_contents = page_contents.decode('utf-8', 'replace')
+        targets = iter(self.targets(number, len(recorded_link.findall(
+                page_contents))))
+        return recorded_link.sub(
+                lambda match: 'href="{}"'.format(self.path(next(targets))),
+                page_contents).encode('utf-8')
+
+    def index_page(self):
+        return ('<html><head><meta charset="utf-8"><title>index</title>'
+                '</head><body><ul>{}</ul></body></html>'.format(
+                    self.links(self.targets(-1, max(self.fan_out, 1))))
+                ).encode('utf-8')
+
+class SiteHandler(http.server.BaseHTTPRequestHandler):
+    '''Serve the pages of a Site, slowly and with errors as configured (see
+    serve()).'''
+    protocol_version = 'HTTP/1.1'
+    site = None
+    latency = default_latency
+    error_rate = default_error_rate
+    random = random.Random(default_seed)
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        body = self.site.pages.get(self.path)
+        if body is None:
+            self.respond(404, b'not found')
+        elif self.path != '/' and self.random.random() < self.error_rate:
+            self.respond(500, b'injected error')
+        else:
+            self.respond(200, body)
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(site, latency, error_rate, seed, ports):
+    '''Serve site on a free port, which is put on the queue ports.'''
+    SiteHandler.site = site
+    SiteHandler.latency = latency
+    SiteHandler.error_rate = error_rate
+    SiteHandler.random = random.Random(seed)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SiteHandler)
+    server.daemon_threads = True
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def run_tool(tool, start_url, settings, results):
+    '''Run one tool's main() in this process, with its output discarded,
+    and put what it cost on the queue results.'''
+    downloader.set_site(site_name, start_url)
+    link_collector.set_site(site_name, start_url)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        if tool == 'downloader':
+            downloader.main(workers=settings['workers'],
+                            batch_size=settings['batch_size'],
+                            codec=settings['codec'], max_retry_wait=0,
+                            host_rate=settings['host_rate'],
+                            host_concurrency=settings['workers'],
+                            near_duplicates=settings['near_duplicates'],
+                            collect_links=settings['collect_links'])
+        else:
+            link_collector.main(batch_size=settings['batch_size'],
+                                processes=settings['processes'],
+                                extractor=settings['extractor'])
+    elapsed = time.perf_counter() - start
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    results.put({'elapsed': elapsed,
+                 'cpu': (own.ru_utime + own.ru_stime + children.ru_utime +
+                         children.ru_stime),
+                 # ru_maxrss is in kilobytes on Linux.
+                 'peak_rss': max(own.ru_maxrss, children.ru_maxrss) / 1024,
+                 'counters': metrics.registry.snapshot()['counters']})
+
+def pending(name):
+    '''Return the number of pages due to be downloaded; those waiting to be
+    retried later are left to a later crawl, as they would be.'''
+    connection = sqlite3.connect(name)
+    try:
+        return connection.execute('''SELECT count(*) FROM urls
+                WHERE date_downloaded IS NULL AND dead_letter IS NULL
+                AND (next_attempt IS NULL OR next_attempt <= ?)''',
+                (utils.timestamp(),)).fetchone()[0]
+    finally:
+        connection.close()
+
+def run_crawl(start_url, settings):
+    '''Crawl the site from a fresh database in the present directory; return
+    a dict of totals for each tool and the number of rounds.'''
+    with open(os.path.join(repo_directory, 'create_table.sqlscript')) as \
+            file_object:
+        connection = sqlite3.connect('crawl_{}.db'.format(site_name))
+        connection.executescript(file_object.read())
+        connection.close()
+    os.mkdir('CRAWLED_PAGES')
+    # Each tool runs in a fresh interpreter, without the memory of this one.
+    context = multiprocessing.get_context('spawn')
+    totals = {tool: {'elapsed': 0.0, 'cpu': 0.0, 'peak_rss': 0.0,
+                     'counters': {}} for tool in tools}
+    rounds = 0
+    while rounds < settings['max_rounds']:
+        rounds += 1
+        for tool in tools:
+            results = context.Queue()
+            process = context.Process(target=run_tool, args=(
+                    tool, start_url, settings, results))
+            process.start()
+            result = results.get()
+            process.join()
+            total = totals[tool]
+            total['elapsed'] += result['elapsed']
+            total['cpu'] += result['cpu']
+            total['peak_rss'] = max(total['peak_rss'], result['peak_rss'])
+            for name, value in result['counters'].items():
+                total['counters'][name] = total['counters'].get(name, 0) + value
+            print('.' if tool == 'downloader' else '|', end='')
+            sys.stdout.flush()
+        if not pending('crawl_{}.db'.format(site_name)):
+            break
+    return totals, rounds
+
+def summarize(totals):
+    '''Return the figures reported for each tool.'''
+    figures = {}
+    for tool, total in totals.items():
+        counters = total['counters']
+        pages = counters.get('pages_saved' if tool == 'downloader'
+                             else 'pages_crawled', 0)
+        elapsed = max(total['elapsed'], 1e-9)
+        figures[tool] = {
+                'pages': pages,
+                'seconds': round(total['elapsed'], 3),
+                'pages_per_sec': round(pages / elapsed, 2),
+                'cpu_seconds': round(total['cpu'], 3),
+                'peak_rss_mb': round(total['peak_rss'], 1),
+                'db_rows': counters.get('db_rows', 0),
+                'db_rows_per_sec': round(counters.get('db_rows', 0) / elapsed,
+                                         1),
+                'errors': counters.get('download_failures', 0)}
+    return figures
+
+def git_commit():
+    '''Return the short hash of the commit checked out, or None.'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=repo_directory, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(settings, label=None, results_path=default_results):
+    '''Serve the site, crawl it, print and save the results.'''
+    corpus = compression.read_corpus(os.path.join(repo_directory,
+                                                  'CRAWLED_PAGES'))
+    site = Site(corpus, settings['pages'], settings['fan_out'],
+                settings['page_size'], settings['recorded'], settings['seed'])
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(
+            site, settings['latency'], settings['error_rate'],
+            settings['seed'], ports))
+    server.daemon = True
+    server.start()
+    start_url = 'http://127.0.0.1:{:d}'.format(ports.get())
+    print('Serving {0:d} pages of {1:.1f} KB on average at {2}.'.format(
+            len(site.pages), sum(len(page) for page in site.pages.values()) /
+            len(site.pages) / 1024, start_url))
+    print('We print . for a run of downloader.py and | for one of '
+          'link_collector.py:')
+    here = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            totals, rounds = run_crawl(start_url, settings)
+    finally:
+        os.chdir(here)
+        server.terminate()
+        server.join()
+    figures = summarize(totals)
+    record = {'label': label or time.strftime('%Y%m%d_%H%M%S'),
+              'date': utils.timestamp(), 'commit': git_commit(),
+              'settings': settings, 'rounds': rounds, 'results': figures}
+    print('\n\n{0} rounds.'.format(rounds))
+    print_table([record])
+    with open(results_path, 'a') as file_object:
+        file_object.write(json.dumps(record, sort_keys=True) + '\n')
+    print('\nResults appended to {} as {}.'.format(results_path,
+                                                   record['label']))
+
+def print_table(records):
+    '''Print the results of records side by side, tool by tool.'''
+    columns = [('pages', 'pages', '{:d}'),
+               ('pages/sec', 'pages_per_sec', '{:.1f}'),
+               ('CPU sec', 'cpu_seconds', '{:.2f}'),
+               ('peak MB', 'peak_rss_mb', '{:.1f}'),
+               ('rows/sec', 'db_rows_per_sec', '{:.0f}'),
+               ('errors', 'errors', '{:d}')]
+    print('{:<16} {:<15} {:<8}'.format('tool', 'label', 'commit') + ''.join(
+            ' {:>10}'.format(heading) for heading, key, form in columns))
+    for tool in tools:
+        for record in records:
+            figures = record['results'][tool]
+            print('{:<16} {:<15} {:<8}'.format(
+                    tool, record['label'][:15], record['commit'] or '-') +
+                  ''.join(' {:>10}'.format(form.format(figures[key]))
+                          for heading, key, form in columns))
+
+def compare(labels=(), results_path=default_results):
+    '''Print saved results side by side: those with the given labels, or
+    the last two.'''
+    try:
+        with open(results_path) as file_object:
+            records = [json.loads(line) for line in file_object if line.strip()]
+    except OSError:
+        records = []
+    if labels:
+        records = [record for record in records if record['label'] in labels]
+    else:
+        records = records[-2:]
+    if not records:
+        print('No results to compare in {}.'.format(results_path))
+        return
+    settings = {json.dumps(record['settings'], sort_keys=True)
+                for record in records}
+    if len(settings) > 1:
+        print('Note: these results were not all run with the same '
+              'settings.\n')
+    print_table(records)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser(
+            'run', help='crawl the stand-in site and save the results')
+    run_parser.add_argument('--label',
+                            help='name the results are saved under '
+                                 '(default: the date and time)')
+    run_parser.add_argument('--results', default=default_results,
+                            help='file the results are appended to '
+                                 '(default {})'.format(default_results))
+    run_parser.add_argument('--pages', type=int, default=default_pages,
+                            help='pages in the site (default {})'.format(
+                                default_pages))
+    run_parser.add_argument('--fan-out', type=int, default=default_fan_out,
+                            help='links on each synthetic page (default {})'
+                                 .format(default_fan_out))
+    run_parser.add_argument('--page-size', type=int,
+                            default=default_page_size,
+                            help='bytes in each synthetic page (default {})'
+                                 .format(default_page_size))
+    run_parser.add_argument('--recorded', action='store_true',
+                            help='serve the pages in CRAWLED_PAGES instead of '
+                                 'synthetic ones')
+    run_parser.add_argument('--latency', type=float, default=default_latency,
+                            help='seconds each response is delayed '
+                                 '(default {:g})'.format(default_latency))
+    run_parser.add_argument('--error-rate', type=float,
+                            default=default_error_rate,
+                            help='share of pages answered with a 500 error '
+                                 '(default {:g})'.format(default_error_rate))
+    run_parser.add_argument('--seed', type=int, default=default_seed,
+                            help='seed for the site and its errors '
+                                 '(default {})'.format(default_seed))
+    run_parser.add_argument('--max-rounds', type=int,
+                            default=default_max_rounds,
+                            help='most runs of each tool (default {})'.format(
+                                default_max_rounds))
+    run_parser.add_argument('-w', '--workers', type=int,
+                            default=downloader.default_workers,
+                            help='downloader workers (default {})'.format(
+                                downloader.default_workers))
+    run_parser.add_argument('-p', '--processes', type=int,
+                            default=link_collector.default_processes,
+                            help='link collector processes (default {})'
+                                 .format(link_collector.default_processes))
+    run_parser.add_argument('--batch-size', type=int,
+                            default=db_writer.default_batch_size,
+                            help='database writes per transaction '
+                                 '(default {})'.format(
+                                     db_writer.default_batch_size))
+    run_parser.add_argument('--codec',
+                            choices=sorted(compression.codecs),
+                            default=compression.default_codec,
+                            help='compression for stored pages (default {})'
+                                 .format(compression.default_codec))
+    run_parser.add_argument('--extractor',
+                            choices=sorted(
+                                link_collector.link_extractors.backends),
+                            default=link_collector.link_extractors
+                                    .default_backend,
+                            help='link extraction backend (default {})'.format(
+                                link_collector.link_extractors.default_backend))
+    run_parser.add_argument('--host-rate', type=float, default=0,
+                            help='most requests a second to the site; 0 for '
+                                 'no limit (default 0)')
+    run_parser.add_argument('--near-duplicates',
+                            choices=downloader.neardup.modes,
+                            default=downloader.neardup.default_mode,
+                            help='near-duplicate mode of the downloader '
+                                 '(default {})'.format(
+                                     downloader.neardup.default_mode))
+    run_parser.add_argument('--no-collect-links', dest='collect_links',
+                            action='store_false',
+                            help='leave the links for link_collector.py to '
+                                 'find, rather than taking them as pages '
+                                 'are downloaded')
+    compare_parser = subparsers.add_parser(
+            'compare', help='show saved results side by side')
+    compare_parser.add_argument('labels', nargs='*',
+                                help='labels of the results to show '
+                                     '(default: the last two)')
+    compare_parser.add_argument('--results', default=default_results,
+                                help='file the results are read from '
+                                     '(default {})'.format(default_results))
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == 'run':
+        settings = {name: getattr(arguments, name) for name in (
+                'pages', 'fan_out', 'page_size', 'recorded', 'latency',
+                'error_rate', 'seed', 'max_rounds', 'workers', 'processes',
+                'batch_size', 'codec', 'extractor', 'host_rate',
+                'near_duplicates', 'collect_links')}
+        run(settings, arguments.label, arguments.results)
+    elif arguments.command == 'compare':
+        compare(arguments.labels, arguments.results)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# canonical.py
+'''Canonical form of the URLs we store, so that variants are stored once.
+
+canonicalize() resolves a link against the page's site and then:
+
+    lower-cases the scheme and host, and drops a default port;
+    drops the fragment;
+    resolves . and .. segments, and drops a trailing slash (but not the
+    root's);
+    upper-cases percent escapes and escapes any other non-ASCII characters;
+    filters the query by the rule for the host (see query_rules), and sorts
+    what is left.
+
+Results are memoized with functools.lru_cache, since most links recur on
+many pages.
+
+Run as a script to merge the rows of the urls table whose URLs have the same
+canonical form, and canonicalize the rest:
+
+    python canonical.py merge [--dry-run] [--site NAME]
+'''
+
+import re
+import logging
+import argparse
+import functools
+import posixpath
+import collections
+import urllib.parse
+
+import utils
+import crawl_db
+
+default_cache_size = 2**16
+default_ports = {'http': 80, 'https': 443}
+# What to keep of the query string, by host (or a domain the host is in):
+# keep is None to keep every parameter but those in strip, or a tuple of the
+# only parameters to keep. Hosts not listed lose the usual tracking
+# parameters.
+QueryRule = collections.namedtuple('QueryRule', 'keep strip')
+default_query_rule = QueryRule(None, ('utm_source', 'utm_medium',
+                                      'utm_campaign', 'utm_term',
+                                      'utm_content', 'fbclid', 'gclid'))
+query_rules = {
+    # Query strings here are only ever references to where a link was.
+    'worldjournal.com': QueryRule((), ()),
+}
+percent_escape = re.compile('%[0-9a-fA-F]{2}')
+# Characters left as they are in paths and in query parameters. A query is
+# decoded to its parameters before it is filtered, so &, =, +, ; and % in a
+# name or value must be escaped again when it is put back together.
+safe_path = "/%:@!$&'()*+,;=-._~"
+safe_query = "/:@!$'()*,?"
+
+def set_query_rule(domain, keep=None, strip=()):
+    '''Set the query rule for domain and the hosts in it.'''
+    query_rules[domain] = QueryRule(tuple(keep) if keep is not None else None,
+                                    tuple(strip))
+    canonicalize.cache_clear()
+
+def query_rule(host):
+    '''Return the rule for host, or for the nearest domain it is in.'''
+    parts = host.split('.')
+    for i in range(len(parts)):
+        rule = query_rules.get('.'.join(parts[i:]))
+        if rule is not None:
+            return rule
+    return default_query_rule
+
+def normalize_path(path):
+    if not path:
+        return '/'
+    normalized = posixpath.normpath(path)
+    # normpath keeps a leading //, which is not a path we want.
+    normalized = '/' + normalized.lstrip('/')
+    if normalized == '/.':
+        normalized = '/'
+    return urllib.parse.quote(
+            percent_escape.sub(lambda m: m.group(0).upper(), normalized),
+            safe=safe_path)
+
+def normalize_query(query, host):
+    if not query:
+        return ''
+    rule = query_rule(host)
+    parameters = urllib.parse.parse_qsl(query, keep_blank_values=True)
+    if rule.keep is not None:
+        parameters = [p for p in parameters if p[0] in rule.keep]
+    parameters = [p for p in parameters if p[0] not in rule.strip]
+    return urllib.parse.urlencode(sorted(parameters), safe=safe_query)
+
+@functools.lru_cache(maxsize=default_cache_size)
+def canonicalize(url, base=None):
+    '''Return the canonical form of url, resolved against base if it is
+    relative, or None if it is empty or not an http(s) URL.'''
+    if not url:
+        return None
+    url = url.strip()
+    if base:
+        url = urllib.parse.urljoin(base, url)
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError as e:
+        logging.warning(str(e) + ' with URL = ' + url)
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in default_ports or not parts.hostname:
+        return None
+    host = parts.hostname.rstrip('.')
+    netloc = host
+    if port and port != default_ports[scheme]:
+        netloc += ':{:d}'.format(port)
+    return urllib.parse.urlunsplit((scheme, netloc,
+                                    normalize_path(parts.path),
+                                    normalize_query(parts.query, host), ''))
+
+def merge_duplicates(connection, dry_run=False):
+    '''Canonicalize the URLs in the urls table, merging rows whose URLs have
+    the same canonical form into one: the first downloaded, or else the
+    first added. Return (rows renamed, rows merged away).'''
+    groups = collections.defaultdict(list)
+    for row_id, url, downloaded in connection.execute(
+            '''SELECT id, url, date_downloaded IS NOT NULL FROM urls
+            WHERE url IS NOT NULL ORDER BY id'''):
+        groups[canonicalize(url) or url].append((not downloaded, row_id, url))
+    count_renamed = count_merged = 0
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        for canonical_url, rows in groups.items():
+            rows.sort()
+            keep, extra = rows[0], rows[1:]
+            if extra:
+                count_merged += len(extra)
+                connection.executemany('DELETE FROM urls WHERE id = ?',
+                                       [(row[1],) for row in extra])
+            if keep[2] != canonical_url:
+                count_renamed += 1
+                connection.execute('UPDATE urls SET url = ? WHERE id = ?',
+                                   (canonical_url, keep[1]))
+        if dry_run:
+            connection.rollback()
+        else:
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return count_renamed, count_merged
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge_parser = subparsers.add_parser(
+            'merge', help='merge rows whose URLs are the same once '
+                          'canonicalized')
+    merge_parser.add_argument('--site', default=utils.default_site,
+                              help='short name of the site (default {})'
+                                   .format(utils.default_site))
+    merge_parser.add_argument('--dry-run', action='store_true',
+                              help='report what would change, change nothing')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == 'merge':
+        connection = crawl_db.connect(arguments.site)
+        renamed, merged = merge_duplicates(connection, arguments.dry_run)
+        connection.close()
+        print('{0} URLs canonicalized; {1} duplicate rows merged{2}.'.format(
+                renamed, merged, ' (dry run)' if arguments.dry_run else ''))
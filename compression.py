@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# compression.py
+'''Compression codecs for stored pages.
+
+Each codec has a name, used on the command line, and a number, recorded with
+every page in the pack index (see pack_store.py) so that a page is always
+read with the codec it was written with. Pages saved before codecs were
+configurable are bz2.
+
+Run as a script to compare the codecs on the pages already downloaded:
+
+    python compression.py [directory]
+'''
+
+import os
+import bz2
+import sys
+import time
+import zlib
+import lzma
+
+import pack_store
+
+class Codec(object):
+    def __init__(self, number, name, compress, decompress, compressor,
+                 decompressor):
+        self.number = number
+        self.name = name
+        # Whole-buffer functions.
+        self.compress = compress
+        self.decompress = decompress
+        # Factories for incremental (de)compressor objects, with compress()
+        # or decompress() and flush() methods.
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+class NullCompressor(object):
+    '''Incremental "compressor" for the none codec.'''
+    def compress(self, data):
+        return data
+
+    decompress = compress
+
+    def flush(self):
+        return b''
+
+codec_list = [
+    Codec(0, 'none', bytes, bytes, NullCompressor, NullCompressor),
+    Codec(1, 'bz2', bz2.compress, bz2.decompress, bz2.BZ2Compressor,
+          bz2.BZ2Decompressor),
+    Codec(2, 'zlib', zlib.compress, zlib.decompress, zlib.compressobj,
+          zlib.decompressobj),
+    Codec(3, 'lzma', lzma.compress, lzma.decompress, lzma.LZMACompressor,
+          lzma.LZMADecompressor),
+]
+codecs = {codec.name: codec for codec in codec_list}
+codecs_by_number = {codec.number: codec for codec in codec_list}
+default_codec = 'zlib'
+# Codec of the pages saved before codecs were recorded.
+legacy_codec = codecs_by_number[pack_store.legacy_codec].name
+
+def iterate_corpus(directory=pack_store.default_directory):
+    '''Yield (hash, uncompressed page) for the pages in directory, from pack
+    stores and from files saved one per page, each page once.'''
+    seen = set()
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.idx'):
+            store = pack_store.PackStore(directory, filename[:-len('.idx')])
+            for hash, codec, data in store:
+                if hash not in seen:
+                    seen.add(hash)
+                    yield hash, codecs_by_number[codec].decompress(data)
+            store.close()
+            continue
+        match = pack_store.page_filename.match(filename)
+        if match and match.group('hash') not in seen:
+            seen.add(match.group('hash'))
+            with open(os.path.join(directory, filename), 'rb') as file_object:
+                yield match.group('hash'), codecs[legacy_codec].decompress(
+                        file_object.read())
+
+def read_corpus(directory=pack_store.default_directory):
+    '''Return the uncompressed pages in directory (see iterate_corpus()).'''
+    return [page for hash, page in iterate_corpus(directory)]
+
+def benchmark(pages):
+    '''Compress and decompress pages with every codec; return a list of
+    (name, ratio, compress MB/s, decompress MB/s).'''
+    raw_size = sum(len(page) for page in pages)
+    megabytes = raw_size / 2**20
+    results = []
+    for codec in codec_list:
+        start = time.perf_counter()
+        compressed = [codec.compress(page) for page in pages]
+        compress_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in compressed:
+            codec.decompress(data)
+        decompress_time = time.perf_counter() - start
+        compressed_size = sum(len(data) for data in compressed)
+        results.append((codec.name, raw_size / max(compressed_size, 1),
+                        megabytes / max(compress_time, 1e-9),
+                        megabytes / max(decompress_time, 1e-9)))
+    return results
+
+def main(directory=pack_store.default_directory):
+    pages = read_corpus(directory)
+    if not pages:
+        print('No pages found in {}.'.format(directory))
+        return
+    print('{0} pages, {1:.2f} MB uncompressed.\n'.format(
+            len(pages), sum(len(page) for page in pages) / 2**20))
+    print('{:<6} {:>7} {:>14} {:>16}'.format('codec', 'ratio',
+                                             'compress MB/s',
+                                             'decompress MB/s'))
+    for name, ratio, compress_rate, decompress_rate in benchmark(pages):
+        print('{:<6} {:>7.2f} {:>14.1f} {:>16.1f}'.format(
+                name, ratio, compress_rate, decompress_rate))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
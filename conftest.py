@@ -0,0 +1,59 @@
+# conftest.py
+'''Fixtures shared by the tests; see pytest.'''
+
+import os
+import sqlite3
+import threading
+import http.server
+
+import pytest
+
+import crawl_db
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'create_table.sqlscript')
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    '''Return the name of a site with a fresh crawl database, and a
+    CRAWLED_PAGES directory, in tmp_path, the working directory.'''
+    site = 'testsite'
+    monkeypatch.chdir(tmp_path)
+    with open(script) as file_object:
+        connection = sqlite3.connect(crawl_db.db_name(site))
+        connection.executescript(file_object.read())
+        connection.close()
+    os.mkdir('CRAWLED_PAGES')
+    return site
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    '''Serve a page, but fail the first request for each path.'''
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.requests.count(self.path) == 1:
+            self.send_error(500)
+            return
+        body = '<html><body><p>第一页。</p></body></html>'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def flaky_site():
+    '''Serve FlakyHandler; return (its URL, the paths requested).'''
+    FlakyHandler.requests = []
+    server = http.server.HTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield ('http://127.0.0.1:{}'.format(server.server_port),
+           FlakyHandler.requests)
+    server.shutdown()
+    server.server_close()
+
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# coordinator.py
+'''Run several downloaders at once over one site's database.
+
+Each worker is a downloader.py process run with --lease: it claims batches
+of URLs under leases in the crawl database (see crawl_db.claim_urls()),
+downloads them, writes the links it finds, and stops once there has been
+nothing to claim for --idle-wait seconds. The per-host limits, and those of
+robots.txt, are split among the workers (see downloader.py --host-share),
+so that together they ask no more of a host than one downloader would; so
+there can be no more workers than --host-concurrency. With --shard each
+worker claims only the URLs in its own shard, by hash of the URL.
+
+    python coordinator.py start [-n N] [--site NAME] [-- DOWNLOADER FLAGS]
+
+starts N workers and watches them: every --interval seconds expired leases
+are cleared, workers that have stopped are started again while there are
+URLs ready, and a line of status is printed. It stops when no worker is
+running, no URL is ready and no lease is held; Ctrl-C stops the workers
+after the batches they are on.
+
+    python coordinator.py scale N [--site NAME]
+
+asks the running coordinator to restart its workers as N, and
+
+    python coordinator.py status [--site NAME]
+
+shows the workers, the leases held and the URLs ready.
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+import subprocess
+
+import utils
+import crawl_db
+import politeness
+import downloader
+
+default_workers = 4
+default_interval = 10.0
+downloader_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'downloader.py')
+
+def state_name(site):
+    '''The file in which the running coordinator describes its workers.'''
+    return 'coordinator_' + site + '.json'
+
+def scale_name(site):
+    '''The file in which `scale` leaves the number of workers wanted.'''
+    return 'coordinator_' + site + '.scale'
+
+class Worker(object):
+    '''One downloader.py process, in slot index of count.'''
+    def __init__(self, index, count, owner):
+        self.index = index
+        self.count = count
+        self.owner = owner
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        # Coordinator.progress() when the worker was started and, if it
+        # stopped without changing it, when it stopped.
+        self.progress_at_start = None
+        self.stalled_at = None
+
+    def command(self, coordinator, start_page):
+        command = [sys.executable, downloader_script,
+                   '--site', coordinator.site,
+                   '--lease', str(coordinator.lease_seconds),
+                   '--owner', self.owner,
+                   '--idle-wait', str(coordinator.idle_wait),
+                   # Each worker keeps to its share of the per-host limits.
+                   '--host-rate', str(coordinator.host_rate),
+                   '--host-concurrency', str(coordinator.host_concurrency),
+                   '--host-share', '{0}/{1}'.format(self.index, self.count)]
+        if coordinator.start_url:
+            command += ['--start-url', coordinator.start_url]
+        if coordinator.shard:
+            command += ['--shard', '{0}/{1}'.format(self.index, self.count)]
+        if not start_page:
+            command.append('--no-start-page')
+        return command + coordinator.downloader_arguments
+
+    def start(self, coordinator, start_page=False):
+        if coordinator.output_directory:
+            output = open(os.path.join(coordinator.output_directory,
+                                       self.owner + '.log'), 'a')
+        else:
+            output = subprocess.DEVNULL
+        # In a session of its own, so that Ctrl-C reaches only the
+        # coordinator, which stops the workers in good order.
+        self.process = subprocess.Popen(
+                self.command(coordinator, start_page), stdout=output,
+                stderr=subprocess.STDOUT, start_new_session=True)
+        if output is not subprocess.DEVNULL:
+            output.close()
+        self.started = time.time()
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def shard(self, coordinator):
+        return (self.index, self.count) if coordinator.shard else None
+
+class Coordinator(object):
+    def __init__(self, site, start_url=None, workers=default_workers,
+                 lease_seconds=downloader.default_lease, shard=False,
+                 host_rate=politeness.default_rate,
+                 host_concurrency=politeness.default_concurrency,
+                 idle_wait=downloader.default_idle_wait,
+                 interval=default_interval, output_directory=None,
+                 downloader_arguments=()):
+        self.site = site
+        self.start_url = start_url
+        self.target = workers
+        self.lease_seconds = lease_seconds
+        self.shard = shard
+        self.host_rate = host_rate
+        self.host_concurrency = host_concurrency
+        self.idle_wait = idle_wait
+        self.interval = interval
+        self.output_directory = output_directory
+        self.downloader_arguments = list(downloader_arguments)
+        self.workers = []
+        self.stopping = threading.Event()
+        self.count_crashes = 0
+        self.count_reclaimed = 0
+        self.start_time = time.time()
+
+    def stop(self, signal_number=None, frame=None):
+        self.stopping.set()
+
+    def progress(self):
+        '''Return (URLs done with, URLs ready or leased): a worker that
+        changes neither gets nowhere.'''
+        return (crawl_db.count(self.connection, 'downloaded') +
+                crawl_db.count(self.connection, 'dead_letter'),
+                crawl_db.count_ready_to_download(self.connection) +
+                sum(count for owner, count, expires in
+                    crawl_db.leases(self.connection)))
+
+    def start_worker(self, worker, start_page=False):
+        worker.progress_at_start = self.progress()
+        worker.stalled_at = None
+        worker.start(self, start_page)
+
+    def start_workers(self, count, start_page=False):
+        self.workers = [Worker(index, count,
+                               '{0}-w{1:d}'.format(self.site, index))
+                        for index in range(count)]
+        for worker in self.workers:
+            # The top-level page is fetched by the first worker only.
+            self.start_worker(worker, start_page and worker.index == 0)
+        self.save_state()
+        print('Started {} workers.'.format(count))
+
+    def stop_workers(self):
+        '''Ask the workers to stop after the batches they are on, and wait
+        for them.'''
+        for worker in self.workers:
+            if worker.running():
+                worker.process.send_signal(signal.SIGTERM)
+        for worker in self.workers:
+            if worker.process:
+                worker.process.wait()
+        # A worker that was killed may have left leases behind.
+        for worker in self.workers:
+            crawl_db.release_leases(self.connection, worker.owner)
+
+    def check_workers(self):
+        '''Start again the workers that have stopped, if there is work in
+        their shard.
+
+        A worker that stopped without any URL being done with, and without
+        fewer waiting, is not started again until something changes: the
+        URLs left are ones it cannot complete.
+        '''
+        progress = self.progress()
+        for worker in self.workers:
+            if worker.running():
+                continue
+            if worker.process:
+                if worker.process.returncode != 0:
+                    self.count_crashes += 1
+                    print('\n{0} exited with status {1}'.format(
+                            worker.owner, worker.process.returncode))
+                    # Its leases need not wait to expire.
+                    crawl_db.release_leases(self.connection, worker.owner)
+                done, waiting = worker.progress_at_start
+                if progress[0] == done and progress[1] >= waiting:
+                    print('\n{} stopped without getting anywhere'.format(
+                            worker.owner))
+                    worker.stalled_at = progress
+                worker.process = None
+            if self.has_work(worker, progress):
+                worker.restarts += 1
+                self.start_worker(worker)
+
+    def has_work(self, worker, progress):
+        '''Whether worker, stopped, should be started again.'''
+        return (worker.stalled_at != progress and
+                crawl_db.count_ready_to_download(self.connection,
+                                                 worker.shard(self)))
+
+    def check_scale(self):
+        '''Apply a number of workers left by `scale`.'''
+        try:
+            with open(scale_name(self.site)) as file_object:
+                count = int(file_object.read())
+            os.remove(scale_name(self.site))
+        except (OSError, ValueError):
+            return
+        if count < 1 or count == len(self.workers):
+            return
+        if count > self.host_concurrency:
+            print('\nNot scaling to {0} workers: they cannot share a host '
+                  'concurrency of {1}.'.format(count, self.host_concurrency))
+            return
+        print('\nScaling from {0} to {1} workers.'.format(
+                len(self.workers), count))
+        self.stop_workers()
+        self.target = count
+        self.start_workers(count)
+
+    def finished(self):
+        '''Whether no worker runs or has work to do, and no lease is held.'''
+        if any(worker.running() for worker in self.workers):
+            return False
+        progress = self.progress()
+        return (not any(self.has_work(worker, progress)
+                        for worker in self.workers) and
+                not crawl_db.leases(self.connection))
+
+    def save_state(self):
+        state = {'pid': os.getpid(), 'site': self.site,
+                 'started': self.start_time, 'crashes': self.count_crashes,
+                 'host_concurrency': self.host_concurrency,
+                 'workers': [{'owner': worker.owner,
+                              'pid': (worker.process.pid if worker.process
+                                      else None),
+                              'running': worker.running(),
+                              'started': worker.started,
+                              'restarts': worker.restarts}
+                             for worker in self.workers]}
+        with open(state_name(self.site) + '.tmp', 'w') as file_object:
+            json.dump(state, file_object, indent=1)
+        os.replace(state_name(self.site) + '.tmp', state_name(self.site))
+
+    def status_line(self):
+        return ('{0:.0f}s: {1}/{2} workers running; {3} URLs ready, {4} '
+                'leased, {5} downloaded; {6} leases reclaimed, {7} '
+                'crashes'.format(
+                    time.time() - self.start_time,
+                    sum(worker.running() for worker in self.workers),
+                    len(self.workers),
+                    crawl_db.count_ready_to_download(self.connection),
+                    sum(count for owner, count, expires in
+                        crawl_db.leases(self.connection)),
+                    crawl_db.count(self.connection, 'downloaded'),
+                    self.count_reclaimed, self.count_crashes))
+
+    def run(self):
+        if self.output_directory:
+            os.makedirs(self.output_directory, exist_ok=True)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.connection = crawl_db.connect(self.site)
+        try:
+            self.start_workers(self.target, start_page=True)
+            while not self.stopping.wait(self.interval):
+                self.count_reclaimed += crawl_db.reclaim_expired_leases(
+                        self.connection)
+                self.check_scale()
+                self.check_workers()
+                self.save_state()
+                print(self.status_line())
+                if self.finished():
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print('\nStopping the workers.')
+            self.stop_workers()
+            print(self.status_line())
+            self.connection.close()
+            os.remove(state_name(self.site))
+
+def scale(site, count):
+    '''Ask the coordinator of site to run count workers.'''
+    try:
+        with open(state_name(site)) as file_object:
+            state = json.load(file_object)
+    except OSError:
+        print('No coordinator is running for {}.'.format(site))
+        return
+    if count > state['host_concurrency']:
+        print('At most {0} workers can share a host concurrency of {0}.'
+              .format(state['host_concurrency']))
+        return
+    with open(scale_name(site), 'w') as file_object:
+        file_object.write(str(count))
+    print('The coordinator will run {} workers at its next check.'.format(
+            count))
+
+def status(site):
+    '''Print the workers, leases and URLs ready for site.'''
+    connection = crawl_db.connect(site)
+    print('URLs ready to download: {0}; not yet downloaded: {1}'.format(
+            crawl_db.count_ready_to_download(connection),
+            crawl_db.count_to_download(connection)))
+    rows = crawl_db.leases(connection)
+    print('Leases held: {}'.format(sum(row[1] for row in rows)))
+    for owner, count, expires in rows:
+        print('    {0:<24} {1:>6} URLs, first expiring {2}'.format(
+                owner, count, expires))
+    connection.close()
+    try:
+        with open(state_name(site)) as file_object:
+            state = json.load(file_object)
+    except OSError:
+        print('No coordinator is running.')
+        return
+    print('Coordinator (pid {0}), {1} crashes:'.format(state['pid'],
+                                                       state['crashes']))
+    for worker in state['workers']:
+        print('    {0:<24} pid {1!s:<8} {2:<8} {3} restarts'.format(
+                worker['owner'], worker['pid'],
+                'running' if worker['running'] else 'stopped',
+                worker['restarts']))
+
+def parse_arguments(argv=None):
+    # Whatever follows -- is passed on to every worker.
+    argv = sys.argv[1:] if argv is None else list(argv)
+    downloader_arguments = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, downloader_arguments = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    start_parser = subparsers.add_parser(
+            'start', help='start the workers and watch them')
+    utils.add_site_flags(start_parser)
+    start_parser.add_argument('-n', '--workers', type=int,
+                              default=default_workers,
+                              help='number of downloader processes '
+                                   '(default {})'.format(default_workers))
+    start_parser.add_argument('--lease', dest='lease_seconds', type=float,
+                              default=downloader.default_lease,
+                              help='seconds for which a worker holds the '
+                                   'URLs it claims (default {})'.format(
+                                       downloader.default_lease))
+    start_parser.add_argument('--shard', action='store_true',
+                              help='give each worker its own shard of the '
+                                   'URLs, by hash')
+    start_parser.add_argument('--host-rate', type=float,
+                              default=politeness.default_rate,
+                              help='most requests a second to any one host, '
+                                   'by all workers together (default '
+                                   '{})'.format(politeness.default_rate))
+    start_parser.add_argument('--host-concurrency', type=int,
+                              default=politeness.default_concurrency,
+                              help='most requests at once to any one host, '
+                                   'by all workers together (default '
+                                   '{})'.format(
+                                       politeness.default_concurrency))
+    start_parser.add_argument('--idle-wait', type=float,
+                              default=downloader.default_idle_wait,
+                              help='seconds a worker waits for URLs to '
+                                   'claim before stopping (default '
+                                   '{})'.format(downloader.default_idle_wait))
+    start_parser.add_argument('--interval', type=float,
+                              default=default_interval,
+                              help='seconds between checks of the workers '
+                                   '(default {:g})'.format(default_interval))
+    start_parser.add_argument('--worker-output', dest='output_directory',
+                              help='keep the output of each worker in '
+                                   'DIRECTORY/OWNER.log, rather than '
+                                   'discarding it')
+    scale_parser = subparsers.add_parser(
+            'scale', help='change the number of workers running')
+    utils.add_site_flags(scale_parser)
+    scale_parser.add_argument('count', type=int)
+    status_parser = subparsers.add_parser(
+            'status', help='show the workers, leases and URLs ready')
+    utils.add_site_flags(status_parser)
+    arguments = parser.parse_args(argv)
+    arguments.downloader_arguments = downloader_arguments
+    return arguments
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == 'start':
+        if arguments.workers > arguments.host_concurrency:
+            sys.exit('At most {0} workers can share a --host-concurrency of '
+                     '{0}.'.format(arguments.host_concurrency))
+        coordinator = Coordinator(arguments.site, arguments.start_url,
+                                  arguments.workers, arguments.lease_seconds,
+                                  arguments.shard, arguments.host_rate,
+                                  arguments.host_concurrency,
+                                  arguments.idle_wait, arguments.interval,
+                                  arguments.output_directory,
+                                  arguments.downloader_arguments)
+        coordinator.run()
+    elif arguments.command == 'scale':
+        if arguments.count < 1:
+            sys.exit('At least one worker is needed.')
+        scale(arguments.site, arguments.count)
+    else:
+        status(arguments.site)
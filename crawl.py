@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# crawl.py
+'''Continuous crawler: download pages and collect their links in one run.
+
+Instead of running downloader.py and link_collector.py alternately, the
+stages run side by side, connected by bounded queues:
+
+    fetch (worker threads) -> link extraction (parser threads) -> database
+
+A single thread owns the database connection. It feeds the fetch queue from
+the pending URLs in the database, in order of id; links found on a page are
+inserted and so reach the fetch queue in the same run. The database thread
+only ever tops the queues up without waiting, so a full queue holds back the
+earlier stages but can never deadlock them.
+
+Interrupting with Ctrl-C stops new work from being queued; pages already in
+the pipeline are finished and written before exit. Everything needed to
+resume is in the database: a restart picks up URLs not yet downloaded (those
+that failed once their retry falls due; see downloader.py) and pages
+downloaded but not yet crawled for links. URLs that fail in this run are
+queued again as their retry falls due; the run waits for those due within
+--max-retry-wait seconds, and leaves the rest to a later run.
+'''
+
+import sys
+import time
+import queue
+import signal
+import logging
+import argparse
+import datetime
+import threading
+
+import utils
+import crawl_db
+import db_writer
+import compression
+import downloader
+import link_collector
+import politeness
+import url_filter
+import neardup
+import metrics
+
+default_parsers = 2
+# Queue lengths, per fetch worker.
+default_queue_factor = 4
+
+class Crawler(object):
+    def __init__(self, logging_flag='', workers=downloader.default_workers,
+                 parsers=default_parsers, queue_size=None,
+                 batch_size=db_writer.default_batch_size,
+                 flush_interval=db_writer.default_flush_interval,
+                 codec=compression.default_codec,
+                 max_attempts=downloader.default_max_attempts,
+                 host_rate=politeness.default_rate,
+                 host_concurrency=politeness.default_concurrency,
+                 obey_robots=True, filter_kind=url_filter.default_kind,
+                 filter_error_rate=url_filter.default_error_rate,
+                 filter_memory=None, near_duplicates=neardup.default_mode,
+                 max_distance=neardup.default_max_distance,
+                 max_retry_wait=downloader.default_max_retry_wait):
+        utils.set_up_logger(__file__.split('.')[0], logging_flag)
+        self.downloader = downloader.Downloader(
+                logging_flag, workers, codec=codec, max_attempts=max_attempts,
+                host_rate=host_rate, host_concurrency=host_concurrency,
+                obey_robots=obey_robots, near_duplicates=near_duplicates,
+                max_distance=max_distance)
+        self.collector = link_collector.LinkCollector(
+                logging_flag, filter_kind=filter_kind,
+                filter_error_rate=filter_error_rate,
+                filter_memory=filter_memory)
+        self.workers = workers
+        self.parsers = parsers
+        queue_size = queue_size or default_queue_factor * workers
+        self.fetch_queue = queue.Queue(queue_size)
+        self.parse_queue = queue.Queue(queue_size)
+        self.db_queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retry_wait = max_retry_wait
+        self.stopping = threading.Event()
+        # Only the database thread uses the following.
+        self.connection = None
+        self.in_flight = 0
+        self.last_fetch_id = -1
+        self.last_link_id = -1
+        self.last_resume_id = 0
+        self.start_time = time.time()
+        metrics.gauge('fetch_queue', self.fetch_queue.qsize)
+        metrics.gauge('parse_queue', self.parse_queue.qsize)
+        metrics.gauge('db_queue', self.db_queue.qsize)
+        metrics.gauge('in_flight', lambda: self.in_flight)
+
+    def stop(self, signal_number=None, frame=None):
+        '''Stop queueing new work; a second interrupt exits at once.'''
+        print('\n\nStopping: finishing pages in progress. '
+              'Interrupt again to quit at once.')
+        self.stopping.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    def fetch_stage(self):
+        '''Download and store pages, passing them on.'''
+        while True:
+            item = self.fetch_queue.get()
+            if item is None:
+                return
+            url, etag, last_modified = item
+            # Errors come back in the page, to be recorded as failures.
+            page = self.downloader.fetch(url, etag, last_modified)
+            sys.stdout.flush()
+            self.parse_queue.put((page, page.hash, 1))
+
+    def parse_stage(self):
+        '''Canonicalize the links found in pages as they were downloaded;
+        pages downloaded before, or not scanned then, are read from disk and
+        crawled for links.'''
+        while True:
+            item = self.parse_queue.get()
+            if item is None:
+                return
+            page, hash, is_for_content = item
+            url_list = []
+            if hash:
+                try:
+                    if page is not None and page.links is not None:
+                        url_list = [self.collector.clean_url(link)
+                                    for link in page.links]
+                        # Not needed any more; let them be freed early.
+                        page = page._replace(links=None)
+                    else:
+                        contents = self.collector.read_page(hash,
+                                                            is_for_content)
+                        url_list = self.collector.crawl_for_links(
+                                contents) or []
+                except Exception as e:
+                    logging.error(str(e) + ' with hash = ' + hash)
+            self.db_queue.put((page, hash, url_list))
+
+    def queue_work(self):
+        '''Top up the parse and fetch queues without blocking; return the
+        number of items queued.'''
+        queued = 0
+        # Pages downloaded before a restart but never crawled for links.
+        room = self.parse_queue.maxsize - self.parse_queue.qsize()
+        if room > 0 and self.last_link_id < self.last_resume_id:
+            rows = crawl_db.next_hashes_to_crawl_for_links(
+                    self.connection, self.last_link_id, room)
+            rows = [row for row in rows if row[0] <= self.last_resume_id]
+            if not rows:
+                self.last_link_id = self.last_resume_id
+            for row_id, hash, is_for_content in rows:
+                # fetch_stage() fills this queue too, so the room counted
+                # may be gone. Blocking here could deadlock, since this
+                # thread alone empties db_queue; the rest wait for the next
+                # call.
+                try:
+                    self.parse_queue.put_nowait((None, hash, is_for_content))
+                except queue.Full:
+                    break
+                self.last_link_id = row_id
+                queued += 1
+        room = self.fetch_queue.maxsize - self.fetch_queue.qsize()
+        # URLs that failed in this run and have fallen due; the cursor
+        # below has passed them. Only this thread fills the fetch queue, so
+        # the room counted stays.
+        retries = self.downloader.retries
+        now = time.time()
+        for url in [url for url, due in retries.items() if due <= now][:room]:
+            del retries[url]
+            self.fetch_queue.put_nowait((url, None, None))
+            queued += 1
+            room -= 1
+        if room > 0:
+            rows = crawl_db.next_urls_to_download(self.connection,
+                                                  self.last_fetch_id, room)
+            if rows:
+                self.last_fetch_id = rows[-1][0]
+            # Spread the fetch workers over the hosts.
+            for row_id, url in politeness.interleave(
+                    rows, key=lambda row: politeness.host_of(row[1])):
+                self.fetch_queue.put_nowait((url, None, None))
+            queued += len(rows)
+        self.in_flight += queued
+        return queued
+
+    def next_retry(self):
+        '''Return the seconds until the next failed URL falls due, if one
+        does within self.max_retry_wait, else None.'''
+        if not self.downloader.retries:
+            return None
+        wait = min(self.downloader.retries.values()) - time.time()
+        return wait if wait <= self.max_retry_wait else None
+
+    def count_written(self, kind, submitted, changed):
+        self.downloader.count_written(kind, submitted, changed)
+        self.collector.count_written(kind, submitted, changed)
+
+    def record(self, page, hash, url_list):
+        '''Write the outcome of one page to the database.
+
+        page is None for pages downloaded in an earlier run.
+        '''
+        self.in_flight -= 1
+        if page is not None:
+            # Stores the page, or schedules a failed one to be retried.
+            self.downloader.record_download(page.url, page)
+        if not hash:
+            return
+        self.collector.now = datetime.datetime.strftime(
+                datetime.datetime.now(), '%Y-%m-%d %H:%M:%S.%f')
+        self.collector.record_links(url_list, hash)
+
+    def database_stage(self):
+        '''Feed the pipeline from the database and record what comes back,
+        until there is no work left or we are stopping and have drained.'''
+        writer = self.downloader.writer
+        while True:
+            if not self.stopping.is_set():
+                self.queue_work()
+            if not self.in_flight:
+                # New links may still be waiting in the writer.
+                if writer.count_pending and not self.stopping.is_set():
+                    writer.flush()
+                    continue
+                wait = self.next_retry()
+                if wait is None or self.stopping.is_set():
+                    break
+                if wait > 0:
+                    print('\n\nWaiting {:.0f} seconds to retry failed URLs.'
+                          .format(wait))
+                    self.stopping.wait(wait)
+                continue
+            try:
+                item = self.db_queue.get(timeout=0.1)
+            except queue.Empty:
+                writer.maybe_flush()
+                continue
+            self.record(*item)
+        writer.flush()
+
+    def crawl(self):
+        print('''\nWe print . for a page successfully saved, ~ for a near '''
+              '''duplicate skipped and | for failure of any kind:''')
+        signal.signal(signal.SIGINT, self.stop)
+        threads = ([threading.Thread(target=self.fetch_stage)
+                    for i in range(self.workers)] +
+                   [threading.Thread(target=self.parse_stage)
+                    for i in range(self.parsers)])
+        for thread in threads:
+            # Daemon threads, so that a second interrupt need not wait on
+            # them.
+            thread.daemon = True
+            thread.start()
+        with crawl_db.connect(downloader.url_core) as self.connection:
+            # Downloader and LinkCollector share one writer, so that all
+            # writes go out in the same transactions.
+            writer = db_writer.BatchWriter(self.connection, self.batch_size,
+                                           self.flush_interval,
+                                           self.count_written)
+            self.downloader.connection = self.connection
+            self.downloader.writer = self.collector.writer = writer
+            self.collector.warm_filter(self.connection)
+            self.downloader.load_fingerprints()
+            self.last_resume_id = crawl_db.max_id(self.connection)
+            print('\nPending: {} pages to download, {} to crawl for links.'
+                  .format(crawl_db.count_to_download(self.connection),
+                          crawl_db.count_to_crawl_for_links(self.connection)))
+            # The top-level page goes first, as in downloader.py.
+            self.downloader.count_prospective_pages += 1
+            self.fetch_queue.put((downloader.start_url,) +
+                                 tuple(crawl_db.start_page_validators(
+                                         self.connection)))
+            self.in_flight += 1
+            try:
+                self.database_stage()
+            except BaseException:
+                self.stopping.set()
+                raise
+            else:
+                for i in range(self.workers):
+                    self.fetch_queue.put(None)
+                for thread in threads[:self.workers]:
+                    thread.join()
+                for i in range(self.parsers):
+                    self.parse_queue.put(None)
+                for thread in threads[self.workers:]:
+                    thread.join()
+        self.connection.close()
+        self.downloader.http.close()
+        self.downloader.store.close()
+        self.collector.store.close()
+
+    def summarize_run(self):
+        self.collector.start_time = self.start_time
+        self.downloader.summarize_run()
+        self.collector.summarize_run()
+
+def main(logging_flag='', workers=downloader.default_workers,
+         parsers=default_parsers, queue_size=None,
+         batch_size=db_writer.default_batch_size,
+         flush_interval=db_writer.default_flush_interval,
+         codec=compression.default_codec,
+         max_attempts=downloader.default_max_attempts,
+         host_rate=politeness.default_rate,
+         host_concurrency=politeness.default_concurrency, obey_robots=True,
+         filter_kind=url_filter.default_kind,
+         filter_error_rate=url_filter.default_error_rate, filter_memory=None,
+         near_duplicates=neardup.default_mode,
+         max_distance=neardup.default_max_distance,
+         max_retry_wait=downloader.default_max_retry_wait):
+    crawler = Crawler(logging_flag, workers, parsers, queue_size, batch_size,
+                      flush_interval, codec, max_attempts, host_rate,
+                      host_concurrency, obey_robots, filter_kind,
+                      filter_error_rate, filter_memory, near_duplicates,
+                      max_distance, max_retry_wait)
+    crawler.crawl()
+    crawler.summarize_run()
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    utils.add_logging_flags(parser)
+    utils.add_site_flags(parser)
+    parser.add_argument('-w', '--workers', type=int,
+                        default=downloader.default_workers,
+                        help='number of pages to download concurrently '
+                             '(default {})'.format(downloader.default_workers))
+    parser.add_argument('--parsers', type=int, default=default_parsers,
+                        help='number of link-extraction threads '
+                             '(default {})'.format(default_parsers))
+    parser.add_argument('--queue-size', type=int,
+                        help='length of each queue between stages '
+                             '(default {} per worker)'.format(
+                                 default_queue_factor))
+    parser.add_argument('--batch-size', type=int,
+                        default=db_writer.default_batch_size,
+                        help='database writes per transaction '
+                             '(default {})'.format(db_writer.default_batch_size))
+    parser.add_argument('--flush-interval', type=float,
+                        default=db_writer.default_flush_interval,
+                        help='maximum seconds between commits '
+                             '(default {})'.format(
+                                 db_writer.default_flush_interval))
+    parser.add_argument('--codec', choices=sorted(compression.codecs),
+                        default=compression.default_codec,
+                        help='compression for stored pages (default {})'
+                             .format(compression.default_codec))
+    parser.add_argument('--max-attempts', type=int,
+                        default=downloader.default_max_attempts,
+                        help='failed attempts before a URL is given up on '
+                             '(default {})'.format(
+                                 downloader.default_max_attempts))
+    parser.add_argument('--max-retry-wait', type=float,
+                        default=downloader.default_max_retry_wait,
+                        help='longest wait, in seconds, to retry failed URLs '
+                             'within this run (default {})'.format(
+                                 downloader.default_max_retry_wait))
+    downloader.add_politeness_flags(parser)
+    url_filter.add_filter_flags(parser)
+    neardup.add_near_duplicate_flags(parser)
+    metrics.add_metrics_flags(parser)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    downloader.set_site(arguments.site, arguments.start_url)
+    link_collector.set_site(arguments.site, arguments.start_url)
+    with metrics.session('crawl', arguments):
+        main(arguments.logging_flag, arguments.workers, arguments.parsers,
+             arguments.queue_size, arguments.batch_size,
+             arguments.flush_interval, arguments.codec,
+             arguments.max_attempts, arguments.host_rate,
+             arguments.host_concurrency, arguments.obey_robots,
+             arguments.url_filter, arguments.filter_error_rate,
+             arguments.filter_memory, arguments.near_duplicates,
+             arguments.simhash_distance, arguments.max_retry_wait)
@@ -0,0 +1,368 @@
+# crawl_db.py
+'''Schema upgrades and work-queue queries for the crawl database.
+
+create_table.sqlscript creates the original urls table; connect() brings any
+database up to date by applying the migrations below that it has not yet
+had, keeping count in PRAGMA user_version.
+
+The pending-work queries are served by partial indexes, which hold only the
+rows still waiting for that kind of work, and are read a page at a time in
+id order rather than with one fetchall(). Row counts are kept up to date by
+triggers in the url_counts table, so summaries need not scan urls.
+
+Several downloaders may share the database (see coordinator.py): each
+claims batches of URLs under a lease, with its name as owner and a time of
+expiry, and the others leave leased URLs alone until the lease expires, so
+that the URLs of a worker that dies are taken up again by the rest.
+'''
+
+import zlib
+import sqlite3
+
+import utils
+import db_writer
+
+default_page_size = 1000
+
+# Each migration is a list of SQL statements, applied in one transaction.
+migrations = [
+    # 1: partial indexes for pending work; counts maintained by triggers.
+    ['''CREATE INDEX IF NOT EXISTS urls_to_download ON urls (id)
+        WHERE date_downloaded IS NULL''',
+     '''CREATE INDEX IF NOT EXISTS urls_to_crawl_for_links ON urls (id)
+        WHERE date_crawled_for_links IS NULL
+        AND date_downloaded IS NOT NULL''',
+     '''CREATE TABLE IF NOT EXISTS url_counts (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL)''',
+     '''INSERT OR REPLACE INTO url_counts (name, value)
+        SELECT 'urls', count(*) FROM urls''',
+     '''INSERT OR REPLACE INTO url_counts (name, value)
+        SELECT 'downloaded', count(*) FROM urls
+        WHERE date_downloaded IS NOT NULL''',
+     '''INSERT OR REPLACE INTO url_counts (name, value)
+        SELECT 'crawled_for_links', count(*) FROM urls
+        WHERE date_crawled_for_links IS NOT NULL''',
+     '''CREATE TRIGGER IF NOT EXISTS urls_counts_insert AFTER INSERT ON urls
+        BEGIN
+            UPDATE url_counts SET value = value + 1 WHERE name = 'urls';
+            UPDATE url_counts SET value = value + 1
+            WHERE name = 'downloaded' AND NEW.date_downloaded IS NOT NULL;
+            UPDATE url_counts SET value = value + 1
+            WHERE name = 'crawled_for_links'
+            AND NEW.date_crawled_for_links IS NOT NULL;
+        END''',
+     '''CREATE TRIGGER IF NOT EXISTS urls_counts_delete AFTER DELETE ON urls
+        BEGIN
+            UPDATE url_counts SET value = value - 1 WHERE name = 'urls';
+            UPDATE url_counts SET value = value - 1
+            WHERE name = 'downloaded' AND OLD.date_downloaded IS NOT NULL;
+            UPDATE url_counts SET value = value - 1
+            WHERE name = 'crawled_for_links'
+            AND OLD.date_crawled_for_links IS NOT NULL;
+        END''',
+     '''CREATE TRIGGER IF NOT EXISTS urls_counts_downloaded
+        AFTER UPDATE OF date_downloaded ON urls
+        BEGIN
+            UPDATE url_counts
+            SET value = value + (NEW.date_downloaded IS NOT NULL)
+                              - (OLD.date_downloaded IS NOT NULL)
+            WHERE name = 'downloaded';
+        END''',
+     '''CREATE TRIGGER IF NOT EXISTS urls_counts_crawled_for_links
+        AFTER UPDATE OF date_crawled_for_links ON urls
+        BEGIN
+            UPDATE url_counts
+            SET value = value + (NEW.date_crawled_for_links IS NOT NULL)
+                              - (OLD.date_crawled_for_links IS NOT NULL)
+            WHERE name = 'crawled_for_links';
+        END'''],
+    # 2: validators and schedule for conditional re-crawling. Pages already
+    # downloaded are due for their first check at once.
+    ['ALTER TABLE urls ADD COLUMN etag TEXT',
+     'ALTER TABLE urls ADD COLUMN last_modified TEXT',
+     'ALTER TABLE urls ADD COLUMN date_checked INTEGER',
+     'ALTER TABLE urls ADD COLUMN refresh_interval REAL',
+     'ALTER TABLE urls ADD COLUMN next_refresh INTEGER',
+     '''UPDATE urls SET refresh_interval = 86400,
+        next_refresh = date_downloaded
+        WHERE url IS NOT NULL AND date_downloaded IS NOT NULL''',
+     '''CREATE INDEX IF NOT EXISTS urls_next_refresh ON urls (next_refresh)
+        WHERE next_refresh IS NOT NULL'''],
+    # 3: failure accounting for retries. URLs that fail too often are given
+    # up on (dead_letter = 1) and leave the download queue.
+    ['ALTER TABLE urls ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0',
+     'ALTER TABLE urls ADD COLUMN last_error TEXT',
+     'ALTER TABLE urls ADD COLUMN next_attempt INTEGER',
+     'ALTER TABLE urls ADD COLUMN dead_letter INTEGER',
+     'DROP INDEX IF EXISTS urls_to_download',
+     '''CREATE INDEX urls_to_download ON urls (id)
+        WHERE date_downloaded IS NULL AND dead_letter IS NULL''',
+     '''INSERT OR REPLACE INTO url_counts (name, value)
+        VALUES ('dead_letter', 0)''',
+     '''CREATE TRIGGER IF NOT EXISTS urls_counts_dead_letter
+        AFTER UPDATE OF dead_letter ON urls
+        BEGIN
+            UPDATE url_counts
+            SET value = value + (NEW.dead_letter IS NOT NULL)
+                              - (OLD.dead_letter IS NOT NULL)
+            WHERE name = 'dead_letter';
+        END''',
+     '''CREATE TRIGGER IF NOT EXISTS urls_counts_dead_letter_delete
+        AFTER DELETE ON urls WHEN OLD.dead_letter IS NOT NULL
+        BEGIN
+            UPDATE url_counts SET value = value - 1
+            WHERE name = 'dead_letter';
+        END'''],
+    # 4: pages still to have their sentences extracted (see
+    # sentence_extractor.py).
+    ['ALTER TABLE urls ADD COLUMN date_extracted INTEGER',
+     '''CREATE INDEX IF NOT EXISTS urls_to_extract ON urls (id)
+        WHERE date_extracted IS NULL AND date_downloaded IS NOT NULL
+        AND to_be_crawled_for_content = 1'''],
+    # 5: SimHash fingerprints of content pages (see neardup.py).
+    ['''CREATE TABLE IF NOT EXISTS page_fingerprints (
+        hash TEXT PRIMARY KEY,
+        simhash INTEGER NOT NULL) WITHOUT ROWID'''],
+    # 6: leases on URLs claimed for download by one of several workers.
+    ['ALTER TABLE urls ADD COLUMN lease_owner TEXT',
+     'ALTER TABLE urls ADD COLUMN lease_expires INTEGER',
+     '''CREATE INDEX IF NOT EXISTS urls_leased ON urls (lease_owner)
+        WHERE lease_owner IS NOT NULL'''],
+]
+
+def db_name(url_core):
+    return 'crawl_' + url_core + '.db'
+
+def connect(url_core, migrate_schema=True):
+    '''Open the crawl database for url_core, tuned and migrated.'''
+    connection = sqlite3.connect(db_name(url_core))
+    db_writer.tune_connection(connection)
+    if migrate_schema:
+        migrate(connection)
+    return connection
+
+def migrate(connection):
+    '''Apply any migrations the database has not had yet.
+
+    The write lock is taken first, so that two processes starting together
+    do not both apply the same migration.
+    '''
+    connection.commit()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(migrations[version:],
+                                            version + 1):
+            for statement in statements:
+                connection.execute(statement)
+            connection.execute('PRAGMA user_version = {:d}'.format(number))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+
+# URLs not yet downloaded, neither given up on, waiting to be retried nor
+# leased to a worker at the time given as the first two parameters.
+urls_ready_condition = '''date_downloaded IS NULL AND dead_letter IS NULL
+        AND (next_attempt IS NULL OR next_attempt <= ?)
+        AND (lease_expires IS NULL OR lease_expires <= ?)'''
+urls_to_download_sql = '''SELECT id, url FROM urls
+        WHERE ''' + urls_ready_condition + ''' AND id > ?
+        ORDER BY id LIMIT ?'''
+hashes_to_crawl_for_links_sql = '''SELECT id, hash,
+        to_be_crawled_for_content FROM urls
+        WHERE date_crawled_for_links IS NULL
+        AND date_downloaded IS NOT NULL AND id > ?
+        ORDER BY id LIMIT ?'''
+hashes_to_extract_sql = '''SELECT id, hash FROM urls
+        WHERE date_extracted IS NULL AND date_downloaded IS NOT NULL
+        AND to_be_crawled_for_content = 1 AND id > ?
+        ORDER BY id LIMIT ?'''
+
+urls_to_refresh_sql = '''SELECT id, url, etag, last_modified, hash,
+        refresh_interval FROM urls
+        WHERE next_refresh <= ? AND url IS NOT NULL AND id > ?
+        ORDER BY id LIMIT ?'''
+
+def read_pages(connection, sql, page_size, parameters=()):
+    '''Yield rows of sql a page at a time, in order of id.
+
+    sql must select id first and take parameters (*parameters, last_id,
+    page_size); the id is not included in the rows yielded.
+    '''
+    last_id = -1
+    while True:
+        rows = connection.execute(sql, parameters +
+                                  (last_id, page_size)).fetchall()
+        for row in rows:
+            yield row[1:]
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+def urls_to_download(connection, page_size=default_page_size):
+    '''Yield the URLs not yet downloaded that may be tried now.'''
+    now = utils.timestamp()
+    for row in read_pages(connection, urls_to_download_sql, page_size,
+                          (now, now)):
+        yield row[0]
+
+def hashes_to_crawl_for_links(connection, page_size=default_page_size):
+    '''Yield (hash, to_be_crawled_for_content) for downloaded pages not yet
+    crawled for links.'''
+    yield from read_pages(connection, hashes_to_crawl_for_links_sql,
+                          page_size)
+
+def hashes_to_extract(connection, page_size=default_page_size):
+    '''Yield the hashes of downloaded content pages whose sentences have not
+    been extracted.'''
+    for row in read_pages(connection, hashes_to_extract_sql, page_size):
+        yield row[0]
+
+def count_to_extract(connection):
+    return connection.execute('''SELECT count(*) FROM urls
+            WHERE date_extracted IS NULL AND date_downloaded IS NOT NULL
+            AND to_be_crawled_for_content = 1''').fetchone()[0]
+
+def urls_to_refresh(connection, now, page_size=default_page_size):
+    '''Yield (url, etag, last_modified, hash, refresh_interval) for the
+    downloaded pages due to be checked for changes at time now.'''
+    yield from read_pages(connection, urls_to_refresh_sql, page_size, (now,))
+
+def count_to_refresh(connection, now):
+    return connection.execute('''SELECT count(*) FROM urls
+            WHERE next_refresh <= ? AND url IS NOT NULL''',
+            (now,)).fetchone()[0]
+
+def start_page_validators(connection):
+    '''Return (etag, last_modified) of the latest copy of the start page.'''
+    row = connection.execute('''SELECT etag, last_modified FROM urls
+            WHERE url IS NULL AND to_be_crawled_for_content = 0
+            ORDER BY id DESC LIMIT 1''').fetchone()
+    return row if row else (None, None)
+
+def next_urls_to_download(connection, after_id, limit=default_page_size):
+    '''Return up to limit (id, url) pairs not yet downloaded that may be
+    tried now, with ids above after_id.
+
+    For callers that keep their own place in the queue; pass the last id
+    returned as after_id next time.
+    '''
+    now = utils.timestamp()
+    return connection.execute(urls_to_download_sql,
+                              (now, now, after_id, limit)).fetchall()
+
+def next_hashes_to_crawl_for_links(connection, after_id,
+                                   limit=default_page_size):
+    '''Return up to limit (id, hash, to_be_crawled_for_content) rows for
+    pages not yet crawled for links, with ids above after_id.'''
+    return connection.execute(hashes_to_crawl_for_links_sql,
+                              (after_id, limit)).fetchall()
+
+def max_id(connection):
+    return connection.execute('SELECT max(id) FROM urls').fetchone()[0] or 0
+
+def count(connection, name):
+    '''Return one of the counts kept in url_counts.'''
+    row = connection.execute('SELECT value FROM url_counts WHERE name = ?',
+                             (name,)).fetchone()
+    return row[0] if row else 0
+
+def count_to_download(connection):
+    '''Return the number of URLs not yet downloaded or given up on,
+    including those waiting to be retried.'''
+    return (count(connection, 'urls') - count(connection, 'downloaded') -
+            count(connection, 'dead_letter'))
+
+def attempts(connection, url):
+    '''Return the number of failed attempts so far to download url.'''
+    row = connection.execute('SELECT attempts FROM urls WHERE url = ?',
+                             (url,)).fetchone()
+    return row[0] if row else 0
+
+def count_to_crawl_for_links(connection):
+    return (count(connection, 'downloaded') -
+            count(connection, 'crawled_for_links'))
+
+def url_shard(url, shards):
+    '''Return the shard, of shards, that url belongs to.'''
+    return zlib.crc32(url.encode('utf-8')) % shards
+
+def ready_condition(connection, shard=None):
+    '''Return the condition on urls, with its parameters, for the URLs that
+    may be claimed for download now; if shard is given, as (k, n), only
+    those in shard k of n (see url_shard()).'''
+    now = utils.timestamp()
+    if not shard:
+        return urls_ready_condition, (now, now)
+    connection.create_function('url_shard', 2, url_shard, deterministic=True)
+    return (urls_ready_condition + ' AND url_shard(url, ?) = ?',
+            (now, now, shard[1], shard[0]))
+
+def claim_urls(connection, owner, limit, lease_seconds, shard=None):
+    '''Lease to owner for lease_seconds up to limit URLs that may be
+    downloaded now, in shard if given (see ready_condition()), and return
+    them.
+
+    The write lock is taken first, so that no two workers claim the same
+    URL. Pending writes on connection must have been committed.
+    '''
+    condition, parameters = ready_condition(connection, shard)
+    connection.commit()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        rows = connection.execute('SELECT id, url FROM urls WHERE ' +
+                                  condition + ' ORDER BY id LIMIT ?',
+                                  parameters + (limit,)).fetchall()
+        connection.executemany('''UPDATE urls
+                SET lease_owner=?, lease_expires=? WHERE id=?''',
+                [(owner, utils.timestamp(lease_seconds), row_id)
+                 for row_id, url in rows])
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return [url for row_id, url in rows]
+
+def renew_leases(connection, owner, lease_seconds):
+    '''Extend the leases owner still holds to lease_seconds from now; return
+    how many. Leases that expired and were claimed by another are not
+    taken back.'''
+    cursor = connection.execute('''UPDATE urls SET lease_expires=?
+            WHERE lease_owner=?''', (utils.timestamp(lease_seconds), owner))
+    connection.commit()
+    return cursor.rowcount
+
+def release_leases(connection, owner):
+    '''Give up the leases owner still holds; return how many.'''
+    cursor = connection.execute('''UPDATE urls
+            SET lease_owner=NULL, lease_expires=NULL
+            WHERE lease_owner=?''', (owner,))
+    connection.commit()
+    return cursor.rowcount
+
+def reclaim_expired_leases(connection):
+    '''Clear the leases that have expired, as those of a worker that died
+    do; return how many.'''
+    cursor = connection.execute('''UPDATE urls
+            SET lease_owner=NULL, lease_expires=NULL
+            WHERE lease_owner IS NOT NULL AND lease_expires <= ?''',
+            (utils.timestamp(),))
+    connection.commit()
+    return cursor.rowcount
+
+def leases(connection):
+    '''Return (owner, URLs leased, earliest expiry) for every owner of
+    leases.'''
+    return connection.execute('''SELECT lease_owner, count(*),
+            min(lease_expires) FROM urls
+            WHERE lease_owner IS NOT NULL
+            GROUP BY lease_owner ORDER BY lease_owner''').fetchall()
+
+def count_ready_to_download(connection, shard=None):
+    '''Return the number of URLs that may be claimed for download now, in
+    shard if given.'''
+    condition, parameters = ready_condition(connection, shard)
+    return connection.execute('SELECT count(*) FROM urls WHERE ' + condition,
+                              parameters).fetchone()[0]
@@ -0,0 +1,123 @@
+# db_writer.py
+'''Batched writes to the crawl database.
+
+Committing after every row makes SQLite sync the disk once per URL. Instead,
+writes are queued here and applied with executemany() in a single
+transaction once batch_size rows are waiting or flush_interval seconds have
+passed since the last commit.
+
+Each write carries a kind (e.g. 'link'); for every kind we count the rows
+submitted and the rows the database actually changed, so that callers using
+INSERT OR IGNORE learn exactly how many rows were new without handling one
+IntegrityError per duplicate.
+'''
+
+import sqlite3
+import time
+import logging
+import collections
+
+import metrics
+
+default_batch_size = 500
+default_flush_interval = 5.0
+
+def tune_connection(connection):
+    '''Set the pragmas we want on every connection to the crawl database.
+
+    WAL lets readers work while the writer commits; with WAL, synchronous
+    NORMAL is still safe against corruption and syncs far less often.
+    '''
+    connection.execute('PRAGMA journal_mode=WAL;')
+    connection.execute('PRAGMA synchronous=NORMAL;')
+    connection.execute('PRAGMA temp_store=MEMORY;')
+    connection.execute('PRAGMA cache_size=-20000;')
+    connection.execute('PRAGMA busy_timeout=30000;')
+    return connection
+
+class BatchWriter(object):
+    '''Queue SQL writes and apply them in batches.
+
+    Writes are applied in the order they were added; consecutive writes
+    with the same statement go to the database in a single executemany().
+
+    on_flush, if given, is called after each commit as
+    on_flush(kind, submitted, changed) for every kind written.
+    '''
+    def __init__(self, connection, batch_size=default_batch_size,
+                 flush_interval=default_flush_interval, on_flush=None):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        # List of [kind, sql, rows]
+        self.pending = []
+        self.count_pending = 0
+        self.last_flush = time.time()
+        # Totals over the life of the writer, by kind.
+        self.submitted = collections.Counter()
+        self.changed = collections.Counter()
+
+    def add(self, kind, sql, parameters):
+        '''Queue one write; flush if a threshold has been reached.'''
+        if self.pending and self.pending[-1][1] == sql:
+            self.pending[-1][2].append(parameters)
+        else:
+            self.pending.append([kind, sql, [parameters]])
+        self.count_pending += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if (self.count_pending >= self.batch_size or
+                time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''Apply all queued writes in one transaction.'''
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+        batch, self.pending, self.count_pending = self.pending, [], 0
+        with metrics.timer('db_write'):
+            try:
+                results = self.write_batch(batch)
+            except sqlite3.Error as e:
+                # Something in the batch is unacceptable; fall back to
+                # writing row by row so that only the offending rows are
+                # lost.
+                logging.error(str(e) + ' in batch write; retrying row by row')
+                self.connection.rollback()
+                results = self.write_rows(batch)
+        metrics.count('db_rows', sum(len(rows) for kind, sql, rows in batch))
+        for kind, submitted, changed in results:
+            self.submitted[kind] += submitted
+            self.changed[kind] += changed
+            if self.on_flush:
+                self.on_flush(kind, submitted, changed)
+
+    def write_batch(self, batch):
+        cursor = self.connection.cursor()
+        results = []
+        for kind, sql, rows in batch:
+            cursor.executemany(sql, rows)
+            results.append((kind, len(rows), max(cursor.rowcount, 0)))
+        self.connection.commit()
+        cursor.close()
+        return results
+
+    def write_rows(self, batch):
+        cursor = self.connection.cursor()
+        results = []
+        for kind, sql, rows in batch:
+            changed = 0
+            for parameters in rows:
+                try:
+                    cursor.execute(sql, parameters)
+                    changed += max(cursor.rowcount, 0)
+                except sqlite3.Error as e:
+                    logging.error(str(e) + ' with parameters = ' +
+                                  str(parameters))
+            results.append((kind, len(rows), changed))
+        self.connection.commit()
+        cursor.close()
+        return results
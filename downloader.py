@@ -10,36 +10,153 @@ scraping Chinese sentences from.
 
 import os
 import sys
+import sqlite3
+import socket
+import signal
 import urllib.request
-import bs4
 import time
+import random
 import datetime
-import sqlite3
-import hashlib
-import bz2
 import logging
+import threading
+import argparse
+import concurrent.futures
+import collections
 
 import utils
+import http_pool
+import db_writer
+import crawl_db
+import pack_store
+import politeness
+import ingest
+import canonical
+import link_collector
+import url_filter
+import neardup
+import metrics
+import compression as compression_codecs
+
+url_core = utils.default_site
+start_url = utils.site_start_url(url_core)
+# Number of pages fetched at once; 1 means the old serial behaviour.
+default_workers = 8
+# Seconds between checks of a downloaded page for changes. The interval of
+# each page is halved when it has changed and doubled when it has not,
+# within these bounds.
+default_refresh_interval = 24 * 3600
+min_refresh_interval = 3600
+max_refresh_interval = 30 * 24 * 3600
+# A URL that fails is tried again after retry_base_delay seconds, doubling
+# with each further failure up to retry_max_delay, give or take half; after
+# default_max_attempts failures it is given up on (dead-lettered).
+retry_base_delay = 10
+retry_max_delay = 24 * 3600
+default_max_attempts = 5
+# Longest wait, in seconds, for failed URLs to fall due within one run;
+# those due later are left to a later run.
+default_max_retry_wait = 60
+# With leases (see download_leased()), a worker claims this many URLs per
+# download worker at a time, and gives up after idle_wait seconds in which
+# there were none to claim. The leases held are renewed this many times
+# in each lease period, so a batch held up by a slow host keeps them.
+default_lease = 300
+claim_factor = 4
+lease_renewals = 3
+default_idle_wait = 60
+idle_poll_interval = 5
+
+# The outcome of fetching one page. status is None if the request failed;
+# hash is None unless the page was stored, and error then says why, unless
+# the page was skipped as a near duplicate of the page with hash
+# duplicate_of. links are the hrefs of the links to follow found in the
+# page as it was read, or None if it has yet to be crawled for them.
+# fingerprint is the SimHash of a content page.
+Fetched = collections.namedtuple('Fetched', 'url status hash etag '
+                                 'last_modified links error fingerprint '
+                                 'duplicate_of',
+                                 defaults=(None, None, None))
+
+def set_site(site, url=None):
+    '''Crawl another site: site names its database and pack file, and url
+    (by default http://<site>.com) is its top-level page.'''
+    global url_core, start_url
+    url_core = site
+    start_url = url or utils.site_start_url(site)
+
+def next_refresh_interval(interval, changed):
+    '''Adapt a page's refresh interval to whether it changed.'''
+    interval = interval or default_refresh_interval
+    if changed:
+        return max(interval / 2, min_refresh_interval)
+    return min(interval * 2, max_refresh_interval)
 
-url_core = 'worldjournal'
+def retry_delay(attempts):
+    '''Return seconds to wait before trying again a URL that has failed
+    attempts times: exponential backoff, with jitter so that URLs failing
+    together are not all retried together.'''
+    delay = min(retry_base_delay * 2 ** (attempts - 1), retry_max_delay)
+    return delay * random.uniform(0.5, 1.5)
 
 class Downloader(object):
-    def __init__(self, logging_flag):
+    def __init__(self, logging_flag, workers=1, pool_size=None,
+                 timeout=http_pool.default_timeout, compression=True,
+                 codec=compression_codecs.default_codec,
+                 max_attempts=default_max_attempts,
+                 host_rate=politeness.default_rate,
+                 host_concurrency=politeness.default_concurrency,
+                 obey_robots=True, near_duplicates=neardup.default_mode,
+                 max_distance=neardup.default_max_distance, host_share=None):
         app_name = __file__.split('.')[0]
         utils.set_up_logger(app_name, logging_flag)
         # Misc. class attributes
-        self.soup = None
-        self.hashed_soup = None
-        self.compressed_soup = None
         self.cursor = None
+        self.writer = None
+        self.workers = workers
+        # Guards counters and timers, which worker threads update.
+        self.lock = threading.Lock()
+        # Keep-alive connections, by default one for each worker.
+        self.http = http_pool.HTTPClient(pool_size or max(workers, 1),
+                                         timeout, compression)
+        self.store = pack_store.PackStore('CRAWLED_PAGES', url_core)
+        # Per-host rate limits and robots.txt; with host_share (K, N), this
+        # process's share of them.
+        self.scheduler = politeness.HostScheduler(
+                host_rate, host_concurrency,
+                politeness.RobotsCache(self.http) if obey_robots else None,
+                share=host_share)
+        # Codec for storing pages.
+        self.codec = compression_codecs.codecs[codec]
+        self.max_attempts = max_attempts
+        # Fingerprints of the pages stored, for finding near duplicates;
+        # filled by load_fingerprints().
+        self.near_duplicates = near_duplicates
+        self.fingerprints = neardup.NearDuplicateIndex(max_distance)
+        # A LinkCollector sharing self.writer, if the links found in pages
+        # as they are read are to be recorded here (see collect_links()).
+        self.collector = None
+        # URL -> time (as from time.time()) it may be tried again, for URLs
+        # that failed in this run and were not given up on.
+        self.retries = {}
+        # Set to stop claiming work; see download_leased().
+        self.stopping = threading.Event()
         # Counters
         self.urlerrors = 0
         self.count_prospective_pages = 0
         self.count_saved = 0
         self.count_discarded_pages = 0
+        self.count_not_modified = 0
+        self.count_changed = 0
+        self.count_unchanged = 0
+        self.count_failed = 0
+        self.count_dead_letter = 0
+        self.count_near_duplicates = 0
+        self.count_exact_duplicates = 0
         # Timers
         self.start_time = time.time()
         self.request_time = 0
+        self.connect_time = 0
+        self.transfer_time = 0
         self.disk_save_time = 0
 
     def summarize_run(self):
@@ -52,6 +169,12 @@ class Downloader(object):
         print(indent + 'Time spent on HTTP requests: {0} or {1:.2f}%.'.
                 format(str(datetime.timedelta(seconds=self.request_time)),
                        100 * self.request_time/elapsed))
+        print(indent * 2 + 'Connecting: {0}; transferring: {1}.'.
+                format(str(datetime.timedelta(seconds=self.connect_time)),
+                       str(datetime.timedelta(seconds=self.transfer_time))))
+        print(indent + 'Time spent waiting on per-host limits: {}.'.
+                format(str(datetime.timedelta(
+                        seconds=self.scheduler.wait_time))))
         print(indent + 'Time spent saving to disk: {0} or {1:.2f}%.'.
                 format(str(datetime.timedelta(seconds=self.disk_save_time)),
                        100 * self.disk_save_time/elapsed))
@@ -60,202 +183,754 @@ class Downloader(object):
                 format(self.count_saved, self.count_prospective_pages, 
                        utils.percentage(self.count_saved,
                                         self.count_prospective_pages)))
+        if self.count_near_duplicates:
+            print(indent + '{0} near-duplicate pages {1}.'.format(
+                    self.count_near_duplicates,
+                    'skipped' if self.near_duplicates == 'skip' else
+                    'flagged as not useful'))
+        if self.count_exact_duplicates:
+            print(indent + '{} pages the same as one stored under another '
+                    'URL, marked as duplicates.'.format(
+                        self.count_exact_duplicates))
+        if self.count_not_modified or self.count_changed or \
+                self.count_unchanged:
+            print(indent + '{} pages not modified (HTTP 304).'.
+                    format(self.count_not_modified))
+            print(indent + '{0} refreshed pages changed, {1} unchanged.'.
+                    format(self.count_changed, self.count_unchanged))
         print('Errors')
         print(indent + '{} pages discarded.'.format(self.count_discarded_pages))
-        print(indent + '{} URLErrors.'.  format(self.urlerrors), end='')
-        if self.urlerrors:
-            print(indent + '''Consider running again until there are no '''
-                    '''more URLErrors''')
-        else:
-            print('\n')
-        with sqlite3.connect('crawl_' + url_core +
-                '.db') as connection:
-            cursor = connection.cursor()
-            cursor = cursor.execute('''SELECT * FROM urls;''')
-            print('{} unique records in database'.
-                    format(len(cursor.fetchall())))
-            cursor.close()
+        print(indent + '{} URLErrors.'.  format(self.urlerrors))
+        if self.scheduler.count_disallowed:
+            print(indent + '{} URLs disallowed by robots.txt.'.
+                    format(self.scheduler.count_disallowed))
+        print(indent + '{0} failed downloads; {1} URLs given up on after {2} '
+                'attempts.'.format(self.count_failed, self.count_dead_letter,
+                                   self.max_attempts))
+        if self.retries:
+            print(indent + '{} URLs are to be retried on a later run.'.
+                    format(len(self.retries)))
+        print()
+        connection = crawl_db.connect(url_core)
+        print('{} URLs given up on in all.'.
+                format(crawl_db.count(connection, 'dead_letter')))
+        print('{} unique records in database'.
+                format(crawl_db.count(connection, 'urls')))
+        connection.close()
 
-    def get_urls(self):
-        '''Return a list of candidate URLs from the database.
+    def load_fingerprints(self):
+        '''Read the fingerprints of the pages stored so far.
 
         Assumes open SQLite3 connection.
         '''
-        try:
-            self.cursor = self.cursor.execute('''SELECT url FROM urls WHERE '''
-                                              '''date_downloaded IS NULL;''')
-        except Exception as e:
-            logging.error(e)
-        db_content = self.cursor.fetchall()
-        return [i[0] for i in db_content]
+        if self.near_duplicates != 'off':
+            self.fingerprints.load(self.connection)
 
-    def request_page(self, url):
-        '''Issue HTTP request for url argument'''
-        request_time_start = time.time()
-        try:
-            retrieved_contents = (urllib.request.urlopen(url).  read().strip())
-        except urllib.request.URLError as e:
-            logging.error(str(e) + ' with URL = ' + url)
-            self.urlerrors += 1
-            print('|', end='')
-            return ''
-        self.request_time += time.time() - request_time_start
-        return retrieved_contents
+    def check_near_duplicate(self, hash, blocks):
+        '''Fingerprint a content page from its content blocks; return
+        (fingerprint, hash of a page already stored that it nearly
+        duplicates, or None).
+
+        The page is added to the index unless it is a near duplicate.
+        '''
+        fingerprint = neardup.fingerprint_blocks(blocks)
+        if fingerprint is None:
+            return None, None
+        duplicate_of = self.fingerprints.check_and_add(fingerprint, hash)
+        if duplicate_of:
+            logging.info('{0} is a near duplicate of {1}'.format(
+                    hash, duplicate_of))
+            self.tally('count_near_duplicates')
+            metrics.count('near_duplicates')
+        return fingerprint, duplicate_of
 
-    def process_page(self, url, retrieved_contents):
-        '''Decode page contents with Beautiful Soup,
-        generating soup, its hash, and compressed form for saving to disk.
+    def get_urls(self):
+        '''Yield candidate URLs from the database, reading them a page at a
+        time. URLs waiting to be retried, or given up on, are left out.
 
-        In;  URL.
+        URLs are interleaved by host, so that concurrent downloads spread
+        over the hosts rather than queueing on one.
 
-        Out: soup, hashed_soup, compressed_soup
+        Assumes open SQLite3 connection.
         '''
-        if retrieved_contents:
-            self.soup = bs4.BeautifulSoup(retrieved_contents)
-        else:
-            logging.error('retrieved_contents is empty, with URL = ' + url)
-        # Periodically soup.encode() raises recursion errors, hence the use of
-        # try block.
-        try:
-            encoded = self.soup.encode()
-        except Exception as e:
-            self.hashed_soup = None
-            self.compressed_soup = None
-            logging.error(e)
-            self.count_discarded_pages += 1
-            print('|', end='')
-        else:
-            self.hashed_soup = hashlib.md5(encoded).hexdigest()
-            self.compressed_soup = bz2.compress(encoded)
+        return politeness.interleave(
+                crawl_db.urls_to_download(self.connection))
 
-    def store_page(self, url):
-        '''Save webpage to disk and the name of file to database.
+    def tally(self, counter, amount=1):
+        '''Add amount to the named counter or timer; safe across threads.'''
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
 
-        In:  URL. Assumes open SQLite3 connection.
+    def request_page(self, url, etag=None, last_modified=None):
+        '''Issue HTTP request for url argument, over a pooled connection.
 
-        Out: Page associated with URL is saved to disk under name derived from
-             page's md5 hash.
+        If etag or last_modified is given, the request is conditional and
+        the response may be 304 Not Modified. Waits for the host's rate
+        limit first. The body of a successful response is taken in by a
+        PageIngest as it is read, and is response.sink. Return the
+        response; raise URLError on failure.
+        '''
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        with self.scheduler.slot(url), metrics.timer('fetch'):
+            request_time_start = time.time()
+            response = self.http.get(url, headers, self.new_ingest)
+        self.tally('request_time', time.time() - request_time_start)
+        self.tally('connect_time', response.connect_time)
+        self.tally('transfer_time', response.transfer_time)
+        return response
 
-             Hash itself is saved to database.
+    def new_ingest(self, headers):
+        '''Return a PageIngest for the body of a response with the given
+        headers, which it is streamed into as it is read.'''
+        return ingest.PageIngest(self.codec, headers.get_content_charset())
+
+    def store_page(self, url, hash, compressed_page):
+        '''Save webpage to disk.
+
+        In:  URL, hash and compressed form of the page.
+
+        Out: Page associated with URL is appended to the pack store under the
+             page's md5 hash. Return True if the page was saved (or had been
+             already).
 
         '''
-        if self.compressed_soup:
+        if compressed_page:
             start_time = time.time()
-            # We save file first and update database afterwards in update_db(),
-            #    to reduce chance of false positives in database.
-            if url == 'http://' + url_core + '.com':
-                filename = url_core + '_base_page_' + self.hashed_soup + '.bz2'
-            else:
-                filename = url_core + '_' + self.hashed_soup + '.bz2'
-            with open(os.path.join('CRAWLED_PAGES', filename), 'wb') as f:
-                try:
-                    f.write(self.compressed_soup)
-                    self.count_saved += 1
-                    print('.', end='')
-                except Exception as e:
-                    logging.error(e)
-                    self.count_discarded_pages += 1
-                    print('|', end='')
-                    return
-                finally:
-                    self.disk_save_time += time.time() - start_time
+            # We save page first and update database afterwards in
+            #    update_db(), to reduce chance of false positives in database.
+            try:
+                with metrics.timer('store'):
+                    self.store.put(hash, compressed_page, self.codec.number)
+                self.tally('count_saved')
+                metrics.count('pages_saved')
+                metrics.progress('.')
+            except Exception as e:
+                logging.error(str(e) + ' with URL = ' + url)
+                self.tally('count_discarded_pages')
+                metrics.progress('|')
+                return False
+            finally:
+                self.tally('disk_save_time', time.time() - start_time)
+            return True
         else:
-            logging.error('self.compressed_soup is empty, with URL = ' + url)
-            return
+            logging.error('compressed page is empty, with URL = ' + url)
+            return False
 
-    def update_db(self, url):
+    def update_db(self, page):
         '''Update the database record for a given URL with the hash of the
-        content and the date/time of the download.
+        content, its validators and the date/time of the download.
 
-        Assumes open SQLite3 connection.
+        In:  a Fetched page.
+
+        Writes go through self.writer, which commits in batches. Only the
+        thread that opened the connection may call this.
         '''
-        now = datetime.datetime.strftime(datetime.datetime.now(),
-                                         '%Y-%m-%d %H:%M:%S.%f')
+        now = utils.timestamp()
         # Normally the start page of a site will not be crawled for content,
         # only for links. The variable want_content notes this state in the db.
-        if url == 'http://' + url_core + '.com':
+        if page.url == start_url:
             # We will not store URL in database, allowing multiple entries. But
             # we will indicate that we will never ask for content from this
             # page; it is solely a source of URLs.
             want_content = 0
-            try:
-                self.cursor = self.cursor.execute('''
-                        INSERT INTO urls (hash, date_url_added, 
-                        date_downloaded, to_be_crawled_for_content)
-                        VALUES (?, ?, ?, ?)''', 
-                        (self.hashed_soup, now, now, want_content))
-            except Exception as e:
-                logging.error(str(e) + ' with URL = ' + url)
+            # An unchanged start page has a known hash and is ignored.
+            self.writer.add('base_page', '''
+                    INSERT OR IGNORE INTO urls (hash, date_url_added,
+                    date_downloaded, to_be_crawled_for_content, etag,
+                    last_modified, date_checked)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (page.hash, now, now, want_content, page.etag,
+                     page.last_modified, now))
         else:
             want_content = 1
-            try:
-                self.cursor = self.cursor.execute('''
-                        UPDATE urls
-                        SET hash=?, date_downloaded=?,
-                        to_be_crawled_for_content=?
+            if page.fingerprint and not page.duplicate_of:
+                neardup.record_fingerprint(self.writer, page.hash,
+                                           page.fingerprint)
+            self.writer.add('page', '''
+                    UPDATE OR IGNORE urls
+                    SET hash=?, date_downloaded=?,
+                    to_be_crawled_for_content=?, etag=?, last_modified=?,
+                    date_checked=?, refresh_interval=?, next_refresh=?,
+                    lease_owner=NULL, lease_expires=NULL
+                    WHERE url=?''',
+                    (page.hash, now, want_content, page.etag,
+                     page.last_modified, now, default_refresh_interval,
+                     utils.timestamp(default_refresh_interval), page.url))
+            # The same content already stored under another URL cannot take
+            # its hash, which is unique, so the update above is ignored; the
+            # URL is then done with as an exact duplicate, with nothing to
+            # crawl or extract. Counted in count_written().
+            self.writer.add('exact_duplicate', '''
+                    UPDATE urls
+                    SET date_downloaded=?, date_crawled_for_links=?,
+                    date_extracted=?, content_useful=0, etag=?,
+                    last_modified=?, date_checked=?,
+                    lease_owner=NULL, lease_expires=NULL
+                    WHERE url=? AND date_downloaded IS NULL''',
+                    (now, now, now, page.etag, page.last_modified, now,
+                     page.url))
+            if page.duplicate_of:
+                # No sentences are to be taken from it.
+                self.writer.add('near_duplicate', '''
+                        UPDATE urls SET content_useful=0, date_extracted=?
                         WHERE url=?''',
-                        (self.hashed_soup, now, want_content, url))
-                self.count_prospective_pages += 1
-                self.connection.commit()
-            except Exception as e:
-                logging.error(str(e) + ' with URL = ' + url)
+                        (now, page.url))
+            self.count_prospective_pages += 1
+
+    def count_written(self, kind, submitted, changed):
+        '''Tally the outcome of a batch of database writes, and pass it on to
+        self.collector, which shares the writer.'''
+        if kind == 'exact_duplicate' and changed:
+            self.count_exact_duplicates += changed
+            metrics.count('exact_duplicates', changed)
+            logging.info('{} pages the same as one stored under another URL'
+                         .format(changed))
+        if self.collector:
+            self.collector.count_written(kind, submitted, changed)
+
+    def record_skipped(self, page):
+        '''Record a page skipped as a near duplicate: done with, but neither
+        stored nor to be crawled.'''
+        now = utils.timestamp()
+        self.writer.add('skipped', '''
+                UPDATE urls
+                SET date_downloaded=?, date_crawled_for_links=?,
+                date_extracted=?, content_useful=0, etag=?, last_modified=?,
+                date_checked=?, lease_owner=NULL, lease_expires=NULL
+                WHERE url=?''',
+                (now, now, now, page.etag, page.last_modified, now, page.url))
+        self.count_prospective_pages += 1
+
+    def update_refreshed(self, row, page):
+        '''Record in the database the outcome of checking a downloaded page
+        for changes, and schedule its next check.
+
+        In:  row as from crawl_db.urls_to_refresh(); a Fetched page.
+        '''
+        url, etag, last_modified, old_hash, interval = row
+        if page.status != 304:
+            self.count_prospective_pages += 1
+        if page.status is None or (page.status != 304 and not page.hash):
+            # Failed; the page stays due.
+            return
+        changed = page.status != 304 and page.hash != old_hash
+        interval = next_refresh_interval(interval, changed)
+        now = utils.timestamp()
+        if changed:
+            self.count_changed += 1
+            # The new version has to be crawled for links, and have its
+            # sentences extracted, again.
+            self.writer.add('changed_page', '''
+                    UPDATE OR IGNORE urls
+                    SET hash=?, date_downloaded=?,
+                    date_crawled_for_links=NULL, date_extracted=NULL
+                    WHERE url=?''',
+                    (page.hash, now, url))
+            self.collect_links(page)
+        else:
+            self.count_unchanged += 1
+        self.writer.add('refresh', '''
+                UPDATE urls
+                SET etag=?, last_modified=?, date_checked=?,
+                refresh_interval=?, next_refresh=?
+                WHERE url=?''',
+                (page.etag, page.last_modified, now, interval,
+                 utils.timestamp(interval), url))
+
+    def fetch(self, url, etag=None, last_modified=None,
+              check_duplicates=True):
+        '''Request, process and store one page; return a Fetched.
+
+        The page is hashed, compressed and scanned for links as it is read
+        (see ingest.py). With etag or last_modified the request is
+        conditional, and on 304 Not Modified nothing is stored. Unless
+        check_duplicates is False, a content page is fingerprinted and,
+        with near_duplicates 'skip', not stored if it nearly duplicates a
+        page already stored.
+
+        Touches no shared state other than the counters, so it may run in a
+        worker thread. Any error is returned in the Fetched, not raised.
+        '''
+        try:
+            return self.fetch_page(url, etag, last_modified, check_duplicates)
+        except Exception as e:
+            logging.exception('{} with URL = {}'.format(e, url))
+            self.tally('count_discarded_pages')
+            metrics.progress('|')
+            return Fetched(url, None, None, None, None, None,
+                           '{}: {}'.format(type(e).__name__, e))
+
+    def fetch_page(self, url, etag, last_modified, check_duplicates):
+        '''The body of fetch(), which may raise.'''
+        if not self.scheduler.allowed(url):
+            logging.info(politeness.disallowed + ': ' + url)
+            metrics.progress('|')
+            return Fetched(url, None, None, None, None, None,
+                           politeness.disallowed)
+        try:
+            response = self.request_page(url, etag, last_modified)
+        except urllib.request.URLError as e:
+            logging.error(str(e) + ' with URL = ' + url)
+            self.tally('urlerrors')
+            metrics.count('url_errors')
+            metrics.progress('|')
+            return Fetched(url, None, None, None, None, None, str(e))
+        # A 304 may leave out the validators; the old ones still hold.
+        etag = response.headers.get('ETag', etag)
+        last_modified = response.headers.get('Last-Modified', last_modified)
+        if response.status == 304:
+            self.tally('count_not_modified')
+            metrics.count('pages_not_modified')
+            metrics.progress('-')
+            return Fetched(url, 304, None, etag, last_modified, None)
+        page = response.sink
+        if page is None or not page.size:
+            logging.error('retrieved contents empty, with URL = ' + url)
+            self.tally('count_discarded_pages')
+            metrics.progress('|')
+            return Fetched(url, response.status, None, etag, last_modified,
+                           None, 'page empty')
+        metrics.observe('ingest', page.busy_time)
+        fingerprint = duplicate_of = None
+        blocks = page.content_blocks()
+        if (blocks is not None and check_duplicates and url != start_url and
+                self.near_duplicates != 'off'):
+            fingerprint, duplicate_of = self.check_near_duplicate(page.hash,
+                                                                  blocks)
+            if duplicate_of and self.near_duplicates == 'skip':
+                metrics.progress('~')
+                return Fetched(url, response.status, None, etag,
+                               last_modified, None, None, fingerprint,
+                               duplicate_of)
+        if not self.store_page(url, page.hash, page.data):
+            return Fetched(url, response.status, None, etag, last_modified,
+                           None, 'page not stored')
+        return Fetched(url, response.status, page.hash, etag, last_modified,
+                       page.links, None, fingerprint, duplicate_of)
+
+    def record_download(self, url, page):
+        '''Record a page as downloaded, or schedule it to be tried again;
+        return whether an outcome was written for url.'''
+        if page.hash:
+            self.update_db(page)
+            self.collect_links(page)
+        elif page.duplicate_of:
+            self.record_skipped(page)
+        elif url != start_url:
+            self.record_failure(url, page.error or 'unknown error')
+        else:
+            return False
+        return True
+
+    def collect_links(self, page):
+        '''Queue the links found in a stored page and mark it crawled for
+        links, as link_collector.py would have done reading it back, if
+        there is a collector and the page was scanned.'''
+        if self.collector is None or page.links is None:
+            return
+        self.collector.now = utils.timestamp()
+        self.collector.record_links([canonical.canonicalize(link, start_url)
+                                     for link in page.links], page.hash)
+
+    def record_failure(self, url, error):
+        '''Count a failed attempt at url and schedule the next, with backoff;
+        give the URL up after self.max_attempts failures, or at once if
+        robots.txt disallows it.
+
+        Only the thread that opened the connection may call this.
+        '''
+        self.count_failed += 1
+        metrics.count('download_failures')
+        attempts = crawl_db.attempts(self.connection, url) + 1
+        delay = retry_delay(attempts)
+        dead_letter = None
+        if attempts >= self.max_attempts or error == politeness.disallowed:
+            dead_letter = 1
+            self.count_dead_letter += 1
+            metrics.count('dead_lettered')
+            logging.error('giving up on URL = {0} after {1} attempts'.format(
+                    url, attempts))
+        else:
+            self.retries[url] = time.time() + delay
+        self.writer.add('failure', '''
+                UPDATE urls
+                SET attempts=?, last_error=?, next_attempt=?, dead_letter=?,
+                lease_owner=NULL, lease_expires=NULL
+                WHERE url=?''',
+                (attempts, error, utils.timestamp(delay), dead_letter, url))
+
+    def retry_failed(self, max_wait=default_max_retry_wait):
+        '''Try again the URLs that failed in this run as they fall due, for as
+        long as the next is due within max_wait seconds. The rest keep their
+        schedule in the database, for a later run.'''
+        while self.retries:
+            wait = min(self.retries.values()) - time.time()
+            if wait > max_wait:
+                return
+            if wait > 0:
+                print('\n\nWaiting {:.0f} seconds to retry failed URLs.'.
+                        format(wait))
+                time.sleep(wait)
+            now = time.time()
+            urls = [url for url, due in self.retries.items() if due <= now]
+            for url in urls:
+                del self.retries[url]
+            print('\n\nNow retrying {} URLs that failed.'.format(len(urls)))
+            self.download_all(politeness.interleave(urls))
+
+    def stop(self, signal_number=None, frame=None):
+        '''Claim no more URLs; the batch in progress is finished.'''
+        self.stopping.set()
 
-    def download(self, url):
+    def download_leased(self, owner, lease_seconds=default_lease, shard=None,
+                        idle_wait=default_idle_wait):
+        '''Claim batches of URLs under leases (see crawl_db.claim_urls()) and
+        download them, until there have been none to claim for idle_wait
+        seconds or stop() is called.
+
+        For one worker among several: the others leave the URLs leased here
+        alone until the lease expires. The leases are renewed while this
+        runs (see keep_leases()), however long a batch takes. Failed URLs
+        are not retried here but come back, once due, in the batches of any
+        worker. The leases not used up are given back at the end.
+        '''
+        batch_size = claim_factor * max(self.workers, 1)
+        idle_since = None
+        stopped = threading.Event()
+        keeper = threading.Thread(target=self.keep_leases,
+                                  args=(owner, lease_seconds, stopped),
+                                  daemon=True)
+        keeper.start()
+        # The URLs downloaded here without an outcome written for them. One
+        # claimed again is counted as a failure instead, so that it is given
+        # up on in the end rather than claimed forever. A URL that failed
+        # is not kept here, and is downloaded again once due.
+        unrecorded = set()
+
+        def record(url, page):
+            unrecorded.add(url)
+            if self.record_download(url, page):
+                unrecorded.discard(url)
+
+        try:
+            while not self.stopping.is_set():
+                # The links found so far must be in the database to be
+                # claimed, by this worker or another.
+                self.writer.flush()
+                urls = crawl_db.claim_urls(self.connection, owner,
+                                           batch_size, lease_seconds, shard)
+                if urls:
+                    idle_since = None
+                    again = unrecorded.intersection(urls)
+                    for url in again:
+                        self.record_failure(url, 'not recorded when '
+                                                 'downloaded')
+                    unrecorded -= again
+                    urls = [url for url in urls if url not in again]
+                    self.run_in_pool(politeness.interleave(urls), self.fetch,
+                                     record)
+                    continue
+                # Other workers may yet add links.
+                idle_since = idle_since or time.time()
+                if time.time() - idle_since >= idle_wait:
+                    break
+                self.stopping.wait(idle_poll_interval)
+        finally:
+            stopped.set()
+            keeper.join()
+            self.writer.flush()
+            crawl_db.release_leases(self.connection, owner)
+        # Whatever failed has been scheduled in the database.
+        self.retries = {}
+
+    def keep_leases(self, owner, lease_seconds, stopped):
+        '''Renew owner's leases lease_renewals times a lease period, until
+        stopped is set. Runs in a thread of its own, with a connection of
+        its own.'''
+        connection = crawl_db.connect(url_core, migrate_schema=False)
+        try:
+            while not stopped.wait(lease_seconds / lease_renewals):
+                try:
+                    renewed = crawl_db.renew_leases(connection, owner,
+                                                    lease_seconds)
+                except sqlite3.Error as e:
+                    # The next renewal may yet be in time.
+                    logging.error('renewing leases: ' + str(e))
+                    continue
+                logging.info('{} leases renewed'.format(renewed))
+        finally:
+            connection.close()
+
+    def download(self, url, etag=None, last_modified=None):
         '''Calls the three main component methods in this procedure and then
         ensures the terminal output has been printed to the screen.
         '''
-        retrieved_contents = self.request_page(url)
-        self.process_page(url, retrieved_contents)
-        self.store_page(url)
-        self.update_db(url)
+        self.record_download(url, self.fetch(url, etag, last_modified))
         sys.stdout.flush()
 
-def main(logging_flag=''):
-    downloader = Downloader(logging_flag)
-    print('''\nWe print . for a page successfully saved and | for '''
+    def run_in_pool(self, items, work, record):
+        '''Call work(item) for every item, using self.workers threads, and
+        record(item, result) for each in this (the calling) thread.
+
+        Workers fetch, process and store pages; the database is updated only
+        in record(), as SQLite connections may not be shared between threads.
+        work() is expected to return its errors rather than raise them (see
+        fetch()), so that record() can schedule the item again; one that is
+        raised all the same ends the run, with one worker or many.
+        '''
+        if self.workers <= 1:
+            for item in items:
+                record(item, work(item))
+                sys.stdout.flush()
+            self.writer.flush()
+            return
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            for (item,), future in utils.run_bounded(
+                    executor, work, ((item,) for item in items),
+                    self.workers):
+                record(item, future.result())
+                sys.stdout.flush()
+        self.writer.flush()
+
+    def download_all(self, urls):
+        '''Download every URL in urls, using self.workers threads.'''
+        self.run_in_pool(urls, self.fetch, self.record_download)
+
+    def refresh_all(self, rows):
+        '''Check the pages in rows (from crawl_db.urls_to_refresh()) for
+        changes with conditional requests, using self.workers threads.'''
+        rows = politeness.interleave(
+                rows, key=lambda row: politeness.host_of(row[0]))
+        # A new version of a page is bound to be near the old one.
+        self.run_in_pool(rows, lambda row: self.fetch(*row[:3],
+                                                      check_duplicates=False),
+                         self.update_refreshed)
+
+def main(logging_flag='', workers=1, pool_size=None,
+         timeout=http_pool.default_timeout, compression=True,
+         batch_size=db_writer.default_batch_size,
+         flush_interval=db_writer.default_flush_interval,
+         codec=compression_codecs.default_codec, refresh=False,
+         max_attempts=default_max_attempts,
+         max_retry_wait=default_max_retry_wait,
+         host_rate=politeness.default_rate,
+         host_concurrency=politeness.default_concurrency, obey_robots=True,
+         near_duplicates=neardup.default_mode,
+         max_distance=neardup.default_max_distance, collect_links=True,
+         filter_kind=url_filter.default_kind,
+         filter_error_rate=url_filter.default_error_rate, filter_memory=None,
+         lease_seconds=None, owner=None, shard=None,
+         idle_wait=default_idle_wait, start_page=True, host_share=None):
+    downloader = Downloader(logging_flag, workers, pool_size, timeout,
+                            compression, codec, max_attempts, host_rate,
+                            host_concurrency, obey_robots, near_duplicates,
+                            max_distance, host_share)
+    if collect_links:
+        # The links found in pages as they are downloaded are written here,
+        # so that link_collector.py need not read the pages back.
+        downloader.collector = link_collector.LinkCollector(
+                logging_flag, filter_kind=filter_kind,
+                filter_error_rate=filter_error_rate,
+                filter_memory=filter_memory)
+    print('''\nWe print . for a page successfully saved, - for a page '''
+            '''not modified, ~ for a near duplicate skipped and | for '''
             '''failure of any kind:''')
-    # We use url_core in anticipation of generalizing this code for multiple
-    # sites.
-    with sqlite3.connect('crawl_' + url_core + '.db') \
-            as downloader.connection:
+    if collect_links:
+        print('''(and, as the links in them are written, . for a new link '''
+              '''and | for one already known)''')
+    # Each site, named by url_core (see set_site()), has its own database.
+    with crawl_db.connect(url_core) as downloader.connection:
         downloader.cursor = downloader.connection.cursor()
+        downloader.writer = db_writer.BatchWriter(
+                downloader.connection, batch_size, flush_interval,
+                downloader.count_written)
+        if downloader.collector:
+            downloader.collector.writer = downloader.writer
+            downloader.collector.warm_filter(downloader.connection)
+        downloader.load_fingerprints()
         # Deal with the top-level page, which always contains links but almost
         # never any unique textual content. This core page is always dealt with 
         # separately, since saving it is for the sake of culling links 
         # rather than culling content.
-        print('\nFirst we handle the top-level page:')
-        downloader.count_prospective_pages += 1
-        downloader.download('http://' + url_core + '.com')
+        if start_page:
+            print('\nFirst we handle the top-level page:')
+            downloader.count_prospective_pages += 1
+            downloader.download(start_url, *crawl_db.start_page_validators(
+                    downloader.connection))
+        if refresh:
+            # Check the pages that are due for changes.
+            now = utils.timestamp()
+            print('\n\nPages to check for changes number {}:'.format(
+                    crawl_db.count_to_refresh(downloader.connection, now)))
+            downloader.refresh_all(crawl_db.urls_to_refresh(
+                    downloader.connection, now))
         # Deal with candidate URLs from the database. These pages will
-        # eventually be used for culling both content and links. We use a while
-        # loop to try again on transient HTTP request failures.
-        while True:
-            downloader.urlerrors = 0
-            candidate_urls = downloader.get_urls()
-            # Prepare to display real-time output
-            if not candidate_urls:
-                print('\n\nThere are no prospective pages to download. '
-                        'Exiting.')
-                break
-            print('\n\nProspective pages to download number {}:'. 
-                    format(len(candidate_urls)))
-            for url in candidate_urls:
-                downloader.download(url)
-            if downloader.urlerrors:
-                # Since we find that most URLErrors do not recur, we keep
-                # trying until they succeed. In the future, we must find a way
-                # to ensure that URLs that repeatedly fail are removed from
-                # the cycle.
-                print('\n\nNow retrying URLs that had URLErrors.', end='')
-            else:
-                break
+        # eventually be used for culling both content and links. Most
+        # failures do not recur, so failed URLs are retried with backoff,
+        # within this run if they fall due soon enough, until they have
+        # failed max_attempts times.
+        count_candidates = crawl_db.count_to_download(downloader.connection)
+        if lease_seconds:
+            # One worker among several; see coordinator.py.
+            owner = owner or default_owner()
+            signal.signal(signal.SIGTERM, downloader.stop)
+            print('\n\nClaiming pages to download as {}:'.format(owner))
+            downloader.download_leased(owner, lease_seconds, shard,
+                                       idle_wait)
+        elif not count_candidates:
+            print('\n\nThere are no prospective pages to download. Exiting.')
+        else:
+            print('\n\nProspective pages to download number {} (some may be '
+                    'waiting to be retried):'.format(count_candidates))
+            downloader.download_all(downloader.get_urls())
+            downloader.retry_failed(max_retry_wait)
+        downloader.writer.flush()
     # Although "with" should make this unnecessary; we manually
     # close the cursor and the connection.
     downloader.cursor.close()
     downloader.connection.close()
+    downloader.http.close()
+    downloader.store.close()
     #
     # Report
     downloader.summarize_run()
+    if downloader.collector:
+        downloader.collector.store.close()
+        downloader.collector.start_time = downloader.start_time
+        downloader.collector.summarize_run()
+
+def default_owner():
+    '''Return a name for this process as the owner of leases.'''
+    return '{0}:{1:d}'.format(socket.gethostname(), os.getpid())
+
+def parse_shard(text):
+    '''Parse a --shard or --host-share argument, K/N, into (K, N).'''
+    try:
+        shard, shards = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected K/N, not ' + repr(text))
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError('K/N needs 0 <= K < N')
+    return shard, shards
+
+def add_lease_flags(parser):
+    '''Add the switches for running as one of several workers.'''
+    parser.add_argument('--lease', dest='lease_seconds', type=float,
+                        nargs='?', const=default_lease,
+                        help='claim pages to download in batches, under '
+                             'leases of this many seconds (default {}), so '
+                             'that several downloaders can share the '
+                             'database'.format(default_lease))
+    parser.add_argument('--owner',
+                        help='name for the leases (default HOST:PID)')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='with --lease, claim only URLs in shard K of N, '
+                             'by hash of the URL')
+    parser.add_argument('--idle-wait', type=float, default=default_idle_wait,
+                        help='with --lease, seconds to wait for more pages '
+                             'before stopping (default {})'.format(
+                                 default_idle_wait))
+    parser.add_argument('--no-start-page', dest='start_page',
+                        action='store_false',
+                        help='do not download the top-level page first')
+    parser.add_argument('--host-share', type=parse_shard,
+                        help='as downloader K of N sharing the per-host '
+                             'limits, those of robots.txt included, keep to '
+                             'a share of each')
+
+def add_politeness_flags(parser):
+    '''Add the per-host limit switches to an argparse parser.'''
+    parser.add_argument('--host-rate', type=float,
+                        default=politeness.default_rate,
+                        help='most requests a second to any one host; 0 for '
+                             'no limit (default {})'.format(
+                                 politeness.default_rate))
+    parser.add_argument('--host-concurrency', type=int,
+                        default=politeness.default_concurrency,
+                        help='most requests in progress at once to any one '
+                             'host (default {})'.format(
+                                 politeness.default_concurrency))
+    parser.add_argument('--ignore-robots', dest='obey_robots',
+                        action='store_false',
+                        help='do not read robots.txt')
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    utils.add_logging_flags(parser)
+    utils.add_site_flags(parser)
+    parser.add_argument('-w', '--workers', type=int, default=default_workers,
+                        help='number of pages to download concurrently '
+                             '(default {})'.format(default_workers))
+    parser.add_argument('--pool-size', type=int,
+                        help='keep-alive connections per host '
+                             '(default: one per worker)')
+    parser.add_argument('--timeout', type=float,
+                        default=http_pool.default_timeout,
+                        help='seconds to wait on connect or read '
+                             '(default {})'.format(http_pool.default_timeout))
+    parser.add_argument('--no-compression', dest='compression',
+                        action='store_false',
+                        help='do not ask for gzip/deflate responses')
+    parser.add_argument('--batch-size', type=int,
+                        default=db_writer.default_batch_size,
+                        help='database writes per transaction '
+                             '(default {})'.format(db_writer.default_batch_size))
+    parser.add_argument('--flush-interval', type=float,
+                        default=db_writer.default_flush_interval,
+                        help='maximum seconds between commits '
+                             '(default {})'.format(
+                                 db_writer.default_flush_interval))
+    parser.add_argument('--codec', choices=sorted(compression_codecs.codecs),
+                        default=compression_codecs.default_codec,
+                        help='compression for stored pages (default {})'
+                             .format(compression_codecs.default_codec))
+    parser.add_argument('--refresh', action='store_true',
+                        help='also check downloaded pages that are due for '
+                             'changes, with conditional requests')
+    parser.add_argument('--max-attempts', type=int,
+                        default=default_max_attempts,
+                        help='failed attempts before a URL is given up on '
+                             '(default {})'.format(default_max_attempts))
+    parser.add_argument('--max-retry-wait', type=float,
+                        default=default_max_retry_wait,
+                        help='longest wait, in seconds, to retry failed URLs '
+                             'within this run (default {})'.format(
+                                 default_max_retry_wait))
+    add_politeness_flags(parser)
+    neardup.add_near_duplicate_flags(parser)
+    parser.add_argument('--no-collect-links', dest='collect_links',
+                        action='store_false',
+                        help='leave the links in downloaded pages for '
+                             'link_collector.py to find')
+    url_filter.add_filter_flags(parser)
+    add_lease_flags(parser)
+    metrics.add_metrics_flags(parser)
+    arguments = parser.parse_args(argv)
+    if (arguments.host_share and
+            arguments.host_concurrency < arguments.host_share[1]):
+        parser.error('--host-concurrency {0} cannot be shared by {1} '
+                     'downloaders'.format(arguments.host_concurrency,
+                                          arguments.host_share[1]))
+    return arguments
 
 if __name__ == '__main__':
-    main(sys.argv[-1])
+    arguments = parse_arguments()
+    set_site(arguments.site, arguments.start_url)
+    # The links found are written by a LinkCollector, for the same site.
+    link_collector.set_site(arguments.site, arguments.start_url)
+    with metrics.session('downloader', arguments):
+        main(arguments.logging_flag, arguments.workers, arguments.pool_size,
+             arguments.timeout, arguments.compression, arguments.batch_size,
+             arguments.flush_interval, arguments.codec, arguments.refresh,
+             arguments.max_attempts, arguments.max_retry_wait,
+             arguments.host_rate, arguments.host_concurrency,
+             arguments.obey_robots, arguments.near_duplicates,
+             arguments.simhash_distance, arguments.collect_links,
+             arguments.url_filter, arguments.filter_error_rate,
+             arguments.filter_memory, arguments.lease_seconds,
+             arguments.owner, arguments.shard, arguments.idle_wait,
+             arguments.start_page, arguments.host_share)
@@ -0,0 +1,292 @@
+# http_pool.py
+'''Pooled keep-alive HTTP client for the crawlers.
+
+urllib.request.urlopen() opens a new connection for every request. Here
+connections to each host are kept open and reused, up to a fixed number per
+host, and responses are requested with gzip/deflate transfer encoding.
+
+Errors are raised as urllib.error.URLError (HTTPError for 4xx/5xx), as
+urlopen() would raise them, so that callers can handle both alike.
+
+The body of a successful response can be streamed instead of returned: a
+sink factory passed to HTTPClient.get() is called with the response headers
+and given the decoded body a chunk at a time, as it is read from the socket.
+'''
+
+import http.client
+import urllib.parse
+import urllib.error
+import threading
+import queue
+import time
+import zlib
+
+default_pool_size = 8
+default_timeout = 30
+# Bytes read from the socket at a time when a body is streamed.
+chunk_size = 64 * 1024
+max_redirects = 5
+redirect_codes = (301, 302, 303, 307, 308)
+# Errors showing that a kept-alive connection was closed by the server while
+# idle; the request is then tried once more on a fresh connection.
+stale_connection_errors = (http.client.RemoteDisconnected,
+                           http.client.BadStatusLine,
+                           BrokenPipeError, ConnectionResetError)
+
+class Response(object):
+    '''The parts of an HTTP response that the crawlers use.
+
+    If the body was streamed, body is None and sink is what it was written
+    to.
+    '''
+    def __init__(self, url, status, headers, body, connect_time,
+                 transfer_time, sink=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.sink = sink
+        # Seconds spent opening connections (0 if one was reused) and
+        # sending the request and reading the response.
+        self.connect_time = connect_time
+        self.transfer_time = transfer_time
+
+    def read(self):
+        return self.body
+
+def decode_body(body, content_encoding):
+    '''Undo gzip or deflate transfer encoding.'''
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif content_encoding == 'deflate':
+        # Some servers send raw deflate data without the zlib header.
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+def has_zlib_header(data):
+    return (len(data) >= 2 and data[0] & 0x0f == 8 and
+            ((data[0] << 8) | data[1]) % 31 == 0)
+
+class BodyDecoder(object):
+    '''Undo gzip or deflate transfer encoding a chunk at a time, as
+    decode_body() does for a whole body.'''
+    def __init__(self, content_encoding):
+        self.encoding = (content_encoding or '').strip().lower()
+        self.decompressor = None
+        if self.encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, chunk):
+        if self.encoding == 'deflate' and self.decompressor is None:
+            # Some servers send raw deflate data without the zlib header.
+            self.decompressor = zlib.decompressobj(
+                    zlib.MAX_WBITS if has_zlib_header(chunk)
+                    else -zlib.MAX_WBITS)
+        if self.decompressor is None:
+            return chunk
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        return self.decompressor.flush() if self.decompressor else b''
+
+def stream_body(response, sink):
+    '''Read the body of response into sink a chunk at a time, undoing any
+    transfer encoding.'''
+    decoder = BodyDecoder(response.getheader('Content-Encoding'))
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        sink.write(decoder.decode(chunk))
+    sink.write(decoder.flush())
+    sink.close()
+
+class ConnectionPool(object):
+    '''Keep-alive connections to a single host.
+
+    At most size connections are open at once; a request made while all of
+    them are busy waits for one to be returned.
+    '''
+    def __init__(self, scheme, host, port=None, size=default_pool_size,
+                 timeout=default_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+
+    def new_connection(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port,
+                                               timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def get_connection(self):
+        '''Return an idle connection if there is one, else a new one.'''
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self.new_connection(), False
+
+    def request(self, method, path, headers, new_sink=None):
+        '''Issue one request; return (status, headers, body, connect_time,
+        transfer_time, sink).
+
+        If new_sink is given and the response is a success, the body is
+        streamed into new_sink(headers) and returned as None.
+        '''
+        with self.slots:
+            connection, reused = self.get_connection()
+            try:
+                return self.send(connection, method, path, headers, new_sink)
+            except stale_connection_errors:
+                connection.close()
+                if not reused:
+                    raise
+                # Retry once on a fresh connection.
+                connection = self.new_connection()
+                return self.send(connection, method, path, headers, new_sink)
+
+    def send(self, connection, method, path, headers, new_sink=None):
+        connect_time = 0
+        if connection.sock is None:
+            start = time.time()
+            try:
+                connection.connect()
+            except Exception:
+                connection.close()
+                raise
+            connect_time = time.time() - start
+        start = time.time()
+        sink = None
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+        try:
+            if new_sink and 200 <= response.status < 300:
+                sink = new_sink(response.msg)
+                body = None
+                stream_body(response, sink)
+            else:
+                body = response.read()
+        except stale_connection_errors as e:
+            connection.close()
+            # Part of the body may have gone to the sink already, so the
+            # request must not be tried again.
+            raise http.client.IncompleteRead(b'', None) from e
+        except Exception:
+            connection.close()
+            raise
+        transfer_time = time.time() - start
+        if response.will_close:
+            connection.close()
+        else:
+            self.idle.put(connection)
+        return (response.status, response.msg, body, connect_time,
+                transfer_time, sink)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class HTTPClient(object):
+    '''Issue GET requests through one ConnectionPool per host.'''
+    def __init__(self, pool_size=default_pool_size, timeout=default_timeout,
+                 compression=True, user_agent='slithersentence'):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.compression = compression
+        self.user_agent = user_agent
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self, scheme, netloc):
+        key = (scheme, netloc)
+        with self.lock:
+            if key not in self.pools:
+                parts = urllib.parse.urlsplit(scheme + '://' + netloc)
+                self.pools[key] = ConnectionPool(scheme, parts.hostname,
+                                                 parts.port, self.pool_size,
+                                                 self.timeout)
+            return self.pools[key]
+
+    def get(self, url, headers=None, new_sink=None):
+        '''GET url, following redirects; return a Response.
+
+        If new_sink is given, the body of a successful response is streamed
+        into new_sink(response headers), an object with write(bytes) and
+        close() methods, instead of being kept in the Response.
+
+        Raise urllib.error.HTTPError for error statuses and
+        urllib.error.URLError for malformed URLs and failures to connect or
+        read.
+        '''
+        connect_time = transfer_time = 0
+        for _ in range(max_redirects + 1):
+            try:
+                parts = urllib.parse.urlsplit(url)
+                if parts.scheme not in ('http', 'https'):
+                    raise urllib.error.URLError('unknown url type: ' + url)
+                pool = self.get_pool(parts.scheme, parts.netloc)
+            except ValueError as e:
+                # A malformed host or port.
+                raise urllib.error.URLError('bad URL {}: {}'.format(url, e))
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            request_headers = {'Host': parts.netloc,
+                               'User-Agent': self.user_agent,
+                               'Connection': 'keep-alive'}
+            if self.compression:
+                request_headers['Accept-Encoding'] = 'gzip, deflate'
+            request_headers.update(headers or {})
+            try:
+                status, response_headers, body, connect, transfer, sink = (
+                        pool.request('GET', path, request_headers, new_sink))
+            except (http.client.HTTPException, OSError) as e:
+                raise urllib.error.URLError(e)
+            except UnicodeError as e:
+                # A path or header, perhaps from a redirect, that is not
+                # ASCII.
+                raise urllib.error.URLError('cannot encode request for {}: {}'
+                                            .format(url, e))
+            except zlib.error as e:
+                raise urllib.error.URLError('bad content encoding: ' + str(e))
+            connect_time += connect
+            transfer_time += transfer
+            location = response_headers.get('Location')
+            if status in redirect_codes and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if body is not None:
+                try:
+                    body = decode_body(body,
+                                       response_headers.get('Content-Encoding'))
+                except zlib.error as e:
+                    raise urllib.error.URLError('bad content encoding: ' +
+                                                str(e))
+            if status >= 400:
+                raise urllib.error.HTTPError(
+                        url, status, http.client.responses.get(status, ''),
+                        response_headers, None)
+            return Response(url, status, response_headers, body,
+                            connect_time, transfer_time, sink)
+        raise urllib.error.URLError('too many redirects: ' + url)
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
@@ -0,0 +1,191 @@
+# ingest.py
+'''Single-pass ingestion of downloaded pages.
+
+A page is taken in as its bytes are read from the socket (see
+http_pool.HTTPClient.get()): each chunk goes at once to an MD5 hash, to an
+incremental compressor for the pack store and to an html.parser scanner
+that collects both the links we follow and the blocks of text that
+sentence_extractor.py and neardup.py look at. The page is therefore never
+parsed into a tree, re-encoded or read back from disk to be crawled for
+links.
+
+Pages are stored as they came, unless they are in a charset other than
+UTF-8, in which case they are decoded as they come and stored as UTF-8. The
+charset is the one the response declared or, if it declared none, the one
+declared in a <meta> tag near the start of the page.
+'''
+
+import time
+import codecs
+import hashlib
+import logging
+
+import bs4
+
+import http_pool
+import compression
+import link_extractors
+import sentence_extractor
+
+# Charsets whose bytes are stored as they are.
+utf8_compatible = {'utf-8', 'ascii'}
+# Charsets read as a superset, as browsers do: pages labelled GB2312 often
+# use characters only in GBK.
+supersets = {'gb2312': 'gbk'}
+# Bytes at the start of a page searched for a <meta> charset, when the
+# response declared none.
+sniff_size = 2048
+
+class PageScanner(link_extractors.HrefScanner):
+    '''An HrefScanner that also hands what it parses to a
+    sentence_extractor.TextScanner, so that one parse finds both the links
+    and the blocks of text.'''
+    def __init__(self, prefix=link_extractors.link_prefix):
+        super().__init__(prefix)
+        self.text = sentence_extractor.TextScanner()
+
+    @property
+    def blocks(self):
+        return self.text.blocks
+
+    def handle_starttag(self, tag, attrs):
+        super().handle_starttag(tag, attrs)
+        self.text.handle_starttag(tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        super().handle_startendtag(tag, attrs)
+        self.text.handle_startendtag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        self.text.handle_endtag(tag)
+
+    def handle_data(self, data):
+        self.text.handle_data(data)
+
+    def close(self):
+        super().close()
+        self.text.close()
+
+def charset_name(charset):
+    '''Return the normal name of charset, or 'utf-8' if it is missing or
+    unknown.'''
+    try:
+        name = codecs.lookup(charset or 'utf-8').name
+    except LookupError:
+        logging.warning('unknown charset ' + repr(charset) + '; using UTF-8')
+        return 'utf-8'
+    return supersets.get(name, name)
+
+def declared_charset(head):
+    '''Return the charset declared by <meta charset> or <meta http-equiv>
+    in head, the start of a page, or None.'''
+    return bs4.dammit.EncodingDetector.find_declared_encoding(head,
+                                                               is_html=True)
+
+def extract_links(page_contents, chunk_size=http_pool.chunk_size):
+    '''Return the links a PageIngest finds in page_contents, fed to it as
+    from a response with no charset, or None if it could not scan them.'''
+    ingestion = PageIngest(compression.codecs['none'])
+    for i in range(0, len(page_contents), chunk_size):
+        ingestion.write(page_contents[i:i + chunk_size])
+    ingestion.close()
+    return ingestion.links
+
+class PageIngest(object):
+    '''Hash, compress and scan a page a chunk at a time.
+
+    Give it the bytes of the page with write() and finish with close();
+    then hash, data (the compressed page) and size are set, and links and
+    content_blocks() give what the scan found. links is None, and so is
+    content_blocks(), if the page could not be scanned; it can still be
+    stored, and crawled for links later from the store.
+    '''
+    def __init__(self, codec, charset=None):
+        # Set by start(), at once if the response declared a charset and
+        # otherwise once sniff_size bytes, kept in head, have come.
+        self.charset = None
+        self.transcode = False
+        self.decoder = None
+        self.head = b''
+        if charset:
+            self.start(charset)
+        self.md5 = hashlib.md5()
+        self.compressor = codec.compressor()
+        self.chunks = []
+        self.scanner = PageScanner()
+        self.scan_error = None
+        self.size = 0
+        self.hash = None
+        self.data = None
+        # Seconds spent on hashing, compressing and scanning.
+        self.busy_time = 0.0
+
+    def start(self, charset):
+        self.charset = charset_name(charset)
+        self.transcode = self.charset not in utf8_compatible
+        self.decoder = codecs.getincrementaldecoder(self.charset)('replace')
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        start = time.perf_counter()
+        if self.decoder is None:
+            self.head += chunk
+            if len(self.head) >= sniff_size:
+                self.sniff()
+        else:
+            self.decode(chunk)
+        self.busy_time += time.perf_counter() - start
+
+    def sniff(self):
+        '''Start decoding head in the charset it declares.'''
+        head, self.head = self.head, b''
+        self.start(declared_charset(head))
+        self.decode(head)
+
+    def decode(self, chunk):
+        text = self.decoder.decode(chunk)
+        self.take(text.encode('utf-8') if self.transcode else chunk, text)
+
+    def take(self, chunk, text):
+        self.size += len(chunk)
+        self.md5.update(chunk)
+        self.chunks.append(self.compressor.compress(chunk))
+        if self.scan_error is None:
+            try:
+                self.scanner.feed(text)
+            except Exception as e:
+                logging.warning(str(e) + ' in scanning page; links left to '
+                                'link_collector.py')
+                self.scan_error = e
+
+    def close(self):
+        start = time.perf_counter()
+        if self.decoder is None:
+            # A page shorter than sniff_size.
+            self.sniff()
+        # Bytes of a character cut off at the end of the page.
+        text = self.decoder.decode(b'', final=True)
+        self.take(text.encode('utf-8') if self.transcode else b'', text)
+        self.chunks.append(self.compressor.flush())
+        if self.scan_error is None:
+            try:
+                self.scanner.close()
+            except Exception as e:
+                self.scan_error = e
+        self.hash = self.md5.hexdigest()
+        self.data = b''.join(self.chunks)
+        self.chunks = []
+        self.busy_time += time.perf_counter() - start
+
+    @property
+    def links(self):
+        '''The hrefs of the links to follow, in order, or None.'''
+        return None if self.scan_error else self.scanner.links
+
+    def content_blocks(self):
+        '''Return the blocks of text that look like content (see
+        sentence_extractor.content_blocks()), or None.'''
+        if self.scan_error:
+            return None
+        return sentence_extractor.select_content_blocks(self.scanner.blocks)
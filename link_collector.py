@@ -6,37 +6,107 @@
 
 import os
 import sys
-import urllib.request
-import bs4
 import time
 import datetime
-import sqlite3
-import hashlib
-import bz2
 import logging
+import argparse
+import concurrent.futures
 
 import utils
+import db_writer
+import crawl_db
+import link_extractors
+import pack_store
+import compression
+import url_filter
+import canonical
+import metrics
 
-url_core = 'worldjournal'
-start_url = 'http://' + url_core + '.com'
+url_core = utils.default_site
+start_url = utils.site_start_url(url_core)
+default_processes = os.cpu_count() or 1
 
-def main(logging_flag=''):
-    link_collector = LinkCollector(logging_flag)
+def set_site(site, url=None):
+    '''Collect links for another site: site names its database and pack
+    file, and url (by default http://<site>.com) completes relative links.'''
+    global url_core, start_url
+    url_core = site
+    start_url = url or utils.site_start_url(site)
+
+def main(logging_flag='', batch_size=db_writer.default_batch_size,
+         flush_interval=db_writer.default_flush_interval,
+         processes=default_processes,
+         extractor=link_extractors.default_backend,
+         filter_kind=url_filter.default_kind,
+         filter_error_rate=url_filter.default_error_rate, filter_memory=None):
+    link_collector = LinkCollector(logging_flag, batch_size, flush_interval,
+                                   processes, extractor, filter_kind,
+                                   filter_error_rate, filter_memory)
     link_collector.collect_links()
     link_collector.summarize_run()
 
+# Each worker process has a LinkCollector of its own, used only to read
+# pages and extract their links; the database is written by the parent.
+worker_collector = None
+
+def start_worker(logging_flag, extractor, site=None, url=None):
+    # The site is passed on, since a worker started by spawn rather than
+    # fork does not inherit set_site().
+    global worker_collector
+    if site is not None:
+        set_site(site, url)
+    worker_collector = LinkCollector(logging_flag, extractor=extractor)
+
+def links_in_page(hash, is_for_content):
+    '''Read and crawl a saved page in a worker process.
+
+    Return (decompressed, url_list, crawl_time): whether the page could be
+    read and decompressed, the URLs found (None if none could be), and the
+    time the parse took.
+    '''
+    worker_collector.crawl_time = 0
+    page_contents = worker_collector.read_page(hash, is_for_content)
+    url_list = worker_collector.crawl_for_links(page_contents)
+    sys.stdout.flush()
+    return (page_contents is not None, url_list,
+            worker_collector.crawl_time)
+
 class LinkCollector(object):
-    def __init__(self, logging_flag=''):
+    def __init__(self, logging_flag='',
+                 batch_size=db_writer.default_batch_size,
+                 flush_interval=db_writer.default_flush_interval,
+                 processes=1, extractor=link_extractors.default_backend,
+                 filter_kind=url_filter.default_kind,
+                 filter_error_rate=url_filter.default_error_rate,
+                 filter_memory=None):
         app_name = __file__.split('.')[0]
+        self.logging_flag = logging_flag
+        self.extractor = extractor
         utils.set_up_logger(app_name, logging_flag)
         # Misc. class attributes
         self.cursor = None
+        self.writer = None
+        self.batch_size = batch_size
+        self.processes = processes
+        self.store = pack_store.PackStore('CRAWLED_PAGES', url_core)
+        self.flush_interval = flush_interval
+        # Known URLs, so that only new ones reach the database; made by
+        # warm_filter().
+        self.filter_kind = filter_kind
+        self.filter_error_rate = filter_error_rate
+        self.filter_memory = filter_memory
+        self.seen = None
+        self.connection = None
+        # Links queued for the database but not yet written.
+        self.queued_urls = set()
         # Counters
         self.count_discarded_urls = 0
         self.count_crawled_pages = 0
         self.count_downloaded_pages = 0
         self.count_no_links_found_pages = 0
         self.total_links_added = 0
+        self.count_filtered_urls = 0
+        self.count_false_positives = 0
         # Timers
         self.crawl_time = 0
         self.now = ''
@@ -48,6 +118,9 @@ class LinkCollector(object):
         indent = ' ' * 4
         print('\n\nTiming')
         print(indent + 'Time elapsed: {}.'.format(elapsed_str))
+        print(indent + 'Time spent extracting links: {0} or {1:.2f}%.'.format(
+                str(datetime.timedelta(seconds=self.crawl_time)),
+                100 * self.crawl_time / elapsed))
         print('Links and pages')
         print(indent + ('{} links added this run.'
                         .format(self.total_links_added)))
@@ -63,38 +136,51 @@ class LinkCollector(object):
         print('Errors')
         print(indent + ('{} pages discarded (no unique or usable links found).'
                         .format(self.count_no_links_found_pages)))
-        with sqlite3.connect('crawl_' + url_core + '.db') as connection:
-            cursor = connection.cursor()
-            cursor = cursor.execute('''SELECT * FROM urls;''')
-            print('{} unique records in database'
-                  .format(len(cursor.fetchall())))
-            cursor.close()
+        if self.seen is not None:
+            print('URL filter')
+            print(indent + ('{0} filter of {1} URLs, about {2:.1f} MB.'
+                            .format(self.filter_kind, len(self.seen),
+                                    self.seen.memory() / 2**20)))
+            print(indent + ('{} known links kept from the database.'
+                            .format(self.count_filtered_urls)))
+            if not self.seen.exact:
+                print(indent + ('False-positive rate {0:.4%} expected; {1} '
+                                'new links caught by the database check.'
+                                .format(self.seen.error_rate(),
+                                        self.count_false_positives)))
+        connection = crawl_db.connect(url_core)
+        print('{} unique records in database'
+              .format(crawl_db.count(connection, 'urls')))
+        connection.close()
 
     def collect_links(self):
         self.start_time = time.time()
         print('''\nWe print . for a link successfully added and | for '''
               '''failure of any kind:''')
         try:
-            with sqlite3.connect('crawl_' + url_core + '.db') \
-                    as connection:
+            with crawl_db.connect(url_core) as connection:
                 # The following line is (apparently) just for the sake of the
                 # close() in the finally-clause below:
                 self.cursor = connection.cursor()
+                self.writer = db_writer.BatchWriter(
+                        connection, self.batch_size, self.flush_interval,
+                        self.count_written)
+                self.warm_filter(connection)
                 # Get list of hashes and whether for content or not of 
                 # uncrawled pages
-                file_hash_list = self.get_hashes()
-                if file_hash_list:
+                count_files = crawl_db.count_to_crawl_for_links(connection)
+                if count_files:
                     # Prepare to display real-time output
                     print('\nProspective uncrawled files number {}:'
-                          .format(len(file_hash_list)))
-                    for hash, is_for_content in file_hash_list:
-                        if hash:
-                            filename = self.name_file(hash, is_for_content)
-                            self.process_page(filename, hash)
-                        else:
-                            self.count_no_links_found_pages += 1
+                          .format(count_files))
+                    if self.processes > 1:
+                        self.process_pages_in_parallel()
+                    else:
+                        for hash, is_for_content in self.pages_to_crawl():
+                            self.process_page(hash, is_for_content)
                 else:
                     print('\nThere are no links to be added.')
+                self.writer.flush()
         except Exception as e:
             logging.error(e)
         finally:
@@ -103,30 +189,50 @@ class LinkCollector(object):
             # closing both manually, just to be sure.
             self.cursor.close()
             connection.close()
+            self.store.close()
 
     def get_hashes(self):
-        '''Return list of hashes for those files not yet crawled for links.
+        '''Yield hashes, and whether for content or not, for those files not
+        yet crawled for links, reading them a page at a time.
 
         Assumes open database.
         '''
-        self.cursor = self.cursor.execute('''SELECT hash, '''
-                '''to_be_crawled_for_content '''
-                '''FROM urls WHERE date_crawled_for_links IS NULL '''
-                '''AND date_downloaded IS NOT NULL;''')
-        return [(i[0], i[1]) for i in self.cursor.fetchall()]
+        return crawl_db.hashes_to_crawl_for_links(self.cursor.connection)
 
     def name_file(self, hash, is_for_content):
         filler = '_' if is_for_content else '_base_page_'
         return url_core + filler + hash + '.bz2'
 
-    def process_page(self, filename, hash):
-        '''Open file, decompress, crawl, add links, mark crawled in db.'''
+    def read_page(self, hash, is_for_content):
+        '''Return the decompressed contents of a saved page, or None.
+
+        Pages are read from the pack store; pages saved one per file before
+        there was a pack store are read from their files.
+        '''
+        codec, compressed = self.store.get(hash)
+        if compressed is None:
+            codec = compression.codecs[compression.legacy_codec].number
+            filename = self.name_file(hash, is_for_content)
+            try:
+                with open(os.path.join('CRAWLED_PAGES', filename),
+                          'rb') as file_object:
+                    compressed = file_object.read()
+            except OSError as e:
+                logging.error(str(e) + ' with hash = ' + hash)
+                return
+        return self.decompress_page(compressed, codec)
+
+    def process_page(self, hash, is_for_content):
+        '''Read page, crawl, add links, mark crawled in db.'''
         self.now = datetime.datetime.strftime(datetime.datetime.now(),
                                               '%Y-%m-%d %H:%M:%S.%f')
-        with open(os.path.join('CRAWLED_PAGES', filename),
-                  'rb') as file_object:
-            page_contents = self.decompress_page(file_object)
+        with metrics.timer('read_page'):
+            page_contents = self.read_page(hash, is_for_content)
         url_list = self.crawl_for_links(page_contents)
+        return self.record_links(url_list, hash)
+
+    def record_links(self, url_list, hash):
+        '''Add links found in a page to db and mark the page crawled.'''
         if url_list:
             # Loop through this url_list and add links to db IF unique
             self.add_links_to_db(url_list, hash)
@@ -135,22 +241,53 @@ class LinkCollector(object):
             # ggg we should mark this page as having no useful links so 
             # this process is not repeated.
         # In either case, mark record for this file as crawled.
-        try:
-            self.cursor = self.cursor.execute(
-                    '''UPDATE urls
-                    SET date_crawled_for_links=?
-                    WHERE hash=?''',
-                    (self.now, hash) )
-            self.count_crawled_pages += 1
-        except Exception as e:
-            logging.error(str(e) + ' with hash = ' + hash)
-            self.count_discarded_urls += 1
-        return len(url_list)
+        self.writer.add('crawled', '''UPDATE urls
+                SET date_crawled_for_links=?
+                WHERE hash=?''',
+                (self.now, hash) )
+        return len(url_list or [])
+
+    def process_pages_in_parallel(self):
+        '''Read and crawl the uncrawled pages in a pool of processes.
+
+        Decompressing and parsing are CPU-bound, so they are spread over
+        self.processes workers; each returns just the list of URLs, and the
+        database is written here, by the only writer.
+        '''
+        with concurrent.futures.ProcessPoolExecutor(
+                self.processes, initializer=start_worker,
+                initargs=(self.logging_flag, self.extractor, url_core,
+                          start_url)) as executor:
+            for (hash, _), future in utils.run_bounded(
+                    executor, links_in_page, self.pages_to_crawl(),
+                    self.processes):
+                self.now = datetime.datetime.strftime(
+                        datetime.datetime.now(), '%Y-%m-%d %H:%M:%S.%f')
+                try:
+                    decompressed, url_list, crawl_time = future.result()
+                except Exception as e:
+                    logging.error(str(e) + ' with hash = ' + hash)
+                    decompressed, url_list, crawl_time = False, None, 0
+                if decompressed:
+                    self.count_downloaded_pages += 1
+                self.crawl_time += crawl_time
+                metrics.observe('extract_links', crawl_time)
+                self.record_links(url_list, hash)
 
-    def decompress_page(self, file_object):
+    def pages_to_crawl(self):
+        '''Yield (hash, is_for_content) for the uncrawled pages, counting
+        those without a page stored.'''
+        for hash, is_for_content in self.get_hashes():
+            if not hash:
+                self.count_no_links_found_pages += 1
+                continue
+            yield hash, is_for_content
+
+    def decompress_page(self, compressed, codec):
         '''Decompress a saved page and return its contents.'''
         try:
-            file_contents = bz2.decompress(file_object.read())
+            file_contents = compression.codecs_by_number[codec].decompress(
+                    compressed)
         except Exception as e:
             print('in decompress_page:', e)
             return
@@ -158,71 +295,127 @@ class LinkCollector(object):
         return file_contents
 
     def crawl_for_links(self, page_contents):
-        '''Generate a list of URLs from the page contents passed in.
-
-        Also, update the database for the URL passed in, so that it
-        is not crawled again.
-        '''
+        '''Generate a list of URLs, in canonical form, from the page contents
+        passed in.'''
         if not page_contents:
             # ggg note: this will eventually be logged as error
             print('The page contents have been returned empty.\n')
             return
         crawl_time_start = time.time()
-        try:
-            soup = bs4.BeautifulSoup(page_contents)
-        except urllib.request.URLError as e:
-            logging.error(str(e) + ' with URL = ' + url)
-            self.urlerrors += 1
-        self.crawl_time += time.time() - crawl_time_start
-        return [self.get_url_from_tag(i)
-                for i in soup.select('a[href^="/view"]')]
-
-    def get_url_from_tag(self, tag):
-        '''From an <a ... href...> tag return the URL alone.'''
-        try:
-            link = tag.attrs['href']
-            link = self.ensure_whole_url(link)
-        except Exception as e:
-            print('tag:', tag)
-            logging.error(str(e) + ' with URL = ' + url)
-        return link
-
-    def ensure_whole_url(self, url):
-        '''Internal URLs are completed here.'''
-        protocol = url.split(':')[0]
-        if protocol in ('http', 'https'):
-            return url
-        else:
-            return start_url + url
+        links = link_extractors.extract_links(page_contents, self.extractor)
+        crawl_time = time.time() - crawl_time_start
+        self.crawl_time += crawl_time
+        if worker_collector is None:
+            # In a worker process the parent records it; see
+            # process_pages_in_parallel().
+            metrics.observe('extract_links', crawl_time)
+        return [self.clean_url(link) for link in links]
+
+    def clean_url(self, url):
+        '''Return the URL in the form we store it (see canonical.py), or None
+        if it is empty or unusable. Relative URLs are completed here.'''
+        return canonical.canonicalize(url, start_url)
+
+    def warm_filter(self, connection):
+        '''Make the filter of known URLs and fill it from the database.'''
+        self.connection = connection
+        self.seen = url_filter.make_filter(
+                self.filter_kind, crawl_db.count(connection, 'urls'),
+                self.filter_error_rate, self.filter_memory)
+        if self.seen is None:
+            return
+        for (url,) in connection.execute(
+                'SELECT url FROM urls WHERE url IS NOT NULL'):
+            self.seen.add(url)
+
+    def is_known(self, url):
+        '''Return True if url is known to be in the database, or queued for
+        it; otherwise note it as known from now on.'''
+        if self.seen is None or self.seen.add(url):
+            return False
+        if self.seen.exact or url in self.queued_urls:
+            return True
+        # Perhaps a false positive of the Bloom filter.
+        if self.connection.execute('SELECT 1 FROM urls WHERE url = ?',
+                                   (url,)).fetchone():
+            return True
+        self.count_false_positives += 1
+        return False
 
     def add_links_to_db(self, url_list, hash):
-        '''Attempt to add URLs to the database.
+        '''Queue the URLs for insertion into the database.
 
-        Assumes database is open. Assumes url_list exists.
+        The URLs are as returned by crawl_for_links(), already in canonical
+        form. URLs already known, including those repeated within url_list,
+        are caught by the filter and never reach the database; any others
+        that are duplicates are ignored by the database (INSERT OR IGNORE on
+        the UNIQUE url column) and counted in count_written() once the batch
+        is written. Assumes self.writer exists. Assumes url_list exists.
         '''
         for url in url_list:
-            if url:
-                # Strip irrelevant reference from URL end; always follows ?
-                url = url.split('?')[0]
-                # If relative URL, add prefix
-                url = self.ensure_whole_url(url)
+            if url and self.is_known(url):
+                self.count_filtered_urls += 1
+                self.count_discarded_urls += 1
+                metrics.count('links_known')
+                metrics.progress('|')
+            elif url:
+                if self.seen is not None and not self.seen.exact:
+                    self.queued_urls.add(url)
                 # insert (uniquely only) into db
-                try:
-                    self.cursor = self.cursor.execute(
-                            '''INSERT INTO urls (url, date_url_added)
-                            VALUES (?, ?)''',
-                            (url, self.now) )
-                    self.total_links_added += 1
-                    print('.', end='')
-                except Exception as e:
-                    logging.error(str(e) + ' with URL = ' + url)
-                    self.count_discarded_urls += 1
-                    print('|', end='')
-                finally:
-                    # flush output, since we have had a problem with this
-                    sys.stdout.flush()
+                self.writer.add('link', '''INSERT OR IGNORE INTO urls
+                        (url, date_url_added) VALUES (?, ?)''',
+                        (url, self.now) )
             else:
                 self.count_discarded_urls += 1
 
+    def count_written(self, kind, submitted, changed):
+        '''Tally the outcome of a batch of database writes.'''
+        if kind == 'link':
+            self.queued_urls.clear()
+            self.total_links_added += changed
+            self.count_discarded_urls += submitted - changed
+            metrics.count('links_added', changed)
+            metrics.count('links_known', submitted - changed)
+            metrics.progress('.' * changed + '|' * (submitted - changed))
+            # flush output, since we have had a problem with this
+            sys.stdout.flush()
+        elif kind == 'crawled':
+            self.count_crawled_pages += changed
+            metrics.count('pages_crawled', changed)
+            self.count_discarded_urls += submitted - changed
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    utils.add_logging_flags(parser)
+    utils.add_site_flags(parser)
+    parser.add_argument('--batch-size', type=int,
+                        default=db_writer.default_batch_size,
+                        help='database writes per transaction '
+                             '(default {})'.format(db_writer.default_batch_size))
+    parser.add_argument('--flush-interval', type=float,
+                        default=db_writer.default_flush_interval,
+                        help='maximum seconds between commits '
+                             '(default {})'.format(
+                                 db_writer.default_flush_interval))
+    parser.add_argument('-p', '--processes', type=int,
+                        default=default_processes,
+                        help='number of processes reading and crawling '
+                             'pages (default {}; 1 to work serially)'
+                             .format(default_processes))
+    parser.add_argument('--extractor', choices=sorted(link_extractors.backends),
+                        default=link_extractors.default_backend,
+                        help='how links are found in pages: fast single-pass '
+                             'scanner or full BeautifulSoup parse (default {})'
+                             .format(link_extractors.default_backend))
+    url_filter.add_filter_flags(parser)
+    metrics.add_metrics_flags(parser)
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
-    main(sys.argv[-1])
+    arguments = parse_arguments()
+    set_site(arguments.site, arguments.start_url)
+    with metrics.session('link_collector', arguments):
+        main(arguments.logging_flag, arguments.batch_size,
+             arguments.flush_interval, arguments.processes,
+             arguments.extractor, arguments.url_filter,
+             arguments.filter_error_rate, arguments.filter_memory)
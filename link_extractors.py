@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# link_extractors.py
+'''Extract the links we follow, <a href="/view...">, from page contents.
+
+Two backends:
+
+    'fast'  scans the page once with html.parser, keeping only the href of
+            each matching <a> tag; no tree is built.
+    'soup'  builds a BeautifulSoup tree and selects a[href^="/view"], as the
+            crawler always did.
+
+The fast backend falls back to BeautifulSoup for pages it cannot handle
+(undecodable or badly broken markup).
+
+Run as a script to check that both backends, and the scanner that reads
+pages as they are downloaded (see ingest.py), find the same links in every
+page stored in CRAWLED_PAGES/ (or in the directory given), in pack files or
+one per file.
+'''
+
+import sys
+import html.parser
+import logging
+
+import bs4
+
+import compression
+
+link_prefix = '/view'
+default_backend = 'fast'
+
+class HrefScanner(html.parser.HTMLParser):
+    '''Collect the href of every <a> tag whose href starts with prefix.'''
+    def __init__(self, prefix=link_prefix):
+        super().__init__(convert_charrefs=True)
+        self.prefix = prefix
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            # As in BeautifulSoup, a repeated attribute keeps its last value.
+            href = dict(attrs).get('href')
+            if href is not None and href.startswith(self.prefix):
+                self.links.append(href)
+
+    handle_startendtag = handle_starttag
+
+def extract_with_soup(page_contents, prefix=link_prefix):
+    soup = bs4.BeautifulSoup(page_contents)
+    return [tag.attrs['href']
+            for tag in soup.select('a[href^="{}"]'.format(prefix))]
+
+def extract_fast(page_contents, prefix=link_prefix):
+    if isinstance(page_contents, bytes):
+        try:
+            page_contents = page_contents.decode('utf-8')
+        except UnicodeDecodeError:
+            # Let BeautifulSoup work out the encoding.
+            return extract_with_soup(page_contents, prefix)
+    scanner = HrefScanner(prefix)
+    try:
+        scanner.feed(page_contents)
+        scanner.close()
+    except Exception as e:
+        logging.warning(str(e) + ' in fast link extraction; using soup')
+        return extract_with_soup(page_contents, prefix)
+    return scanner.links
+
+backends = {'fast': extract_fast,
+            'soup': extract_with_soup}
+
+def extract_links(page_contents, backend=default_backend):
+    '''Return the hrefs of links to follow in page_contents, in order.'''
+    return backends[backend](page_contents)
+
+def check_parity(directory='CRAWLED_PAGES'):
+    '''Compare the backends and the ingest scanner with the soup backend on
+    every saved page; return (pages compared, pages on which they
+    disagree).'''
+    # Imported here, since ingest.py imports this module.
+    import ingest
+    extractors = dict(backends, ingest=ingest.extract_links)
+    count_pages = count_differing = 0
+    for hash, page_contents in compression.iterate_corpus(directory):
+        count_pages += 1
+        results = {name: set(extract(page_contents) or ())
+                   for name, extract in extractors.items()}
+        differing = [name for name in extractors
+                     if results[name] != results['soup']]
+        if differing:
+            count_differing += 1
+        for name in differing:
+            print('{0}: only {1} {2}; only soup {3}'.format(
+                    hash, name, sorted(results[name] - results['soup']),
+                    sorted(results['soup'] - results[name])))
+    print('{0}/{1} pages with identical link sets.'.format(
+            count_pages - count_differing, count_pages))
+    return count_pages, count_differing
+
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'CRAWLED_PAGES'
+    count_pages, count_differing = check_parity(directory)
+    if not count_pages:
+        sys.exit('No pages found in {}.'.format(directory))
+    sys.exit(1 if count_differing else 0)
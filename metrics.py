@@ -0,0 +1,310 @@
+# metrics.py
+'''Counters, latency histograms and queue depths for the crawling tools.
+
+The tools record into the module-level registry:
+
+    metrics.count('pages_saved')
+    with metrics.timer('fetch'):
+        ...
+    metrics.gauge('fetch_queue', fetch_queue.qsize)
+
+A session, opened around a tool's main(), can
+
+    show a live line of rates and latencies in place of the stream of
+    . and | (--live);
+    export everything every few seconds to a local file, as JSON lines or
+    in the Prometheus text format (--metrics-file, --metrics-format);
+    profile the run with cProfile (--profile) or trace memory allocations
+    with tracemalloc (--trace-memory).
+
+At the end of a session a table of stage latencies is printed.
+'''
+
+import os
+import sys
+import json
+import time
+import pstats
+import bisect
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+default_interval = 10.0
+live_interval = 1.0
+formats = ('json', 'prometheus')
+prometheus_prefix = 'slithersentence_'
+# Histogram bucket upper bounds, in seconds: 0.1 ms doubling to about 100 s.
+bucket_bounds = [0.0001 * 2 ** i for i in range(21)]
+
+class Histogram(object):
+    '''Counts of observations in exponential buckets.'''
+    def __init__(self):
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(bucket_bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        '''Return the upper bound of the bucket holding the given fraction
+        of observations.'''
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(bucket_bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.percentile(0.5), 'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99), 'max': self.max}
+
+class Registry(object):
+    '''Named counters, histograms and gauges; safe across threads.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        # name -> function returning the current value
+        self.gauges = {}
+        self.start_time = time.time()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def gauge(self, name, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        '''Return the present values, as a dict ready for JSON.'''
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.summary()
+                          for name, histogram in self.histograms.items()}
+            gauges = dict(self.gauges)
+        values = {}
+        for name, function in gauges.items():
+            try:
+                values[name] = function()
+            except Exception:
+                values[name] = None
+        return {'time': time.time(),
+                'elapsed': time.time() - self.start_time,
+                'counters': counters, 'gauges': values,
+                'histograms': histograms}
+
+    def prometheus(self):
+        '''Return the present values in the Prometheus text format.'''
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metric = prometheus_prefix + name + '_total'
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{0} {1}'.format(metric, value))
+            for name, histogram in sorted(self.histograms.items()):
+                metric = prometheus_prefix + name + '_seconds'
+                lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, count in zip(bucket_bounds, histogram.buckets):
+                    cumulative += count
+                    lines.append('{0}_bucket{{le="{1:g}"}} {2}'.format(
+                            metric, bound, cumulative))
+                lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(
+                        metric, histogram.count))
+                lines.append('{0}_sum {1}'.format(metric, histogram.sum))
+                lines.append('{0}_count {1}'.format(metric, histogram.count))
+        for name, value in sorted(self.snapshot()['gauges'].items()):
+            if value is not None:
+                metric = prometheus_prefix + name
+                lines.append('# TYPE {} gauge'.format(metric))
+                lines.append('{0} {1}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+count = registry.count
+observe = registry.observe
+timer = registry.timer
+gauge = registry.gauge
+
+# Set while a session shows the live line; progress marks are then not
+# printed.
+live = False
+
+def progress(marks):
+    '''Print progress marks (. | - ~), unless the live line is showing.'''
+    if not live and marks:
+        print(marks, end='')
+
+def rate_line(snapshot, previous):
+    '''Return the live line: counter rates since previous, queue depths and
+    median latencies.'''
+    elapsed = snapshot['time'] - previous['time'] if previous else 0
+    parts = ['{:.0f}s'.format(snapshot['elapsed'])]
+    for name, value in sorted(snapshot['counters'].items()):
+        last = previous['counters'].get(name, 0) if previous else value
+        rate = (value - last) / elapsed if elapsed else 0.0
+        parts.append('{0} {1} ({2:.1f}/s)'.format(name, value, rate))
+    for name, value in sorted(snapshot['gauges'].items()):
+        parts.append('{0} {1}'.format(name, value))
+    for name, summary in sorted(snapshot['histograms'].items()):
+        parts.append('{0} p50 {1:.0f}ms'.format(name, 1000 * summary['p50']))
+    return ' | '.join(parts)
+
+class Reporter(threading.Thread):
+    '''Show the live line and export metrics to a file, periodically.'''
+    def __init__(self, show_live=False, path=None, format='json',
+                 interval=default_interval):
+        super().__init__()
+        self.daemon = True
+        self.show_live = show_live
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.previous = None
+        self.last_export = 0
+        self.width = 0
+
+    def run(self):
+        tick = live_interval if self.show_live else self.interval
+        while not self.stopping.wait(tick):
+            self.report()
+
+    def report(self, final=False):
+        snapshot = registry.snapshot()
+        if self.show_live:
+            line = rate_line(snapshot, self.previous)
+            # Pad to blank out the rest of a longer line before.
+            sys.stdout.write('\r' + line.ljust(self.width))
+            sys.stdout.flush()
+            self.width = len(line)
+            self.previous = snapshot
+        if self.path and (final or
+                          snapshot['time'] - self.last_export >= self.interval):
+            self.export(snapshot)
+            self.last_export = snapshot['time']
+
+    def export(self, snapshot):
+        if self.format == 'prometheus':
+            # The file always holds the latest values, as a textfile
+            # collector expects.
+            with open(self.path + '.tmp', 'w') as file_object:
+                file_object.write(registry.prometheus())
+            os.replace(self.path + '.tmp', self.path)
+        else:
+            with open(self.path, 'a') as file_object:
+                file_object.write(json.dumps(snapshot, sort_keys=True) + '\n')
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+        self.report(final=True)
+        if self.show_live:
+            print()
+
+def print_latencies():
+    '''Print a table of the stage latencies recorded.'''
+    histograms = registry.snapshot()['histograms']
+    if not histograms:
+        return
+    print('\nStage latency (ms)')
+    print('    {:<16} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+            'stage', 'count', 'mean', 'p50', 'p95', 'max'))
+    for name, summary in sorted(histograms.items()):
+        print('    {:<16} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                name, summary['count'], 1000 * summary['mean'],
+                1000 * summary['p50'], 1000 * summary['p95'],
+                1000 * summary['max']))
+
+@contextlib.contextmanager
+def session(app_name, arguments):
+    '''Run the body with the reporting and profiling asked for in arguments
+    (see add_metrics_flags()).'''
+    global live
+    live = arguments.live
+    reporter = None
+    if arguments.live or arguments.metrics_file:
+        reporter = Reporter(arguments.live, arguments.metrics_file,
+                            arguments.metrics_format,
+                            arguments.metrics_interval)
+        reporter.start()
+    profiler = cProfile.Profile() if arguments.profile else None
+    if arguments.trace_memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        if arguments.trace_memory:
+            # Taken before anything is reported, so that the report's own
+            # allocations are not counted.
+            current, peak = tracemalloc.get_traced_memory()
+            statistics = tracemalloc.take_snapshot().statistics('lineno')
+            tracemalloc.stop()
+        if reporter:
+            reporter.stop()
+        live = False
+        print_latencies()
+        if profiler:
+            profiler.dump_stats(app_name + '.prof')
+            print('\nProfile saved to {}.prof; top functions by '
+                  'cumulative time:'.format(app_name))
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        if arguments.trace_memory:
+            print('\nMemory: {0:.1f} MB allocated now, {1:.1f} MB at peak. '
+                  'Largest allocations by line:'.format(current / 2**20,
+                                                        peak / 2**20))
+            for statistic in statistics[:10]:
+                print('    ' + str(statistic))
+
+def add_metrics_flags(parser):
+    '''Add the metrics and profiling switches to an argparse parser.'''
+    parser.add_argument('--live', action='store_true',
+                        help='show a live line of rates and latencies '
+                             'instead of . and |')
+    parser.add_argument('--metrics-file',
+                        help='export metrics periodically to this file')
+    parser.add_argument('--metrics-format', choices=formats, default='json',
+                        help='JSON lines, appended, or Prometheus text, '
+                             'rewritten (default json)')
+    parser.add_argument('--metrics-interval', type=float,
+                        default=default_interval,
+                        help='seconds between exports (default {:g})'
+                             .format(default_interval))
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the main thread with cProfile (worker '
+                             'threads and processes are not profiled)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='trace memory allocations with tracemalloc')
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# neardup.py
+'''Near-duplicate page detection with SimHash.
+
+Pages that differ only in advertisements, timestamps or blocks of related
+links have different MD5 hashes but the same main text. Each content page
+is given a 64-bit SimHash fingerprint of the character shingles of its main
+text (the blocks sentence_extractor.py would take sentences from); pages
+whose fingerprints differ in at most max_distance bits are near duplicates.
+
+Fingerprints are kept in the page_fingerprints table of the crawl database
+and loaded into an in-memory LSH index when the downloader starts. The
+fingerprint is cut into max_distance + 1 bands; two fingerprints within
+max_distance bits agree exactly on at least one band, so only pages sharing
+a band are compared.
+
+Run as a script to fingerprint the pages downloaded before this existed:
+
+    python neardup.py build [--site NAME]
+'''
+
+import sys
+import hashlib
+import argparse
+import threading
+import collections
+
+import utils
+import crawl_db
+import db_writer
+import link_collector
+import sentence_extractor
+
+bits = 64
+default_max_distance = 3
+# Characters per shingle.
+shingle_size = 4
+# Pages with less main text than this are not fingerprinted: there is too
+# little to tell them apart.
+min_text_chars = 100
+# What to do with a near duplicate: 'flag' stores it and collects its links
+# but marks it content_useful=0, so no sentences are taken from it; 'skip'
+# does not store it at all; 'off' does not look for near duplicates.
+modes = ('flag', 'skip', 'off')
+default_mode = 'flag'
+
+def main_text(page_contents):
+    '''Return the main text of a page, without white space.'''
+    return join_blocks(sentence_extractor.content_blocks(page_contents))
+
+def join_blocks(blocks):
+    return ''.join(''.join(block.split()) for block in blocks)
+
+def simhash(text):
+    '''Return the 64-bit SimHash of the shingles of text, or None if text is
+    too short.'''
+    if len(text) < min_text_chars:
+        return None
+    shingles = collections.Counter(text[i:i + shingle_size] for i in
+                                   range(len(text) - shingle_size + 1))
+    features = [(int.from_bytes(hashlib.blake2b(
+                    shingle.encode('utf-8'), digest_size=8).digest(),
+                    'little'), weight)
+                for shingle, weight in shingles.items()]
+    fingerprint = 0
+    for bit in range(bits):
+        mask = 1 << bit
+        balance = sum(weight if feature & mask else -weight
+                      for feature, weight in features)
+        if balance > 0:
+            fingerprint |= mask
+    return fingerprint
+
+def fingerprint_page(page_contents):
+    return simhash(main_text(page_contents))
+
+def fingerprint_blocks(blocks):
+    '''Return the fingerprint of a page from its content blocks (see
+    sentence_extractor.content_blocks()).'''
+    return simhash(join_blocks(blocks))
+
+def distance(first, second):
+    return bin(first ^ second).count('1')
+
+def to_signed(fingerprint):
+    '''SQLite integers are signed.'''
+    return fingerprint - (1 << bits) if fingerprint >= 1 << (bits - 1) \
+            else fingerprint
+
+def to_unsigned(fingerprint):
+    return fingerprint & ((1 << bits) - 1)
+
+class NearDuplicateIndex(object):
+    '''Fingerprints of the pages seen, banded for lookup; safe across
+    threads.'''
+    def __init__(self, max_distance=default_max_distance):
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = bits // self.bands
+        # One dict per band: band value -> [(fingerprint, page hash)]
+        self.tables = [collections.defaultdict(list)
+                       for i in range(self.bands)]
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def band_values(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (i * self.band_bits)) & mask
+                for i in range(self.bands)]
+
+    def find(self, fingerprint):
+        '''Return the hash of a page near fingerprint, or None.'''
+        for table, value in zip(self.tables, self.band_values(fingerprint)):
+            for other, hash in table.get(value, ()):
+                if distance(fingerprint, other) <= self.max_distance:
+                    return hash
+        return None
+
+    def add(self, fingerprint, hash):
+        for table, value in zip(self.tables, self.band_values(fingerprint)):
+            table[value].append((fingerprint, hash))
+        self.count += 1
+
+    def check_and_add(self, fingerprint, hash):
+        '''Return the hash of an earlier page near fingerprint; if there is
+        none, add this page and return None.
+
+        A page with the same hash is not a near duplicate of itself.
+        '''
+        with self.lock:
+            near = self.find(fingerprint)
+            if near is None:
+                self.add(fingerprint, hash)
+            return None if near == hash else near
+
+    def load(self, connection):
+        '''Fill the index from the page_fingerprints table.'''
+        with self.lock:
+            for hash, fingerprint in connection.execute(
+                    'SELECT hash, simhash FROM page_fingerprints'):
+                self.add(to_unsigned(fingerprint), hash)
+
+def record_fingerprint(writer, hash, fingerprint):
+    '''Queue a page's fingerprint for the database.'''
+    writer.add('fingerprint', '''INSERT OR IGNORE INTO page_fingerprints
+            (hash, simhash) VALUES (?, ?)''', (hash, to_signed(fingerprint)))
+
+def build(max_distance=default_max_distance):
+    '''Fingerprint the stored content pages that have no fingerprint yet,
+    flagging those near an earlier page as the downloader would; return
+    (pages fingerprinted, near duplicates found among them).'''
+    reader = link_collector.LinkCollector()
+    connection = crawl_db.connect(link_collector.url_core)
+    index = NearDuplicateIndex(max_distance)
+    index.load(connection)
+    writer = db_writer.BatchWriter(connection)
+    count_pages = count_near = 0
+    rows = connection.execute('''SELECT hash FROM urls
+            WHERE to_be_crawled_for_content = 1 AND hash IS NOT NULL
+            AND content_useful IS NOT 0
+            AND hash NOT IN (SELECT hash FROM page_fingerprints)''').fetchall()
+    for (hash,) in rows:
+        page_contents = reader.read_page(hash, 1)
+        fingerprint = (fingerprint_page(page_contents) if page_contents
+                       else None)
+        if fingerprint is None:
+            continue
+        count_pages += 1
+        if index.check_and_add(fingerprint, hash):
+            count_near += 1
+            # As the downloader would have flagged it.
+            writer.add('near_duplicate', '''UPDATE urls
+                    SET content_useful=0, date_extracted=?
+                    WHERE hash=? AND date_extracted IS NULL''',
+                    (utils.timestamp(), hash))
+            print('|', end='')
+        else:
+            record_fingerprint(writer, hash, fingerprint)
+            print('.', end='')
+        sys.stdout.flush()
+    writer.flush()
+    connection.close()
+    reader.store.close()
+    return count_pages, count_near
+
+def add_near_duplicate_flags(parser):
+    '''Add the near-duplicate switches to an argparse parser.'''
+    parser.add_argument('--near-duplicates', choices=modes,
+                        default=default_mode,
+                        help='flag pages nearly the same as one already '
+                             'stored as content_useful=0, skip them, or do '
+                             'not look (default {})'.format(default_mode))
+    parser.add_argument('--simhash-distance', type=int,
+                        default=default_max_distance,
+                        help='most fingerprint bits in which near duplicates '
+                             'differ (default {})'.format(
+                                 default_max_distance))
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser(
+            'build', help='fingerprint pages downloaded without one')
+    utils.add_site_flags(build_parser)
+    build_parser.add_argument('--simhash-distance', type=int,
+                              default=default_max_distance,
+                              help='most fingerprint bits in which near '
+                                   'duplicates differ (default {})'.format(
+                                       default_max_distance))
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == 'build':
+        link_collector.set_site(arguments.site, arguments.start_url)
+        pages, near = build(arguments.simhash_distance)
+        print('\n{0} pages fingerprinted; {1} near duplicates of earlier '
+              'pages.'.format(pages, near))
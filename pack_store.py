@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# pack_store.py
+'''Append-only pack-file store for downloaded pages.
+
+Instead of one file per page, compressed pages are appended to a single pack
+file, CRAWLED_PAGES/<url_core>.pack. A second file, <url_core>.idx, lists
+for every page its hash, the offset and length of its data in the pack and
+the number of the codec it was compressed with (see compression.py); the
+index is read into a dict when the store is opened, and pages are read
+through an mmap of the pack.
+
+Both files are only ever appended to, data before index, so a crash can at
+worst leave data that no index record points to. Appends take an exclusive
+lock on the index file, so several processes may share a store.
+
+Run as a script to move pages saved one per file into the pack:
+
+    python pack_store.py migrate [--delete] [directory]
+'''
+
+import os
+import re
+import sys
+import mmap
+import fcntl
+import struct
+import argparse
+import threading
+
+default_directory = 'CRAWLED_PAGES'
+default_name = 'worldjournal'
+# Version 1 indexes have no codec; all their pages are bz2, codec 1. They
+# are rewritten as version 2 when opened.
+index_headers = {1: b'SLSIDX\x01\n', 2: b'SLSIDX\x02\n'}
+index_header = index_headers[2]
+# hash as 32 hex digits, offset, length, codec
+index_record = struct.Struct('<32sQQB')
+index_record_v1 = struct.Struct('<32sQQ')
+legacy_codec = 1
+page_filename = re.compile(r'^(?P<core>.+?)_(?:base_page_)?'
+                           r'(?P<hash>[0-9a-f]{32})\.bz2$')
+
+class PackStore(object):
+    '''Pages stored by hash in one pack file, with an offset index.'''
+    def __init__(self, directory=default_directory, name=default_name):
+        self.pack_path = os.path.join(directory, name + '.pack')
+        self.index_path = os.path.join(directory, name + '.idx')
+        self.lock = threading.Lock()
+        # hash -> (offset, length, codec)
+        self.index = {}
+        self.index_position = 0
+        self.map = None
+        self.pack = open(self.pack_path, 'ab+')
+        self.index_file = open(self.index_path, 'ab+')
+        with self.lock:
+            fcntl.flock(self.index_file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.index_file.fileno()).st_size == 0:
+                    self.index_file.write(index_header)
+                    self.index_file.flush()
+                self.index_file.seek(0)
+                header = self.index_file.read(len(index_header))
+                if header == index_headers[1]:
+                    self.upgrade_index()
+                self.refresh()
+            finally:
+                fcntl.flock(self.index_file, fcntl.LOCK_UN)
+
+    def upgrade_index(self):
+        '''Rewrite a version 1 index as version 2, with codec bz2 for every
+        page. Assumes the index lock is held.
+
+        Processes that still have the old index open do not see the new
+        one, so this should happen while no crawler is running.
+        '''
+        self.index_file.seek(len(index_headers[1]))
+        data = self.index_file.read()
+        count = len(data) // index_record_v1.size
+        upgraded_path = self.index_path + '.upgrade'
+        with open(upgraded_path, 'wb') as upgraded:
+            upgraded.write(index_header)
+            for hash, offset, length in index_record_v1.iter_unpack(
+                    data[:count * index_record_v1.size]):
+                upgraded.write(index_record.pack(hash, offset, length,
+                                                 legacy_codec))
+        os.replace(upgraded_path, self.index_path)
+        # Keep the lock on the new file while we read it.
+        old_index_file = self.index_file
+        self.index_file = open(self.index_path, 'ab+')
+        fcntl.flock(self.index_file, fcntl.LOCK_EX)
+        fcntl.flock(old_index_file, fcntl.LOCK_UN)
+        old_index_file.close()
+
+    def refresh(self):
+        '''Read index records added since we last looked, possibly by
+        another process.'''
+        self.index_file.seek(self.index_position or 0)
+        if not self.index_position:
+            if self.index_file.read(len(index_header)) != index_header:
+                raise ValueError('not a page index: ' + self.index_path)
+            self.index_position = len(index_header)
+        data = self.index_file.read()
+        # A partly written record at the end is left for next time.
+        count = len(data) // index_record.size
+        for hash, offset, length, codec in index_record.iter_unpack(
+                data[:count * index_record.size]):
+            self.index[hash.decode('ascii')] = (offset, length, codec)
+        self.index_position += count * index_record.size
+
+    def __contains__(self, hash):
+        return self.locate(hash) is not None
+
+    def locate(self, hash):
+        with self.lock:
+            if hash not in self.index:
+                self.refresh()
+            return self.index.get(hash)
+
+    def put(self, hash, data, codec):
+        '''Append data, compressed with codec (a number), under hash, unless
+        the store has it already.
+
+        Return True if the data was written.
+        '''
+        with self.lock:
+            fcntl.flock(self.index_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if hash in self.index:
+                    return False
+                offset = self.pack.seek(0, os.SEEK_END)
+                self.pack.write(data)
+                self.pack.flush()
+                self.index_file.seek(0, os.SEEK_END)
+                self.index_file.write(index_record.pack(
+                        hash.encode('ascii'), offset, len(data), codec))
+                self.index_file.flush()
+                self.index[hash] = (offset, len(data), codec)
+                self.index_position += index_record.size
+                return True
+            finally:
+                fcntl.flock(self.index_file, fcntl.LOCK_UN)
+
+    def get(self, hash):
+        '''Return (codec, data) stored under hash, or (None, None).'''
+        location = self.locate(hash)
+        if location is None:
+            return None, None
+        offset, length, codec = location
+        return codec, self.read(offset, length)
+
+    def read(self, offset, length):
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                # The pack has grown since it was mapped.
+                if self.map is not None:
+                    self.map.close()
+                self.map = mmap.mmap(self.pack.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            return self.map[offset:offset + length]
+
+    def __iter__(self):
+        '''Yield (hash, codec, data) for every page, in the order of the
+        pack.'''
+        with self.lock:
+            self.refresh()
+            locations = sorted(self.index.items(), key=lambda item: item[1])
+        for hash, (offset, length, codec) in locations:
+            yield hash, codec, self.read(offset, length)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.pack.close()
+            self.index_file.close()
+
+def migrate(directory=default_directory, delete=False):
+    '''Move pages saved one per file in directory into pack stores, one per
+    url_core; return the number of pages moved.'''
+    stores = {}
+    count_moved = 0
+    for filename in sorted(os.listdir(directory)):
+        match = page_filename.match(filename)
+        if not match:
+            continue
+        core = match.group('core')
+        if core not in stores:
+            stores[core] = PackStore(directory, core)
+        path = os.path.join(directory, filename)
+        with open(path, 'rb') as file_object:
+            data = file_object.read()
+        stores[core].put(match.group('hash'), data, legacy_codec)
+        count_moved += 1
+        if delete:
+            os.remove(path)
+        print('.', end='')
+        sys.stdout.flush()
+    for store in stores.values():
+        store.close()
+    print('\n{} pages moved into pack files.'.format(count_moved))
+    return count_moved
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser(
+            'migrate', help='move pages saved one per file into pack files')
+    migrate_parser.add_argument('directory', nargs='?',
+                                default=default_directory)
+    migrate_parser.add_argument('--delete', action='store_true',
+                                help='remove each file once it is packed')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == 'migrate':
+        migrate(arguments.directory, arguments.delete)
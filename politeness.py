@@ -0,0 +1,258 @@
+# politeness.py
+'''Per-host politeness: rate limits, concurrency caps and robots.txt.
+
+Every host gets a token bucket, refilled at rate requests a second and
+holding at most burst tokens, and a cap on the number of its requests in
+progress at once. A host's robots.txt can only lower its rate, through
+Crawl-delay or Request-rate, and URLs it disallows are not fetched. Copies
+of robots.txt are kept in ROBOTS/ and fetched again once a day old.
+
+Limits are per host, so total throughput grows with the number of hosts
+while each host sees a bounded load. Processes that crawl side by side each
+take a share of every limit, those from robots.txt too, so that between
+them they keep to it. interleave() orders URLs round-robin by host, so that
+the workers are not all held up waiting on one host.
+'''
+
+import os
+import time
+import logging
+import threading
+import contextlib
+import collections
+import urllib.error
+import urllib.parse
+import urllib.robotparser
+
+# Requests a second, and the most allowed in a burst, for each host.
+default_rate = 4.0
+default_burst = 4
+# Requests in progress at once, for each host.
+default_concurrency = 4
+default_robots_directory = 'ROBOTS'
+robots_max_age = 24 * 3600
+# How far ahead interleave() looks for URLs of other hosts.
+default_window = 1000
+# Error recorded for URLs that robots.txt disallows.
+disallowed = 'disallowed by robots.txt'
+# What a robots.txt that refuses us (401 or 403) amounts to.
+disallow_all = 'User-agent: *\nDisallow: /\n'
+
+def host_of(url):
+    '''Return (scheme, netloc) of url, the key for per-host limits.'''
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme, parts.netloc.lower()
+
+def interleave(items, window=default_window, key=host_of):
+    '''Yield items round-robin by host (key(item)), looking no more than
+    window items ahead. The order within each host is kept.'''
+    items = iter(items)
+    queues = collections.OrderedDict()
+    buffered = 0
+    exhausted = False
+    while True:
+        while not exhausted and buffered < window:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            queues.setdefault(key(item), collections.deque()).append(item)
+            buffered += 1
+        if not queues:
+            return
+        # One item from each host in turn.
+        for host in list(queues):
+            yield queues[host].popleft()
+            buffered -= 1
+            if not queues[host]:
+                del queues[host]
+
+def share_of(rate, share):
+    '''Return the part of a per-host rate of process K of N, for share
+    (K, N), or the whole rate for share None. No limit (0) stays so.'''
+    if share is None or not rate:
+        return rate
+    return rate / share[1]
+
+def slots_of(count, share):
+    '''Return the part of a per-host count (of slots or of tokens) of
+    process K of N, for share (K, N): as even as can be, the first count % N
+    processes taking one more, so that the parts add up to count.'''
+    if share is None:
+        return count
+    index, processes = share
+    return count // processes + (1 if index < count % processes else 0)
+
+class TokenBucket(object):
+    '''Allow rate events a second on average, and up to burst at once.'''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''Take a token, waiting for it if need be; return seconds waited.
+
+        Tokens may be owed: each caller reserves its place in line and
+        sleeps outside the lock until its token is due.
+        '''
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class RobotsCache(object):
+    '''robots.txt rules for each host, from copies kept on disk.'''
+    def __init__(self, http, directory=default_robots_directory,
+                 max_age=robots_max_age):
+        self.http = http
+        self.user_agent = http.user_agent
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, scheme, netloc):
+        return os.path.join(self.directory, '{0}_{1}.txt'.format(
+                scheme, netloc.replace(':', '_')))
+
+    def rules(self, scheme, netloc):
+        '''Return a RobotFileParser for the host, from the cached copy if it
+        is fresh enough, else fetched anew. If it cannot be fetched, a stale
+        copy is used; with none, everything is allowed.'''
+        path = self.path(scheme, netloc)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            age = None
+        text = None
+        if age is None or age > self.max_age:
+            text = self.fetch(scheme, netloc)
+            if text is not None:
+                with open(path + '.tmp', 'w', encoding='utf-8') as file_object:
+                    file_object.write(text)
+                os.replace(path + '.tmp', path)
+        if text is None and age is not None:
+            with open(path, encoding='utf-8') as file_object:
+                text = file_object.read()
+        rules = urllib.robotparser.RobotFileParser()
+        rules.parse((text or '').splitlines())
+        return rules
+
+    def fetch(self, scheme, netloc):
+        '''Return the text of the host's robots.txt, or None on failure.'''
+        url = '{0}://{1}/robots.txt'.format(scheme, netloc)
+        try:
+            response = self.http.get(url)
+        except urllib.error.HTTPError as e:
+            # As urllib.robotparser does: refused means keep out; missing
+            # means no rules.
+            if e.code in (401, 403):
+                return disallow_all
+            if 400 <= e.code < 500:
+                return ''
+            logging.warning(str(e) + ' with URL = ' + url)
+            return None
+        except urllib.error.URLError as e:
+            logging.warning(str(e) + ' with URL = ' + url)
+            return None
+        return response.read().decode('utf-8', 'replace')
+
+class Host(object):
+    '''Limits on requests to one host.'''
+    def __init__(self, rate, burst, concurrency):
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.rules = None
+        # Held while robots.txt is read, the first time the host is used.
+        self.lock = threading.Lock()
+        self.ready = False
+
+class HostScheduler(object):
+    '''Hand out per-host permission to make requests; safe across threads.
+
+    With robots (a RobotsCache), each host's robots.txt is read the first
+    time the host is seen. With share (K, N), this is process K of N sharing
+    the limits, and keeps to its share of each.
+    '''
+    def __init__(self, rate=default_rate, concurrency=default_concurrency,
+                 robots=None, burst=default_burst, share=None):
+        if share is not None and concurrency < share[1]:
+            raise ValueError('a concurrency of {0} cannot be shared by {1} '
+                             'processes'.format(concurrency, share[1]))
+        self.share = share
+        self.rate = share_of(rate, share)
+        self.burst = slots_of(burst, share)
+        self.concurrency = slots_of(concurrency, share)
+        self.robots = robots
+        self.hosts = {}
+        self.lock = threading.Lock()
+        # Counters
+        self.wait_time = 0
+        self.count_disallowed = 0
+
+    def host(self, url):
+        key = host_of(url)
+        with self.lock:
+            host = self.hosts.get(key)
+            if host is None:
+                host = self.hosts[key] = Host(self.rate, self.burst,
+                                              self.concurrency)
+        if not host.ready:
+            with host.lock:
+                if not host.ready:
+                    self.read_robots(host, *key)
+                    host.ready = True
+        return host
+
+    def read_robots(self, host, scheme, netloc):
+        '''Apply the host's robots.txt to its limits.'''
+        if self.robots is None:
+            return
+        host.rules = self.robots.rules(scheme, netloc)
+        rate = None
+        delay = host.rules.crawl_delay(self.robots.user_agent)
+        if delay:
+            rate = 1 / float(delay)
+        request_rate = host.rules.request_rate(self.robots.user_agent)
+        if request_rate and request_rate.seconds:
+            rate = min(rate or float('inf'),
+                       request_rate.requests / request_rate.seconds)
+        rate = share_of(rate, self.share)
+        if rate and (not self.rate or rate < self.rate):
+            logging.info('{0}: {1:.3f} requests a second, from robots.txt'
+                         .format(netloc, rate))
+            # No burst: one request at a time, among all the processes.
+            host.bucket = TokenBucket(rate, slots_of(1, self.share))
+
+    def allowed(self, url):
+        '''Return whether robots.txt lets us fetch url.'''
+        host = self.host(url)
+        if host.rules is None or host.rules.can_fetch(self.robots.user_agent,
+                                                      url):
+            return True
+        with self.lock:
+            self.count_disallowed += 1
+        return False
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        '''Wait until a request to url's host is allowed, and hold one of
+        the host's slots while the request is made.'''
+        host = self.host(url)
+        start = time.time()
+        with host.slots:
+            host.bucket.take()
+            with self.lock:
+                self.wait_time += time.time() - start
+            yield
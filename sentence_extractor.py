@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# sentence_extractor.py
+'''Extract distinct Chinese sentences from downloaded pages.
+
+Content pages not yet extracted are read from the pack store a few at a
+time. Boilerplate is dropped: scripts, styles, navigation, headers and
+footers, forms, and blocks of text that are mostly link text or have no
+sentence punctuation. The rest is split after 。！？； into sentences.
+
+Sentences go to a database of their own, sentences_<site>.db, keyed by the
+MD5 hash of the sentence, with a row in sentence_sources for every page a
+sentence was found on. Writes are batched. A page is marked as extracted
+(date_extracted, and content_useful if it had any sentences) in the crawl
+database only once its sentences are committed, so a re-run picks up where
+the last one stopped and never misses a page.
+'''
+
+import re
+import sys
+import time
+import hashlib
+import logging
+import sqlite3
+import argparse
+import datetime
+import html.parser
+import concurrent.futures
+
+import utils
+import crawl_db
+import db_writer
+import link_collector
+import metrics
+
+default_processes = link_collector.default_processes
+# Sentences with fewer Chinese characters than this are dropped.
+default_min_chars = 4
+# Blocks with more than this share of their text inside links are menus or
+# lists of links.
+max_link_density = 0.5
+sentence_end = '。！？；'
+# A sentence runs to its end punctuation, with any closing quotes or
+# brackets that follow.
+sentence_pattern = re.compile('[^{0}]+[{0}]+[」』”’"\'）)]*'.format(
+        sentence_end))
+chinese_character = re.compile('[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+# Tags whose contents are never content.
+boilerplate_tags = {'head', 'script', 'style', 'noscript', 'template', 'nav',
+                    'header', 'footer', 'aside', 'form', 'select', 'button',
+                    'iframe', 'svg'}
+# Tags that end a block of text.
+block_tags = {'p', 'div', 'br', 'li', 'ul', 'ol', 'td', 'th', 'tr', 'table',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'article', 'section',
+              'blockquote', 'pre', 'dd', 'dt', 'main', 'body'}
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS sentences (
+        hash TEXT PRIMARY KEY,
+        sentence TEXT NOT NULL,
+        date_added INTEGER) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS sentence_sources (
+        sentence_hash TEXT NOT NULL,
+        page_hash TEXT NOT NULL,
+        PRIMARY KEY (sentence_hash, page_hash)) WITHOUT ROWID''',
+]
+
+def db_name(url_core):
+    return 'sentences_' + url_core + '.db'
+
+def connect(url_core):
+    '''Open the sentence database for url_core, creating its tables.'''
+    connection = sqlite3.connect(db_name(url_core))
+    db_writer.tune_connection(connection)
+    for statement in schema:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+class TextScanner(html.parser.HTMLParser):
+    '''Collect the blocks of text of a page outside boilerplate tags, as
+    (text, length of the text inside links).'''
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self.parts = []
+        self.link_chars = 0
+        self.skip_depth = 0
+        self.link_depth = 0
+
+    def end_block(self):
+        text = ''.join(self.parts).strip()
+        if text:
+            self.blocks.append((text, self.link_chars))
+        self.parts = []
+        self.link_chars = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in boilerplate_tags:
+            self.skip_depth += 1
+        elif tag == 'a':
+            self.link_depth += 1
+        if tag in block_tags:
+            self.end_block()
+
+    def handle_endtag(self, tag):
+        if tag in boilerplate_tags:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag == 'a':
+            self.link_depth = max(self.link_depth - 1, 0)
+        if tag in block_tags:
+            self.end_block()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in block_tags:
+            self.end_block()
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        self.parts.append(data)
+        if self.link_depth:
+            self.link_chars += len(data.strip())
+
+    def close(self):
+        super().close()
+        self.end_block()
+
+def content_blocks(page_contents):
+    '''Return the blocks of text of a page that look like content.'''
+    if isinstance(page_contents, bytes):
+        page_contents = page_contents.decode('utf-8', 'replace')
+    scanner = TextScanner()
+    scanner.feed(page_contents)
+    scanner.close()
+    return select_content_blocks(scanner.blocks)
+
+def select_content_blocks(blocks):
+    '''Return the text of the blocks, as collected by a TextScanner, that
+    look like content.'''
+    return [text for text, link_chars in blocks
+            if link_chars <= max_link_density * len(text)
+            and any(mark in text for mark in sentence_end)]
+
+def split_sentences(text, min_chars=default_min_chars):
+    '''Return the sentences in text with at least min_chars Chinese
+    characters, with runs of white space closed up.'''
+    sentences = []
+    for match in sentence_pattern.finditer(text):
+        sentence = ''.join(match.group(0).split())
+        if len(chinese_character.findall(sentence)) >= min_chars:
+            sentences.append(sentence)
+    return sentences
+
+def extract_sentences(page_contents, min_chars=default_min_chars):
+    '''Return the content sentences of a page, in order.'''
+    sentences = []
+    for text in content_blocks(page_contents):
+        sentences.extend(split_sentences(text, min_chars))
+    return sentences
+
+def sentence_hash(sentence):
+    return hashlib.md5(sentence.encode('utf-8')).hexdigest()
+
+# Each worker process reads pages with a LinkCollector of its own.
+worker_reader = None
+
+def start_worker(logging_flag, site=None, url=None):
+    global worker_reader
+    if site is not None:
+        # As in link_collector.start_worker().
+        link_collector.set_site(site, url)
+    worker_reader = link_collector.LinkCollector(logging_flag)
+
+def sentences_in_page(hash, min_chars):
+    '''Read a saved page and extract its sentences, in a worker process.
+
+    Return the sentences, or None if the page could not be read.
+    '''
+    page_contents = worker_reader.read_page(hash, 1)
+    if page_contents is None:
+        return None
+    return extract_sentences(page_contents, min_chars)
+
+class SentenceExtractor(object):
+    def __init__(self, logging_flag='',
+                 batch_size=db_writer.default_batch_size,
+                 flush_interval=db_writer.default_flush_interval,
+                 processes=1, min_chars=default_min_chars):
+        app_name = __file__.split('.')[0]
+        self.logging_flag = logging_flag
+        utils.set_up_logger(app_name, logging_flag)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.processes = processes
+        self.min_chars = min_chars
+        self.reader = None
+        self.writer = None
+        self.page_writer = None
+        # Counters
+        self.count_pages = 0
+        self.count_useful_pages = 0
+        self.count_unreadable_pages = 0
+        self.count_sentences = 0
+        self.count_new_sentences = 0
+        # Timers
+        self.start_time = time.time()
+
+    def summarize_run(self):
+        '''Summarize the main events of this extraction run.'''
+        elapsed = time.time() - self.start_time
+        indent = ' ' * 4
+        print('\n\nTiming')
+        print(indent + 'Time elapsed: {}.'.format(
+                str(datetime.timedelta(seconds=elapsed))))
+        print(indent + '{0:.1f} pages/sec; {1:.1f} sentences/sec.'.format(
+                self.count_pages / max(elapsed, 1e-9),
+                self.count_sentences / max(elapsed, 1e-9)))
+        print('Pages and sentences')
+        print(indent + '{0}/{1} pages = ({2:d}%) had sentences.'.format(
+                self.count_useful_pages, self.count_pages,
+                utils.percentage(self.count_useful_pages, self.count_pages)))
+        duplicates = self.count_sentences - self.count_new_sentences
+        print(indent + '{0} sentences found, {1} of them new; dedup ratio '
+              '{2:d}% (already known).'.format(
+                self.count_sentences, self.count_new_sentences,
+                utils.percentage(duplicates, self.count_sentences)))
+        print('Errors')
+        print(indent + '{} pages could not be read.'.format(
+                self.count_unreadable_pages))
+        connection = connect(link_collector.url_core)
+        print('{} distinct sentences in database'.format(
+                connection.execute('SELECT count(*) FROM sentences')
+                .fetchone()[0]))
+        connection.close()
+
+    def count_written(self, kind, submitted, changed):
+        '''Tally a batch of sentence writes, then mark the pages whose
+        sentences it held as extracted.'''
+        if kind == 'sentence':
+            self.count_new_sentences += changed
+            metrics.count('sentences_new', changed)
+            metrics.progress('.' * changed + '|' * (submitted - changed))
+            sys.stdout.flush()
+        # Every page marked so far has had all its sentences committed.
+        self.page_writer.flush()
+
+    def record_sentences(self, hash, sentences):
+        '''Queue the sentences of a page for the database, then the mark
+        that the page is done.'''
+        self.count_pages += 1
+        metrics.count('pages_extracted')
+        if sentences is None:
+            self.count_unreadable_pages += 1
+            return
+        now = utils.timestamp()
+        self.count_sentences += len(sentences)
+        metrics.count('sentences', len(sentences))
+        for sentence in sentences:
+            key = sentence_hash(sentence)
+            self.writer.add('sentence', '''INSERT OR IGNORE INTO sentences
+                    (hash, sentence, date_added) VALUES (?, ?, ?)''',
+                    (key, sentence, now))
+            self.writer.add('source', '''INSERT OR IGNORE INTO
+                    sentence_sources (sentence_hash, page_hash)
+                    VALUES (?, ?)''',
+                    (key, hash))
+        if sentences:
+            self.count_useful_pages += 1
+        # Written only with the next batch of sentences; see count_written().
+        self.page_writer.add('extracted', '''UPDATE urls
+                SET date_extracted=?, content_useful=?
+                WHERE hash=?''',
+                (now, 1 if sentences else 0, hash))
+
+    def extract_serially(self, hashes):
+        for hash in hashes:
+            with metrics.timer('read_page'):
+                page_contents = self.reader.read_page(hash, 1)
+            if page_contents is None:
+                self.record_sentences(hash, None)
+                continue
+            with metrics.timer('extract_sentences'):
+                sentences = extract_sentences(page_contents, self.min_chars)
+            self.record_sentences(hash, sentences)
+
+    def extract_in_parallel(self, hashes):
+        '''Read and split pages in a pool of processes; the databases are
+        written here.'''
+        with concurrent.futures.ProcessPoolExecutor(
+                self.processes, initializer=start_worker,
+                initargs=(self.logging_flag, link_collector.url_core,
+                          link_collector.start_url)) as executor:
+            for (hash, _), future in utils.run_bounded(
+                    executor, sentences_in_page,
+                    ((hash, self.min_chars) for hash in hashes),
+                    self.processes):
+                try:
+                    sentences = future.result()
+                except Exception as e:
+                    logging.error(str(e) + ' with hash = ' + hash)
+                    sentences = None
+                self.record_sentences(hash, sentences)
+
+    def extract(self):
+        print('''\nWe print . for a new sentence and | for one already '''
+              '''known:''')
+        self.reader = link_collector.LinkCollector(self.logging_flag)
+        crawl_connection = crawl_db.connect(link_collector.url_core)
+        sentence_connection = connect(link_collector.url_core)
+        try:
+            # Page marks wait until the sentences before them are committed,
+            # so they are flushed only from count_written().
+            self.page_writer = db_writer.BatchWriter(
+                    crawl_connection, float('inf'), float('inf'))
+            self.writer = db_writer.BatchWriter(
+                    sentence_connection, self.batch_size,
+                    self.flush_interval, self.count_written)
+            count_pages = crawl_db.count_to_extract(crawl_connection)
+            if not count_pages:
+                print('\nThere are no pages to extract sentences from.')
+                return
+            print('\nPages to extract sentences from number {}:'.format(
+                    count_pages))
+            hashes = crawl_db.hashes_to_extract(crawl_connection)
+            if self.processes > 1:
+                self.extract_in_parallel(hashes)
+            else:
+                self.extract_serially(hashes)
+            self.writer.flush()
+            self.page_writer.flush()
+        finally:
+            crawl_connection.close()
+            sentence_connection.close()
+            self.reader.store.close()
+
+def main(logging_flag='', batch_size=db_writer.default_batch_size,
+         flush_interval=db_writer.default_flush_interval,
+         processes=default_processes, min_chars=default_min_chars):
+    extractor = SentenceExtractor(logging_flag, batch_size, flush_interval,
+                                  processes, min_chars)
+    extractor.extract()
+    extractor.summarize_run()
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    utils.add_logging_flags(parser)
+    utils.add_site_flags(parser)
+    parser.add_argument('--batch-size', type=int,
+                        default=db_writer.default_batch_size,
+                        help='database writes per transaction '
+                             '(default {})'.format(db_writer.default_batch_size))
+    parser.add_argument('--flush-interval', type=float,
+                        default=db_writer.default_flush_interval,
+                        help='maximum seconds between commits '
+                             '(default {})'.format(
+                                 db_writer.default_flush_interval))
+    parser.add_argument('-p', '--processes', type=int,
+                        default=default_processes,
+                        help='number of processes reading and splitting '
+                             'pages (default {}; 1 to work serially)'
+                             .format(default_processes))
+    parser.add_argument('--min-chars', type=int, default=default_min_chars,
+                        help='fewest Chinese characters in a sentence kept '
+                             '(default {})'.format(default_min_chars))
+    metrics.add_metrics_flags(parser)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    link_collector.set_site(arguments.site, arguments.start_url)
+    with metrics.session('sentence_extractor', arguments):
+        main(arguments.logging_flag, arguments.batch_size,
+             arguments.flush_interval, arguments.processes,
+             arguments.min_chars)
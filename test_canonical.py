@@ -0,0 +1,37 @@
+# test_canonical.py
+'''Tests for canonical.py; run with pytest.'''
+
+import canonical
+
+urls = [
+    'http://example.com/a?q=%26',
+    'http://example.com/a?q=%2B',
+    'http://example.com/a?q=a+b&q=%2B%26%3D%3B%25',
+    'http://example.com/a?b=%3D&a=1;2',
+    'http://example.com/a?q=%2541',
+    'http://example.com/a?u=http://example.org/b%3Fc%3Dd',
+    'http://example.com/a?q=中文&r=%e4%b8%ad',
+    'HTTP://Example.COM:80/b/../c/./d/?utm_source=x&z=1#top',
+    'http://example.com/%7euser/a%2fb',
+]
+
+def test_idempotent():
+    for url in urls:
+        once = canonical.canonicalize(url)
+        assert canonical.canonicalize(once) == once, url
+
+def test_query_escapes_kept():
+    '''Escaped separators in a value are not turned into separators.'''
+    assert (canonical.canonicalize('http://example.com/a?q=%26') ==
+            'http://example.com/a?q=%26')
+    assert (canonical.canonicalize('http://example.com/a?q=%2B') ==
+            'http://example.com/a?q=%2B')
+    assert (canonical.canonicalize('http://example.com/a?q=%2B&p=a+b') ==
+            'http://example.com/a?p=a+b&q=%2B')
+
+def test_default_form():
+    assert (canonical.canonicalize(
+                'HTTP://Example.COM:80/b/../c/./d/?utm_source=x&z=1#top') ==
+            'http://example.com/c/d?z=1')
+    assert (canonical.canonicalize('/a', 'https://example.com:8443/b/') ==
+            'https://example.com:8443/a')
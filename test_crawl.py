@@ -0,0 +1,31 @@
+# test_crawl.py
+'''Tests for crawl.py; run with pytest.'''
+
+import crawl_db
+import crawl
+import downloader
+import link_collector
+
+def test_failed_url_retried_in_run(database, flaky_site, monkeypatch):
+    '''A URL that fails is downloaded again in the same run once its retry
+    falls due.'''
+    site, requests = flaky_site
+    monkeypatch.setattr(downloader, 'retry_delay', lambda attempts: 0.5)
+    for module in (downloader, link_collector):
+        monkeypatch.setattr(module, 'url_core', module.url_core)
+        monkeypatch.setattr(module, 'start_url', module.start_url)
+        module.set_site(database, site)
+    connection = crawl_db.connect(database)
+    connection.execute('INSERT INTO urls (url) VALUES (?)',
+                       (site + '/view/a.html',))
+    connection.commit()
+    crawler = crawl.Crawler(workers=1, host_rate=0, obey_robots=False,
+                            max_retry_wait=5)
+    crawler.crawl()
+    assert requests.count('/view/a.html') == 2
+    assert not crawler.downloader.retries
+    downloaded, attempts = connection.execute(
+            '''SELECT date_downloaded IS NOT NULL, attempts FROM urls
+            WHERE url = ?''', (site + '/view/a.html',)).fetchone()
+    assert (downloaded, attempts) == (1, 1)
+    connection.close()
@@ -0,0 +1,52 @@
+# test_http_pool.py
+'''Tests for http_pool.py; run with pytest.'''
+
+import threading
+import urllib.error
+import http.server
+
+import pytest
+
+import http_pool
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            # Not ASCII, as some sites send.
+            self.send_header('Location', '/页面'.encode('utf-8').decode(
+                    'latin-1'))
+            self.end_headers()
+            return
+        body = b'<html></html>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def site():
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+def test_get(site):
+    client = http_pool.HTTPClient()
+    assert client.get(site + '/a').body == b'<html></html>'
+    client.close()
+
+def test_unencodable_urls_are_url_errors(site):
+    client = http_pool.HTTPClient()
+    with pytest.raises(urllib.error.URLError):
+        client.get(site + '/redirect')
+    with pytest.raises(urllib.error.URLError):
+        client.get(site + '/页面')
+    with pytest.raises(urllib.error.URLError):
+        client.get('http://127.0.0.1:99999/')
+    client.close()
@@ -0,0 +1,56 @@
+# test_ingest.py
+'''Tests for ingest.py; run with pytest.'''
+
+import ingest
+import compression
+import sentence_extractor
+
+sentences = ['今天天气很好，我们一起去公园散步。', '这个城市的交通非常方便。']
+page = ('<html><head>{}<title>测试</title></head><body><div><p>' +
+        ''.join(sentences) + '</p><a href="/view/1.html">下一页</a>'
+        '</div></body></html>')
+codec = compression.codecs['zlib']
+
+def ingest_page(page_bytes, charset=None, chunk_size=7):
+    '''Return a closed PageIngest fed page_bytes chunk_size bytes at a
+    time.'''
+    ingestion = ingest.PageIngest(codec, charset)
+    for i in range(0, len(page_bytes), chunk_size):
+        ingestion.write(page_bytes[i:i + chunk_size])
+    ingestion.close()
+    return ingestion
+
+def test_meta_charset_only():
+    '''A GBK page that declares its charset only in <meta> is stored as
+    UTF-8 and its sentences are found.'''
+    page_bytes = page.format('<meta charset="gbk">').encode('gbk')
+    for chunk_size in (7, ingest.sniff_size + 1, len(page_bytes)):
+        ingestion = ingest_page(page_bytes, chunk_size=chunk_size)
+        assert ingestion.charset == 'gbk'
+        assert ingestion.content_blocks() == [''.join(sentences)]
+        assert ingestion.links == ['/view/1.html']
+        stored = codec.decompress(ingestion.data)
+        assert stored == page.format('<meta charset="gbk">').encode('utf-8')
+        assert sentence_extractor.extract_sentences(stored, 1) == sentences
+
+def test_meta_http_equiv_gb2312():
+    '''GB2312 is read as GBK, its superset.'''
+    meta = ('<meta http-equiv="Content-Type" '
+            'content="text/html; charset=gb2312">')
+    ingestion = ingest_page(page.format(meta).encode('gbk'))
+    assert ingestion.charset == 'gbk'
+    assert ingestion.content_blocks() == [''.join(sentences)]
+
+def test_header_charset_wins():
+    '''The charset of the response is used over that of <meta>.'''
+    page_bytes = page.format('<meta charset="gbk">').encode('utf-8')
+    ingestion = ingest_page(page_bytes, 'utf-8')
+    assert ingestion.charset == 'utf-8'
+    assert codec.decompress(ingestion.data) == page_bytes
+
+def test_no_charset_is_utf8():
+    page_bytes = page.format('').encode('utf-8')
+    ingestion = ingest_page(page_bytes)
+    assert ingestion.charset == 'utf-8'
+    assert codec.decompress(ingestion.data) == page_bytes
+    assert ingestion.content_blocks() == [''.join(sentences)]
@@ -0,0 +1,118 @@
+# test_leases.py
+'''Tests for the leases of crawl_db.py and Downloader.download_leased();
+run with pytest.'''
+
+import os
+import time
+import threading
+
+import pytest
+
+import crawl_db
+import db_writer
+import downloader
+
+@pytest.fixture
+def connection(database):
+    connection = crawl_db.connect(database)
+    yield connection
+    connection.close()
+
+def add_urls(connection, urls):
+    connection.executemany('INSERT INTO urls (url) VALUES (?)',
+                           [(url,) for url in urls])
+    connection.commit()
+
+def lease_of(connection, url):
+    return connection.execute('''SELECT lease_owner, lease_expires FROM urls
+            WHERE url = ?''', (url,)).fetchone()
+
+def test_owners_never_share_a_url(database, connection):
+    add_urls(connection, ['http://example.com/{}'.format(i)
+                          for i in range(50)])
+    claimed = {'a': [], 'b': []}
+
+    def claim(owner):
+        connection = crawl_db.connect(database)
+        while True:
+            urls = crawl_db.claim_urls(connection, owner, 3, 60)
+            if not urls:
+                break
+            claimed[owner].extend(urls)
+        connection.close()
+
+    threads = [threading.Thread(target=claim, args=(owner,))
+               for owner in claimed]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not set(claimed['a']) & set(claimed['b'])
+    assert len(claimed['a']) + len(claimed['b']) == 50
+
+def test_expired_lease_claimed_by_another(connection):
+    add_urls(connection, ['http://example.com/a'])
+    assert crawl_db.claim_urls(connection, 'a', 10, 60) == [
+            'http://example.com/a']
+    assert crawl_db.claim_urls(connection, 'b', 10, 60) == []
+    assert crawl_db.claim_urls(connection, 'a', 10, 60) == []
+    crawl_db.renew_leases(connection, 'a', -1)
+    assert crawl_db.claim_urls(connection, 'b', 10, 60) == [
+            'http://example.com/a']
+    assert lease_of(connection, 'http://example.com/a')[0] == 'b'
+
+def test_expired_lease_reclaimed(connection):
+    add_urls(connection, ['http://example.com/a', 'http://example.com/b'])
+    crawl_db.claim_urls(connection, 'a', 1, 60)
+    crawl_db.claim_urls(connection, 'b', 1, -1)
+    assert crawl_db.reclaim_expired_leases(connection) == 1
+    assert lease_of(connection, 'http://example.com/a')[0] == 'a'
+    assert lease_of(connection, 'http://example.com/b') == (None, None)
+
+def test_renewal_leaves_others_leases(connection):
+    add_urls(connection, ['http://example.com/a', 'http://example.com/b'])
+    crawl_db.claim_urls(connection, 'a', 2, -1)
+    # a's leases expire and b takes one of them.
+    assert crawl_db.claim_urls(connection, 'b', 1, 60) == [
+            'http://example.com/a']
+    _, expires_b = lease_of(connection, 'http://example.com/a')
+    assert crawl_db.renew_leases(connection, 'a', 600) == 1
+    assert lease_of(connection, 'http://example.com/a') == ('b', expires_b)
+    owner, expires = lease_of(connection, 'http://example.com/b')
+    assert owner == 'a' and expires > expires_b
+
+def test_release(connection):
+    add_urls(connection, ['http://example.com/a', 'http://example.com/b'])
+    crawl_db.claim_urls(connection, 'a', 1, 60)
+    crawl_db.claim_urls(connection, 'b', 1, 60)
+    assert crawl_db.release_leases(connection, 'a') == 1
+    assert [row[0] for row in crawl_db.leases(connection)] == ['b']
+    assert crawl_db.count_ready_to_download(connection) == 1
+
+def test_failed_url_retried_by_same_worker(database, connection, flaky_site,
+                                           monkeypatch):
+    '''A URL that failed once is downloaded when it falls due, by the
+    worker that tried it first, not given up on.'''
+    monkeypatch.setattr(downloader, 'retry_delay', lambda attempts: 0.5)
+    monkeypatch.setattr(downloader, 'idle_poll_interval', 0.2)
+    monkeypatch.setattr(downloader, 'url_core', downloader.url_core)
+    monkeypatch.setattr(downloader, 'start_url', downloader.start_url)
+    site, requests = flaky_site
+    downloader.set_site(database, site)
+    url = site + '/view/a.html'
+    add_urls(connection, [url])
+    worker = downloader.Downloader('', workers=1, host_rate=0,
+                                   obey_robots=False)
+    worker.connection = connection
+    worker.writer = db_writer.BatchWriter(connection, 1, 0,
+                                          worker.count_written)
+    start = time.time()
+    worker.download_leased('w0', lease_seconds=60, idle_wait=1)
+    worker.store.close()
+    worker.http.close()
+    assert requests == ['/view/a.html', '/view/a.html']
+    downloaded, attempts, dead_letter, lease = connection.execute(
+            '''SELECT date_downloaded IS NOT NULL, attempts, dead_letter,
+            lease_owner FROM urls WHERE url = ?''', (url,)).fetchone()
+    assert (downloaded, attempts, dead_letter, lease) == (1, 1, None, None)
+    assert time.time() - start < 30
@@ -0,0 +1,39 @@
+# test_link_extractors.py
+'''Tests for link_extractors.py; run with pytest.'''
+
+import os
+import hashlib
+
+import pack_store
+import compression
+import link_extractors
+
+directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'CRAWLED_PAGES')
+# Markup the scanners could be led astray by.
+pages = [
+    '<html><body><a href="/view/1.html">一</a><a href="/other/2.html">二</a>'
+    '<A HREF="/view/3.html">三</A><a name="x">四</a></body></html>',
+    '<p><a href=/view/4.html>unquoted</a><a class="x" href=\'/view/5.html\''
+    '>single</a><a href="/view/6.html"/></p>',
+    '<script>var s = "<a href=\\"/view/7.html\\">";</script>'
+    '<!-- <a href="/view/8.html"> --><a href="/view/9.html?a=1&amp;b=2">'
+    '</a>',
+    '<a href="/view/10.html"><a href="/view/10.html"><a href=" /view/11.html"'
+    '>',
+]
+
+def test_parity_on_saved_pages():
+    count_pages, count_differing = link_extractors.check_parity(directory)
+    assert count_pages
+    assert count_differing == 0
+
+def test_parity_on_tricky_markup(tmp_path):
+    store = pack_store.PackStore(str(tmp_path), 'test')
+    codec = compression.codecs[compression.default_codec]
+    for page in pages:
+        data = page.encode('utf-8')
+        store.put(hashlib.md5(data).hexdigest(), codec.compress(data),
+                  codec.number)
+    store.close()
+    assert link_extractors.check_parity(str(tmp_path)) == (len(pages), 0)
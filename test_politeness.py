@@ -0,0 +1,57 @@
+# test_politeness.py
+'''Tests for politeness.py; run with pytest.'''
+
+import urllib.robotparser
+
+import pytest
+
+import politeness
+
+class Robots(object):
+    '''A RobotsCache with the same robots.txt for every host.'''
+    user_agent = 'slithersentence'
+
+    def __init__(self, text):
+        self.text = text
+
+    def rules(self, scheme, netloc):
+        rules = urllib.robotparser.RobotFileParser()
+        rules.parse(self.text.splitlines())
+        return rules
+
+def test_slots_add_up():
+    for count in range(1, 9):
+        for processes in range(1, count + 1):
+            slots = [politeness.slots_of(count, (index, processes))
+                     for index in range(processes)]
+            assert sum(slots) == count
+            assert max(slots) - min(slots) <= 1
+            assert min(slots) >= 1
+
+def test_shared_limits():
+    schedulers = [politeness.HostScheduler(4.0, 4, share=(index, 3))
+                  for index in range(3)]
+    assert sum(scheduler.rate for scheduler in schedulers) == pytest.approx(4)
+    assert [scheduler.concurrency for scheduler in schedulers] == [2, 1, 1]
+    assert sum(scheduler.burst for scheduler in schedulers) == 4
+
+def test_too_many_to_share():
+    with pytest.raises(ValueError):
+        politeness.HostScheduler(4.0, 2, share=(0, 3))
+
+def test_robots_rate_shared():
+    robots = Robots('User-agent: *\nCrawl-delay: 2\n')
+    rates = []
+    bursts = []
+    for index in range(4):
+        scheduler = politeness.HostScheduler(4.0, 4, robots, share=(index, 4))
+        host = scheduler.host('http://example.com/a')
+        rates.append(host.bucket.rate)
+        bursts.append(host.bucket.burst)
+    assert sum(rates) == pytest.approx(0.5)
+    assert sum(bursts) == 1
+
+def test_robots_rate_unshared():
+    robots = Robots('User-agent: *\nRequest-rate: 1/4\n')
+    scheduler = politeness.HostScheduler(4.0, 4, robots)
+    assert scheduler.host('http://example.com/a').bucket.rate == 0.25
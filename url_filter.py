@@ -0,0 +1,120 @@
+# url_filter.py
+'''In-memory filters of the URLs already in the database.
+
+Most links found on a page are already known, so LinkCollector checks each
+one against a filter, warmed from the urls table, before it goes to SQLite.
+
+    'exact'  a set of the URLs; no false positives, but memory grows with
+             the length of the URLs.
+    'bloom'  a Bloom filter of fixed size. A URL it reports as seen may be
+             new (a false positive, at about the configured rate); such URLs
+             are checked against the database, so none is lost.
+'''
+
+import sys
+import math
+import hashlib
+
+default_kind = 'exact'
+default_error_rate = 0.001
+# Bloom filters are sized for at least this many URLs, and for twice as
+# many as the database holds.
+min_capacity = 100000
+
+class ExactFilter(object):
+    '''The set of URLs seen.'''
+    exact = True
+
+    def __init__(self):
+        self.urls = set()
+        self.url_bytes = 0
+
+    def add(self, url):
+        '''Add url; return True if it had not been seen.'''
+        if url in self.urls:
+            return False
+        self.urls.add(url)
+        self.url_bytes += sys.getsizeof(url)
+        return True
+
+    def __len__(self):
+        return len(self.urls)
+
+    def memory(self):
+        '''Return an estimate, in bytes, of the memory the filter holds.'''
+        return sys.getsizeof(self.urls) + self.url_bytes
+
+    def error_rate(self):
+        return 0.0
+
+class BloomFilter(object):
+    '''Bloom filter for capacity URLs with about the given false-positive
+    rate, or of max_bytes bytes if that is smaller.'''
+    exact = False
+
+    def __init__(self, capacity, error_rate=default_error_rate,
+                 max_bytes=None):
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if max_bytes:
+            bits = min(bits, max_bytes * 8)
+        self.bits = max(bits, 64)
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, url):
+        # Double hashing: k positions from two 64-bit halves of one digest.
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, url):
+        '''Add url; return True if it had certainly not been seen.'''
+        new = False
+        for position in self.positions(url):
+            byte, bit = divmod(position, 8)
+            if not self.array[byte] & (1 << bit):
+                self.array[byte] |= 1 << bit
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __len__(self):
+        return self.count
+
+    def memory(self):
+        return sys.getsizeof(self.array)
+
+    def error_rate(self):
+        '''Return the expected false-positive rate at the present fill.'''
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** \
+                self.hashes
+
+kinds = ('exact', 'bloom', 'none')
+
+def make_filter(kind=default_kind, count_urls=0, error_rate=default_error_rate,
+                max_megabytes=None):
+    '''Return an empty filter of the given kind (None for 'none'), sized for
+    a database of count_urls URLs.'''
+    if kind == 'exact':
+        return ExactFilter()
+    if kind == 'bloom':
+        return BloomFilter(max(2 * count_urls, min_capacity), error_rate,
+                           int(max_megabytes * 2**20) if max_megabytes
+                           else None)
+    return None
+
+def add_filter_flags(parser):
+    '''Add the URL-filter switches to an argparse parser.'''
+    parser.add_argument('--url-filter', choices=kinds, default=default_kind,
+                        help='in-memory filter of known URLs, so that only '
+                             'new ones are written (default {})'.format(
+                                 default_kind))
+    parser.add_argument('--filter-error-rate', type=float,
+                        default=default_error_rate,
+                        help='false-positive rate the Bloom filter is sized '
+                             'for (default {})'.format(default_error_rate))
+    parser.add_argument('--filter-memory', type=float,
+                        help='most megabytes for the Bloom filter')
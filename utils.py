@@ -1,4 +1,11 @@
 import logging
+import datetime
+import concurrent.futures
+
+# The site crawled unless another is given with --site.
+default_site = 'worldjournal'
+# Tasks kept in flight per worker by run_bounded().
+in_flight_per_worker = 4
 
 def set_up_logger(app_name, logging_flag):
     '''Set the logging level from a command-line switch. Default WARN.'''
@@ -22,3 +29,54 @@ def percentage(numerator, denominator):
         return 0               # XXX better to make this float('nan')?
     else:
         return round(100 * numerator / denominator)
+
+def add_logging_flags(parser):
+    '''Add the -d/-i/-e/-c logging switches to an argparse parser.'''
+    for flag, level in (('-d', 'DEBUG'), ('-i', 'INFO'), ('-e', 'ERROR'),
+                        ('-c', 'CRITICAL')):
+        parser.add_argument(flag, dest='logging_flag', action='store_const',
+                            const=flag, help='log at level ' + level)
+    parser.set_defaults(logging_flag='')
+
+def site_start_url(site):
+    '''Return the top-level page of the site with the given short name.'''
+    return 'http://' + site + '.com'
+
+def add_site_flags(parser):
+    '''Add the --site/--start-url switches to an argparse parser.'''
+    parser.add_argument('--site', default=default_site,
+                        help='short name of the site, which names its '
+                             'database and pack file (default {})'
+                             .format(default_site))
+    parser.add_argument('--start-url',
+                        help='top-level page of the site '
+                             '(default http://SITE.com)')
+
+def timestamp(seconds_from_now=0):
+    '''Return the time now, or seconds_from_now later, as stored in the db.'''
+    moment = (datetime.datetime.now() +
+              datetime.timedelta(seconds=seconds_from_now))
+    return datetime.datetime.strftime(moment, '%Y-%m-%d %H:%M:%S.%f')
+
+def run_bounded(executor, function, arguments, workers):
+    '''Call function(*args) in executor for each tuple args in arguments;
+    yield (args, future) as each call finishes.
+
+    Only in_flight_per_worker calls per worker are submitted ahead, so that
+    arguments may be a generator over a very long queue, read only as it is
+    needed.
+    '''
+    arguments = iter(arguments)
+    max_in_flight = in_flight_per_worker * workers
+    futures = {}
+    while True:
+        for args in arguments:
+            futures[executor.submit(function, *args)] = args
+            if len(futures) >= max_in_flight:
+                break
+        if not futures:
+            return
+        done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            yield futures.pop(future), future